@@ -0,0 +1,76 @@
+"""
+Compare the flat and sharded blob directory layouts, reports the time to create, look up
+and unlink a blob file and to list the top directory at 10k, 100k and 1M files
+
+python -m benchmarks.blob_directory [--dir /tmp] [--files 10000,100000,1000000] [--output results.json]
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from prism.storage.storage import blob_subdir
+from benchmarks.utils import write_results
+
+LEVELS = (0, 1, 2)
+
+
+def timed(fn, paths):
+    start = time.time()
+    for path in paths:
+        fn(path)
+    return (time.time() - start) / len(paths) * 1000000.0
+
+
+def create(path):
+    open(path, 'wb').close()
+
+
+def run_layout(base_dir, blob_hashes, levels):
+    db_dir = tempfile.mkdtemp(dir=base_dir)
+    try:
+        blob_dirs = set()
+        paths = []
+        for blob_hash in blob_hashes:
+            blob_dir = os.path.join(db_dir, blob_subdir(blob_hash, levels))
+            if blob_dir not in blob_dirs:
+                if not os.path.isdir(blob_dir):
+                    os.makedirs(blob_dir)
+                blob_dirs.add(blob_dir)
+            paths.append(os.path.join(blob_dir, blob_hash))
+        result = {'create_us': timed(create, paths)}
+        start = time.time()
+        os.listdir(db_dir)
+        result['list_top_ms'] = (time.time() - start) * 1000.0
+        result['lookup_us'] = timed(os.stat, paths[::-1])
+        result['unlink_us'] = timed(os.remove, paths)
+        return result
+    finally:
+        shutil.rmtree(db_dir)
+
+
+def run_benchmark(args):
+    results = []
+    for num_files in [int(n) for n in args.files.split(',')]:
+        blob_hashes = [hashlib.sha384(str(i)).hexdigest() for i in range(num_files)]
+        for levels in LEVELS:
+            result = run_layout(args.dir, blob_hashes, levels)
+            result.update({'files': num_files, 'levels': levels})
+            results.append(result)
+    write_results('blob_directory', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--dir', default=tempfile.gettempdir(),
+                        help='directory to create the files in, use the filesystem of the blob directory')
+    parser.add_argument('--files', default='10000,100000,1000000', help='comma separated file counts')
+    parser.add_argument('--output', help='write the json results to this file')
+    run_benchmark(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Compare the json and packed blob_hashes entries, redis memory per million blobs and
+time to decode an entry
+
+python -m benchmarks.blob_records [--redis localhost] [--blobs 200000] [--output results.json]
+"""
+
+import time
+import json
+import hashlib
+import argparse
+
+from redis import Redis
+
+from prism.storage.storage import RedisHelper
+from benchmarks.utils import write_results
+
+BENCHMARK_KEY = 'benchmark_blob_records'
+HOST = 'jack.lbry.tech'
+PAGE_SIZE = 10000
+
+
+def encode_json(helper, length, timestamp, host):
+    return json.dumps([length, timestamp, host])
+
+
+def encode_packed(helper, length, timestamp, host):
+    return helper._encode_blob(length, timestamp, host)
+
+
+def memory_per_million(db, blob_hashes, values):
+    db.delete(BENCHMARK_KEY)
+    before = db.info('memory')['used_memory']
+    for i in range(0, len(blob_hashes), PAGE_SIZE):
+        pipe = db.pipeline(transaction=False)
+        for blob_hash, value in zip(blob_hashes[i:i + PAGE_SIZE], values[i:i + PAGE_SIZE]):
+            pipe.hset(BENCHMARK_KEY, blob_hash, value)
+        pipe.execute()
+    used = db.info('memory')['used_memory'] - before
+    db.delete(BENCHMARK_KEY)
+    return used * 1000000.0 / len(blob_hashes)
+
+
+def run_benchmark(args):
+    db = Redis(args.redis)
+    helper = RedisHelper(args.redis)
+    helper._host_ids[HOST] = 1
+    helper._host_names[1] = HOST
+    blob_hashes = [hashlib.sha384(str(i)).hexdigest() for i in range(args.blobs)]
+    timestamp = time.time()
+    results = []
+    for encoding, encode in (('json', encode_json), ('packed', encode_packed)):
+        values = [encode(helper, 2097152, timestamp + i, HOST) for i in range(args.blobs)]
+        start = time.time()
+        for value in values:
+            helper._decode_blob(value)
+        decode_time = time.time() - start
+        results.append({
+            'encoding': encoding,
+            'value_bytes': len(values[0]),
+            'redis_bytes_per_million_blobs': memory_per_million(db, blob_hashes, values),
+            'decode_us': decode_time / args.blobs * 1000000.0,
+        })
+    results.append({
+        'encoding': 'saved',
+        'redis_bytes_per_million_blobs': results[0]['redis_bytes_per_million_blobs'] -
+                                         results[1]['redis_bytes_per_million_blobs'],
+    })
+    write_results('blob_records', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--blobs', type=int, default=200000)
+    parser.add_argument('--output', help='write the json results to this file')
+    run_benchmark(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Open many idle reflector connections to a PrismServer and measure the handshake latency
+as the number of open connections grows
+
+python -m benchmarks.connections [--connections 10000] [--batch 500] [--output results.json]
+
+The server runs in a child process using the configured reactor and the fake redis backend.
+Connections are held idle, the server drops idle connections after
+ReflectorServerProtocol.PROTOCOL_TIMEOUT seconds, so they are all opened well within that.
+"""
+
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import ClientCreator, Protocol
+
+from prism.config import get_settings
+from prism.reactors import raise_open_files_limit
+from benchmarks.utils import run_reactor, summarize_latencies, write_results
+
+
+class HandshakeClient(Protocol):
+    def connectionMade(self):
+        self.handshake_d = defer.Deferred()
+        self.lost = False
+        self.started = time.time()
+        self.transport.write(json.dumps({'version': 1}))
+
+    def dataReceived(self, data):
+        if not self.handshake_d.called:
+            self.handshake_d.callback(time.time() - self.started)
+
+    def connectionLost(self, reason=None):
+        self.lost = True
+
+
+@defer.inlineCallbacks
+def wait_for_server(port, address='127.0.0.1'):
+    for _ in range(100):
+        try:
+            client = yield ClientCreator(reactor, Protocol).connectTCP(address, port)
+        except Exception:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        else:
+            client.transport.loseConnection()
+            return
+    raise Exception("server did not start")
+
+
+@defer.inlineCallbacks
+def connect(port):
+    start = time.time()
+    client = yield ClientCreator(reactor, HandshakeClient).connectTCP('127.0.0.1', port, timeout=30)
+    yield client.handshake_d
+    defer.returnValue((client, time.time() - start))
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.connections', '--serve',
+                               '--port', str(args.port)])
+    clients = []
+    results = []
+    try:
+        yield wait_for_server(args.port)
+        while len(clients) < args.connections:
+            batch = min(args.batch, args.connections - len(clients))
+            start = time.time()
+            connected = yield defer.gatherResults([connect(args.port) for _ in range(batch)])
+            elapsed = time.time() - start
+            clients.extend(c for c, _ in connected)
+            result = summarize_latencies([latency for _, latency in connected])
+            result.update({
+                'open_connections': len(clients),
+                'connects_per_sec': batch / elapsed,
+            })
+            results.append(result)
+        still_open = len([c for c in clients if not c.lost])
+        results.append({'open_connections': len(clients), 'still_open': still_open})
+    finally:
+        for client in clients:
+            client.transport.abortConnection()
+        server.terminate()
+        server.wait()
+    write_results('connections', results, args.output)
+
+
+def serve(port):
+    from prism.server import PrismServer
+    from prism.storage.storage import ClusterStorage
+    db_dir = tempfile.mkdtemp()
+    raise_open_files_limit(get_settings()['max open files'])
+    server = PrismServer(port, ClusterStorage(db_dir, 'fake'), '127.0.0.1')
+    reactor.callWhenRunning(server.startService)
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(db_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=500, help='connections opened at a time')
+    parser.add_argument('--port', type=int, default=5599)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='write the json results to this file')
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.port)
+    # each connection needs a file descriptor here as well as in the server
+    raise_open_files_limit(args.connections + 1024)
+    run_reactor(run_benchmark, args)
+
+
+if __name__ == '__main__':
+    main()
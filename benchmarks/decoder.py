@@ -0,0 +1,106 @@
+"""
+Feed reflector requests to the incremental ReflectorMessageDecoder and to the framing the
+server used before it, in 1 byte, 1 KB and 64 KB chunks
+
+python -m benchmarks.decoder [--size 1048576] [--output results.json]
+"""
+
+import json
+import time
+import hashlib
+import argparse
+
+from prism.constants import MAXIMUM_QUERY_SIZE
+from prism.protocol.decoder import ReflectorMessageDecoder
+from benchmarks.utils import write_results
+
+CHUNK_SIZES = (1, 1024, 65536)
+
+
+def legacy_decode(buff):
+    # ReflectorServerProtocol._get_valid_response, before the incremental decoder
+    curr_pos = 0
+    while True:
+        next_close_paren = buff.find('}', curr_pos)
+        if next_close_paren == -1:
+            return None, buff
+        curr_pos = next_close_paren + 1
+        try:
+            msg = json.loads(buff[:curr_pos])
+        except ValueError:
+            if curr_pos > MAXIMUM_QUERY_SIZE:
+                raise ValueError("Error decoding response")
+        else:
+            return msg, buff[curr_pos:]
+
+
+def run_legacy(chunks):
+    messages = 0
+    buff = ''
+    for chunk in chunks:
+        buff += chunk
+        while True:
+            msg, buff = legacy_decode(buff)
+            if msg is None:
+                break
+            messages += 1
+    return messages
+
+
+def run_incremental(chunks):
+    messages = 0
+    decoder = ReflectorMessageDecoder(MAXIMUM_QUERY_SIZE)
+    for chunk in chunks:
+        offset = 0
+        while offset < len(chunk):
+            msg, offset = decoder.decode(chunk, offset)
+            if msg is None:
+                break
+            messages += 1
+    return messages
+
+
+def make_payload(pattern, size):
+    messages = []
+    total = 0
+    i = 0
+    while total < size:
+        if pattern == 'requests':
+            msg = json.dumps({'blob_hash': hashlib.sha384(str(i)).hexdigest(), 'blob_size': 2097152})
+        else:
+            # closing braces inside strings make the legacy framing try json.loads at each one
+            msg = json.dumps({'blob_hash': '}' * 96, 'blob_size': 2097152})
+        messages.append(msg)
+        total += len(msg)
+        i += 1
+    return ''.join(messages), len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='bytes of requests per run')
+    parser.add_argument('--output', help='write the json results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for pattern in ('requests', 'braces'):
+        payload, num_messages = make_payload(pattern, args.size)
+        for chunk_size in CHUNK_SIZES:
+            chunks = [payload[i:i + chunk_size] for i in xrange(0, len(payload), chunk_size)]
+            for name, fn in (('legacy', run_legacy), ('incremental', run_incremental)):
+                start = time.time()
+                decoded = fn(chunks)
+                elapsed = time.time() - start
+                assert decoded == num_messages, "%s decoded %i of %i messages" % (name, decoded, num_messages)
+                results.append({
+                    'decoder': name,
+                    'pattern': pattern,
+                    'chunk_size': chunk_size,
+                    'mb_per_sec': len(payload) / elapsed / 1024 / 1024,
+                    'messages_per_sec': num_messages / elapsed,
+                })
+    write_results('decoder', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Time build_prism_stream_client_factory for streams of 10, 100 and 1000 blobs, comparing
+BlobFile checks of every blob with the verification records in redis and the local cache
+
+python -m benchmarks.factory_build [--redis localhost] [--iterations 50] [--output results.json]
+"""
+
+import argparse
+import shutil
+import tempfile
+
+from twisted.internet import defer
+
+from prism.protocol.factory import build_prism_stream_client_factory
+from prism.storage.storage import ClusterStorage, get_redis_helper
+from prism.storage.verification import VerificationCache
+from benchmarks.utils import run_concurrently, run_reactor, seed_stream, summarize_latencies, write_results
+
+STREAM_SIZES = (10, 100, 1000)
+BLOB_SIZE = 2097152
+
+
+@defer.inlineCallbacks
+def build_with_blob_files(storage, sd_hash):
+    # the checks the factory made before verifications were recorded
+    sd_blob = yield storage.get_blob(sd_hash)
+    assert sd_blob.verified
+    blob_hashes = yield storage.db.get_blobs_for_stream(sd_hash)
+    for blob_hash in blob_hashes:
+        in_cluster = yield storage.db.blob_has_been_forwarded_to_host(blob_hash)
+        if not in_cluster:
+            blob = yield storage.get_blob(blob_hash)
+            assert blob.verified
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    db_dir = tempfile.mkdtemp()
+    storage = ClusterStorage(db_dir, args.redis)
+    storage.db = get_redis_helper(args.redis, args.client)
+    results = []
+    try:
+        for num_blobs in STREAM_SIZES:
+            sd_hash = yield seed_stream(storage, num_blobs, num_blobs, BLOB_SIZE)
+            methods = (
+                ('blob_files', lambda: build_with_blob_files(storage, sd_hash), 0),
+                ('redis_record', lambda: build_prism_stream_client_factory(sd_hash, storage, None), 0),
+                ('local_cache', lambda: build_prism_stream_client_factory(sd_hash, storage, None),
+                 num_blobs + 1),
+            )
+            for method, fn, cache_size in methods:
+                storage.verification_cache = VerificationCache(cache_size)
+                elapsed, latencies = yield run_concurrently(1, args.iterations, fn)
+                result = summarize_latencies(latencies)
+                result.update({'method': method, 'stream_blobs': num_blobs})
+                results.append(result)
+    finally:
+        shutil.rmtree(db_dir)
+    write_results('factory_build', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--client', default='thread', choices=('thread', 'reactor'))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Forward streams from a seeded prism blob directory to several stand-in reflector hosts with
+prism-worker processes, reports streams/s, bytes/s, the balance of the hosts and the share of
+the jobs that failed
+
+python -m benchmarks.forwarding [--streams 200] [--blobs 4] [--hosts 4] [--workers 2] [--mode reactor]
+                                [--delay 0.005] [--bandwidth 0] [--failure-rate 0] [--output results.json]
+
+Every stand-in host listens on its own loopback address, 127.0.1.1 and up, since hosts are told
+apart by address. The streams are placed on the hosts with the hash ring the "consistent"
+placement uses and enqueued through the configured redis server and the "default" queue, which
+must be empty. Point the settings at a local redis-server, never a production one.
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from twisted.internet import defer
+from rq import Queue
+
+from prism.config import get_settings
+from prism.placement import HashRing
+from prism.protocol.factory import build_prism_stream_client_factory
+from prism.protocol.task import enqueue_stream
+from prism.storage.storage import ClusterStorage, get_redis_connection
+from benchmarks.connections import wait_for_server
+from benchmarks.utils import run_reactor, seed_stream, write_results
+from benchmarks.worker import wait_for_exit
+
+settings = get_settings()
+FAILED_QUEUE_KEY = Queue.redis_queue_namespace_prefix + 'failed'
+
+
+def host_address(i):
+    return '127.0.1.%i' % (i + 1)
+
+
+def start_hosts(args):
+    hosts = []
+    for i in range(args.hosts):
+        hosts.append(subprocess.Popen([sys.executable, '-m', 'benchmarks.hosts', '--interface', host_address(i),
+                                       '--port', str(args.port), '--delay', str(args.delay),
+                                       '--pipelined-blobs', str(args.pipelined_blobs),
+                                       '--bandwidth', str(args.bandwidth),
+                                       '--failure-rate', str(args.failure_rate)]))
+    return hosts
+
+
+def balance(counts):
+    # the largest host count over the mean, 1.0 is perfectly even
+    mean = float(sum(counts)) / len(counts)
+    return max(counts) / mean if mean else None
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    redis_address = settings['redis server']
+    redis_conn = get_redis_connection(redis_address)
+    if redis_conn.llen(Queue.redis_queue_namespace_prefix + 'default'):
+        raise Exception("the default queue is not empty")
+    addresses = [host_address(i) for i in range(args.hosts)]
+    hosts = start_hosts(args)
+    db_dir = tempfile.mkdtemp()
+    storage = ClusterStorage(db_dir, redis_address)
+    try:
+        for address in addresses:
+            yield wait_for_server(args.port, address)
+        ring = HashRing(addresses, settings['virtual nodes'])
+        sd_hashes = []
+        for i in range(args.streams):
+            sd_hash = yield seed_stream(storage, 'forwarding-%i' % i, args.blobs, args.blob_size)
+            sd_hashes.append(sd_hash)
+        host_counts = {}
+        for address in addresses:
+            host_counts[address] = yield storage.get_host_count(address)
+        failed_before = redis_conn.llen(FAILED_QUEUE_KEY)
+        for sd_hash in sd_hashes:
+            address = ring.host_for(sd_hash)
+            enqueue_stream(sd_hash, args.blobs, db_dir, build_prism_stream_client_factory, redis_address,
+                           host_infos=(address, args.port, host_counts[address]))
+
+        start = time.time()
+        workers = [subprocess.Popen([sys.executable, '-m', 'prism.worker', '--burst', '--mode', args.mode,
+                                     '--max-in-flight', str(args.max_in_flight),
+                                     '--host-connections', str(args.host_connections)])
+                   for _ in range(args.workers)]
+        for worker in workers:
+            yield wait_for_exit(worker)
+        elapsed = time.time() - start
+
+        forwarded = 0
+        for sd_hash in sd_hashes:
+            in_cluster = yield storage.blob_has_been_forwarded_to_host(sd_hash)
+            forwarded += int(bool(in_cluster))
+        host_blobs = {}
+        for address in addresses:
+            count = yield storage.get_host_count(address)
+            host_blobs[address] = count - host_counts[address]
+        failed_jobs = redis_conn.llen(FAILED_QUEUE_KEY) - failed_before
+    finally:
+        shutil.rmtree(db_dir)
+        for host in hosts:
+            host.terminate()
+            host.wait()
+    stream_bytes = (args.blobs + 1) * args.blob_size
+    write_results('forwarding', [{
+        'hosts': args.hosts,
+        'workers': args.workers,
+        'mode': args.mode,
+        'delay_ms': args.delay * 1000,
+        'bandwidth': args.bandwidth,
+        'failure_rate': args.failure_rate,
+        'streams': args.streams,
+        'forwarded': forwarded,
+        'failed_jobs': failed_jobs,
+        'job_failure_rate': float(args.streams - forwarded) / args.streams,
+        'streams_per_sec': forwarded / elapsed,
+        'mb_per_sec': forwarded * stream_bytes / elapsed / 1024 / 1024,
+        'host_blobs': host_blobs,
+        'host_balance': balance(list(host_blobs.values())),
+    }], args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--blobs', type=int, default=4, help='blobs in each stream')
+    parser.add_argument('--blob-size', type=int, default=65536)
+    parser.add_argument('--hosts', type=int, default=4, help='stand-in hosts')
+    parser.add_argument('--workers', type=int, default=2, help='prism-worker processes')
+    parser.add_argument('--mode', choices=('fork', 'reactor'), default='reactor', help='prism-worker --mode')
+    parser.add_argument('--max-in-flight', type=int, default=32, help='jobs in flight for each reactor worker')
+    parser.add_argument('--host-connections', type=int, default=0, help='pooled connections to each host')
+    parser.add_argument('--delay', type=float, default=0.005, help='seconds the hosts wait before each response')
+    parser.add_argument('--pipelined-blobs', type=int, default=0, help='pipelined offers the hosts accept')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes a second each host receives, 0 for no limit')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='share of the host connections dropped after their first offer')
+    parser.add_argument('--port', type=int, default=5567)
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
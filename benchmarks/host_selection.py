@@ -0,0 +1,91 @@
+"""
+Compare picking a host by counting every host table with picking from the kept host blob
+counts, read for every pick and cached, with 10, 100 and 1000 hosts on a local redis-server
+
+python -m benchmarks.host_selection [--redis localhost] [--picks 2000] [--output results.json]
+"""
+
+import time
+import random
+import argparse
+
+from redis import Redis
+
+from prism.config import get_settings
+from prism.protocol import task
+from prism.storage.storage import HOST_BLOB_COUNTS
+from benchmarks.utils import write_results
+
+settings = get_settings()
+HOST_COUNTS = (10, 100, 1000)
+BLOBS_PER_HOST = 100
+
+
+def next_host_by_scard(redis_conn):
+    # how hosts were picked before the counts were kept
+    host_info = {}
+    for address, port in task.HOST_ADDRESSES:
+        count = redis_conn.scard(address)
+        if count < settings['max blobs']:
+            host_info["%s:%i" % (address, port)] = count
+    host = random.choice(host_info.keys())
+    address, port = host.split(":")
+    return address, int(port), host_info[host]
+
+
+def seed(redis_conn, num_hosts):
+    addresses = ['benchmark-host-%i' % i for i in range(num_hosts)]
+    pipe = redis_conn.pipeline(transaction=False)
+    for address in addresses:
+        blobs = random.randint(1, BLOBS_PER_HOST)
+        pipe.sadd(address, *['%s-%i' % (address, i) for i in range(blobs)])
+        pipe.hset(HOST_BLOB_COUNTS, address, blobs)
+    pipe.execute()
+    return addresses
+
+
+def clean(redis_conn, addresses):
+    pipe = redis_conn.pipeline(transaction=False)
+    for address in addresses:
+        pipe.delete(address)
+    pipe.hdel(HOST_BLOB_COUNTS, *addresses)
+    pipe.execute()
+
+
+def run_benchmark(args):
+    redis_conn = Redis(args.redis)
+    results = []
+    for num_hosts in HOST_COUNTS:
+        addresses = seed(redis_conn, num_hosts)
+        task.HOST_ADDRESSES = [(address, 5566) for address in addresses]
+        try:
+            for method, pick, ttl in (('scard', next_host_by_scard, 0),
+                                      ('counts', task.next_host, 0),
+                                      ('cached_counts', task.next_host, settings['host counts ttl'])):
+                task.HOST_COUNTS_TTL = ttl
+                task._host_weights[:] = [0, [], []]
+                start = time.time()
+                for _ in range(args.picks):
+                    pick(redis_conn)
+                elapsed = time.time() - start
+                results.append({
+                    'method': method,
+                    'hosts': num_hosts,
+                    'picks_per_sec': args.picks / elapsed,
+                    'ms_per_pick': elapsed / args.picks * 1000.0,
+                })
+        finally:
+            clean(redis_conn, addresses)
+    write_results('host_selection', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--picks', type=int, default=2000, help='hosts picked for each method and host count')
+    parser.add_argument('--output', help='write the json results to this file')
+    run_benchmark(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+A stand-in for a reflector host in the cluster, it accepts every blob it is offered and
+throws the data away. Used by the benchmarks that forward to hosts.
+
+python -m benchmarks.hosts [--interface 127.0.0.1] [--port 5567] [--delay 0] [--pipelined-blobs 0]
+                           [--bandwidth 0] [--failure-rate 0]
+"""
+
+import json
+import random
+import argparse
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, ServerFactory
+
+from prism.protocol.decoder import ReflectorMessageDecoder
+
+
+class StandInHostProtocol(Protocol):
+    def connectionMade(self):
+        self.decoder = ReflectorMessageDecoder()
+        # bytes of the blob being received that are still expected
+        self.receiving = 0
+        self.receiving_sd_blob = False
+        # sizes of the offered blobs to receive, in order
+        self.accepted = deque()
+        self.last_response_at = 0
+        # connections that fail drop after the first offer, part way through a job
+        self.fail = random.random() < self.factory.failure_rate
+
+    def dataReceived(self, data):
+        self.factory.throttle(self.transport, len(data))
+        offset = 0
+        while offset < len(data):
+            if self.receiving:
+                received = min(self.receiving, len(data) - offset)
+                self.receiving -= received
+                offset += received
+                self.factory.bytes_received += received
+                if not self.receiving:
+                    self._respond({'received_sd_blob' if self.receiving_sd_blob else 'received_blob': True})
+                    self.receiving_sd_blob = False
+                    self._receive_next()
+                continue
+            msg, offset = self.decoder.decode(data, offset)
+            if msg is None:
+                break
+            self.handle_message(msg)
+
+    def handle_message(self, msg):
+        if self.fail and ('sd_blob_hash' in msg or 'blob_hash' in msg):
+            self.factory.failed_connections += 1
+            self.transport.abortConnection()
+        elif 'version' in msg:
+            response = {'version': msg['version']}
+            if 'pipelined_blobs' in msg:
+                response['pipelined_blobs'] = min(msg['pipelined_blobs'], self.factory.pipelined_blobs)
+            self._respond(response)
+        elif 'sd_blob_hash' in msg:
+            self.receiving_sd_blob = True
+            self.receiving = msg['sd_blob_size']
+            self._respond({'send_sd_blob': True, 'needed_blobs': []})
+        elif 'blob_hash' in msg:
+            self.accepted.append(msg['blob_size'])
+            self.factory.blobs_received += 1
+            self._respond({'send_blob': True})
+            if not msg.get('offers_following', 0):
+                self._receive_next()
+
+    def _receive_next(self):
+        if self.accepted:
+            self.receiving = self.accepted.popleft()
+
+    def _respond(self, msg):
+        if self.factory.delay:
+            # keep the responses in order
+            respond_at = max(reactor.seconds() + self.factory.delay, self.last_response_at + 0.000001)
+            self.last_response_at = respond_at
+            reactor.callLater(respond_at - reactor.seconds(), self.transport.write, json.dumps(msg))
+        else:
+            self.transport.write(json.dumps(msg))
+
+
+class StandInHostFactory(ServerFactory):
+    protocol = StandInHostProtocol
+
+    def __init__(self, delay=0, pipelined_blobs=0, bandwidth=0, failure_rate=0):
+        # seconds to wait before each response, to stand in for network latency
+        self.delay = delay
+        # pipelined offers accepted, 0 to behave like a host that doesn't pipeline
+        self.pipelined_blobs = pipelined_blobs
+        # bytes a second received over all connections, 0 for no limit
+        self.bandwidth = bandwidth
+        # share of the connections that are dropped after their first offer
+        self.failure_rate = failure_rate
+        self.blobs_received = 0
+        self.bytes_received = 0
+        self.failed_connections = 0
+        # when the data received so far would have finished arriving at the bandwidth
+        self._busy_until = 0
+
+    def throttle(self, transport, received):
+        # stop reading from a connection until its data would have arrived at
+        # the bandwidth, the sender is slowed down by tcp flow control
+        if not self.bandwidth:
+            return
+        now = reactor.seconds()
+        self._busy_until = max(self._busy_until, now) + float(received) / self.bandwidth
+        if self._busy_until > now:
+            transport.pauseProducing()
+            reactor.callLater(self._busy_until - now, self._resume, transport)
+
+    @staticmethod
+    def _resume(transport):
+        if transport.connected:
+            transport.resumeProducing()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5567)
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before each response')
+    parser.add_argument('--pipelined-blobs', type=int, default=0)
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes a second received, 0 for no limit')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='share of the connections dropped after their first offer')
+    args = parser.parse_args()
+    factory = StandInHostFactory(args.delay, args.pipelined_blobs, args.bandwidth, args.failure_rate)
+    reactor.listenTCP(args.port, factory, interface=args.interface)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
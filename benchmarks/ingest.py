@@ -0,0 +1,242 @@
+"""
+Upload synthetic streams to a PrismServer from concurrent reflector v1 and v2 clients, reports
+blobs/s, MB/s and the server's descriptor and blob decision latencies
+
+python -m benchmarks.ingest [--clients 8] [--streams 50] [--stream-blobs 10] [--blob-size 262144]
+                            [--duplicate-ratio 0.2] [--protocol v1 --protocol v2] [--redis fake]
+                            [--processes 1] [--output results.json]
+
+The server runs in a child process, a fresh one with empty storage for each protocol. v2 clients
+send each stream as an sd blob and its blobs, v1 clients offer the blobs of a stream one at a time
+like a client reflecting single blobs. --duplicate-ratio is the share of the blobs of a stream that
+are copies of blobs in earlier streams, which the server should decline. With --redis pointing at a
+redis server the streams are also enqueued there, use a scratch one. The server's peak memory is
+reported too, run it with --clients 1000 to see the in flight budget at work.
+
+With --processes N the server is started through PrismServerSupervisor with N server processes
+on one listening socket, they have to share a redis server given with --redis. The decision
+latencies are only recorded with one process, and the peak memory is that of the largest one.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import resource
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+from twisted.internet import defer, reactor
+
+from lbrynet.blob.blob_file import BlobFile
+from prism.config import get_settings
+from prism.constants import REFLECTOR_V1, REFLECTOR_V2
+from prism.protocol.factory import PrismClientFactory, PrismStreamClientFactory
+from prism.reactors import raise_open_files_limit
+from benchmarks.connections import wait_for_server
+from benchmarks.utils import run_concurrently, run_reactor, summarize_latencies, write_results
+
+PROTOCOLS = {'v1': REFLECTOR_V1, 'v2': REFLECTOR_V2}
+
+
+class LocalBlobs(object):
+    """The blobs a v1 client reads from, by hash"""
+
+    def __init__(self):
+        self.blobs = {}
+
+    def add(self, blob):
+        self.blobs[blob.blob_hash] = blob
+
+    def get_blob(self, blob_hash, length=None):
+        return defer.succeed(self.blobs[blob_hash])
+
+
+def write_blob(blob_dir, contents):
+    blob_hash = hashlib.sha384(contents).hexdigest()
+    with open(os.path.join(blob_dir, blob_hash), 'wb') as blob_file:
+        blob_file.write(contents)
+    return BlobFile(blob_dir, blob_hash, len(contents))
+
+
+def make_streams(blob_dir, num_streams, stream_blobs, blob_size, duplicate_ratio, seed=0):
+    """
+    Write num_streams streams of stream_blobs random blobs to blob_dir, returns a list
+    of (sd blob, blobs). duplicate_ratio of the blobs are reused from earlier streams
+    """
+    rand = random.Random(seed)
+    written = []
+    streams = []
+    for i in range(num_streams):
+        blobs = []
+        for _ in range(stream_blobs):
+            if written and rand.random() < duplicate_ratio:
+                blob = rand.choice(written)
+                if blob not in blobs:
+                    blobs.append(blob)
+                    continue
+            blobs.append(write_blob(blob_dir, os.urandom(blob_size)))
+        written.extend(blobs)
+        sd_info = {
+            'stream_name': ('ingest-%i' % i).encode('hex'),
+            'blobs': [{'length': b.length, 'blob_num': num, 'blob_hash': b.blob_hash,
+                       'iv': os.urandom(16).encode('hex')} for num, b in enumerate(blobs)],
+            'stream_type': 'lbryfile',
+            'key': os.urandom(16).encode('hex'),
+            'suggested_file_name': ('ingest-%i' % i).encode('hex'),
+            'stream_hash': hashlib.sha384('ingest-%i' % i).hexdigest(),
+        }
+        sd_info['blobs'].append({'length': 0, 'blob_num': len(blobs), 'iv': os.urandom(16).encode('hex')})
+        streams.append((write_blob(blob_dir, json.dumps(sd_info)), blobs))
+    return streams
+
+
+@defer.inlineCallbacks
+def send_stream(port, protocol, local_blobs, sd_blob, blobs, pipelined_blobs):
+    if protocol == 'v2':
+        factory = PrismStreamClientFactory(None, sd_blob, blobs, pipelined_blobs)
+    else:
+        factory = PrismClientFactory(local_blobs, [blob.blob_hash for blob in [sd_blob] + blobs])
+    factory.protocol_version = PROTOCOLS[protocol]
+    reactor.connectTCP('127.0.0.1', port, factory)
+    yield factory.on_connection_lost_d
+    defer.returnValue(factory.p.blob_hashes_sent)
+
+
+@defer.inlineCallbacks
+def run_protocol(args, protocol, streams, local_blobs):
+    samples_path = tempfile.mktemp()
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.ingest', '--serve', '--port', str(args.port),
+                               '--redis', args.redis, '--processes', str(args.processes), '--samples', samples_path])
+    sizes = dict((blob.blob_hash, blob.length) for blob in local_blobs.blobs.values())
+    sent = []
+    pending = list(streams)
+
+    def upload_next():
+        sd_blob, blobs = pending.pop(0)
+        d = send_stream(args.port, protocol, local_blobs, sd_blob, blobs, args.pipelined_blobs)
+        d.addCallback(sent.extend)
+        return d
+
+    try:
+        yield wait_for_server(args.port)
+        elapsed, latencies = yield run_concurrently(args.clients, len(streams), upload_next)
+    finally:
+        server.terminate()
+        server.wait()
+    with open(samples_path) as samples_file:
+        samples = json.load(samples_file)
+    os.remove(samples_path)
+
+    offered = sum(len(blobs) + 1 for _, blobs in streams)
+    sent_bytes = sum(sizes[blob_hash] for blob_hash in sent)
+    defer.returnValue({
+        'protocol': protocol,
+        'processes': args.processes,
+        'clients': args.clients,
+        'streams': len(streams),
+        'stream_blobs': args.stream_blobs,
+        'blob_size': args.blob_size,
+        'duplicate_ratio': args.duplicate_ratio,
+        'blobs_offered': offered,
+        'blobs_sent': len(sent),
+        'elapsed': elapsed,
+        'offers_per_sec': offered / elapsed,
+        'blobs_per_sec': len(sent) / elapsed,
+        'mb_per_sec': sent_bytes / elapsed / 1024 / 1024,
+        'stream_upload': summarize_latencies(latencies),
+        'descriptor_decision': summarize_latencies(samples['descriptor']) if args.processes == 1 else None,
+        'blob_decision': summarize_latencies(samples['blob']) if args.processes == 1 else None,
+        'server_max_rss_mb': samples['max_rss_kb'] / 1024.0,
+    })
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    blob_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        streams = make_streams(blob_dir, args.streams, args.stream_blobs, args.blob_size, args.duplicate_ratio)
+        local_blobs = LocalBlobs()
+        for sd_blob, blobs in streams:
+            for blob in [sd_blob] + blobs:
+                local_blobs.add(blob)
+        for protocol in args.protocol or sorted(PROTOCOLS):
+            result = yield run_protocol(args, protocol, streams, local_blobs)
+            results.append(result)
+    finally:
+        shutil.rmtree(blob_dir)
+    write_results('ingest', results, args.output)
+
+
+def record_samples(histogram, samples):
+    # keep every observation so the percentiles aren't limited to the histogram buckets
+    observe = histogram.observe
+
+    def _observe(value):
+        samples.append(value)
+        observe(value)
+    histogram.observe = _observe
+
+
+def serve(port, redis_address, samples_path, processes=1):
+    from prism.metrics import BLOB_DECISION_LATENCY, DESCRIPTOR_LATENCY
+    from prism.server import PrismServer, PrismServerSupervisor
+    from prism.storage.storage import ClusterStorage
+    db_dir = tempfile.mkdtemp()
+    raise_open_files_limit(get_settings()['max open files'])
+    samples = {'descriptor': [], 'blob': []}
+    record_samples(DESCRIPTOR_LATENCY, samples['descriptor'])
+    record_samples(BLOB_DECISION_LATENCY, samples['blob'])
+
+    def write_samples():
+        # after the server processes have exited, the children's is the largest of them
+        samples['max_rss_kb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        with open(samples_path, 'w') as samples_file:
+            json.dump(samples, samples_file)
+
+    if processes > 1:
+        server = PrismServerSupervisor(processes, port, ClusterStorage(db_dir, redis_address), '127.0.0.1')
+    else:
+        server = PrismServer(port, ClusterStorage(db_dir, redis_address), '127.0.0.1')
+    reactor.callWhenRunning(server.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown', server.stopService)
+    reactor.addSystemEventTrigger('during', 'shutdown', write_samples)
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(db_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client connections')
+    parser.add_argument('--streams', type=int, default=50)
+    parser.add_argument('--stream-blobs', type=int, default=10, help='blobs in each stream')
+    parser.add_argument('--blob-size', type=int, default=262144)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--protocol', action='append', choices=sorted(PROTOCOLS),
+                        help='client protocol to run, may be repeated, default both')
+    parser.add_argument('--pipelined-blobs', type=int, help='offers v2 clients pipeline, default from settings')
+    parser.add_argument('--redis', default='fake', help='redis server for the prism server, default fakeredis')
+    parser.add_argument('--processes', type=int, default=1, help='server processes sharing the listening port')
+    parser.add_argument('--port', type=int, default=5599)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--samples', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='write the json results to this file')
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.port, args.redis, args.samples, args.processes)
+    if args.processes > 1 and args.redis == 'fake':
+        parser.error("--processes needs a redis server the server processes share, see --redis")
+    # each client has a connection and a blob file open
+    raise_open_files_limit(args.clients * 2 + 1024)
+    run_reactor(run_benchmark, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Time get_needed_blobs_for_stream for streams of 10, 100 and 1000 blobs, comparing the
+per-blob round trips it used to make with the batched fallback and the lua script
+
+python -m benchmarks.needed_blobs [--redis localhost] [--iterations 50] [--output results.json]
+"""
+
+import argparse
+import hashlib
+import shutil
+import tempfile
+
+from twisted.internet import defer
+
+from prism.storage.storage import ClusterStorage, get_redis_helper
+from benchmarks.utils import run_concurrently, run_reactor, summarize_latencies, write_results
+
+STREAM_SIZES = (10, 100, 1000)
+
+
+@defer.inlineCallbacks
+def per_blob_needed_blobs(storage, sd_hash):
+    # the algorithm get_needed_blobs_for_stream used before the script
+    missing = []
+    blobs_in_stream = yield storage.db.get_blobs_for_stream(sd_hash)
+    for blob_hash in blobs_in_stream:
+        in_cluster = yield storage.db.blob_has_been_forwarded_to_host(blob_hash)
+        if not in_cluster:
+            exists = yield storage.db.blob_exists(blob_hash)
+            if not exists:
+                missing.append(blob_hash)
+    defer.returnValue(missing)
+
+
+@defer.inlineCallbacks
+def seed_stream(storage, num_blobs):
+    # a third of the blobs are in the cluster, a third are local and a third missing
+    sd_hash = hashlib.sha384('stream-%i' % num_blobs).hexdigest()
+    blob_hashes = [hashlib.sha384('%i-%i' % (num_blobs, i)).hexdigest() for i in range(num_blobs)]
+    yield storage.db.add_sd_blob(sd_hash, blob_hashes)
+    for i, blob_hash in enumerate(blob_hashes):
+        if i % 3 != 2:
+            yield storage.db.set_blob(blob_hash, 2097152, 0)
+    yield storage.db.add_blobs_to_host(blob_hashes[::3], 'benchmark-host')
+    defer.returnValue(sd_hash)
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    db_dir = tempfile.mkdtemp()
+    storage = ClusterStorage(db_dir, args.redis)
+    storage.db = get_redis_helper(args.redis, args.client)
+    methods = {
+        'per_blob': lambda sd_hash: per_blob_needed_blobs(storage, sd_hash),
+        'script': storage.get_needed_blobs_for_stream,
+        'batch': storage.get_needed_blobs_for_stream,
+    }
+    results = []
+    try:
+        for num_blobs in STREAM_SIZES:
+            sd_hash = yield seed_stream(storage, num_blobs)
+            for method in ('per_blob', 'batch', 'script'):
+                storage.db.scripting = method == 'script'
+                elapsed, latencies = yield run_concurrently(
+                    1, args.iterations, lambda: methods[method](sd_hash))
+                result = summarize_latencies(latencies)
+                result.update({'method': method, 'stream_blobs': num_blobs})
+                results.append(result)
+    finally:
+        shutil.rmtree(db_dir)
+    write_results('needed_blobs', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--client', default='thread', choices=('thread', 'reactor'))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Send streams to a stand-in reflector host that delays each response, waiting for the response
+to each offer and blob and with pipelined offers
+
+python -m benchmarks.pipelining [--blobs 50] [--blob-size 65536] [--output results.json]
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from twisted.internet import defer, reactor
+
+from lbrynet.blob.blob_file import BlobFile
+from prism.protocol.factory import PrismStreamClientFactory
+from benchmarks.hosts import StandInHostFactory
+from benchmarks.utils import run_reactor, write_results
+
+DELAYS = (0, 0.005, 0.025)
+WINDOWS = (0, 4, 16)
+
+
+def make_blobs(db_dir, num_blobs, blob_size):
+    blobs = []
+    for i in range(num_blobs + 1):
+        blob_hash = hashlib.sha384('pipelining-%i' % i).hexdigest()
+        with open(os.path.join(db_dir, blob_hash), 'wb') as blob_file:
+            blob_file.truncate(blob_size)
+        blobs.append(BlobFile(db_dir, blob_hash, blob_size))
+    return blobs[0], blobs[1:]
+
+
+@defer.inlineCallbacks
+def send_stream(port, sd_blob, blobs, window):
+    factory = PrismStreamClientFactory(None, sd_blob, blobs, window)
+    reactor.connectTCP('127.0.0.1', port, factory)
+    yield factory.on_connection_lost_d
+    defer.returnValue(factory.p)
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    db_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        sd_blob, blobs = make_blobs(db_dir, args.blobs, args.blob_size)
+        for delay in DELAYS:
+            host_factory = StandInHostFactory(delay, max(WINDOWS))
+            listening = reactor.listenTCP(0, host_factory, interface='127.0.0.1')
+            port = listening.getHost().port
+            try:
+                for window in WINDOWS:
+                    start = time.time()
+                    for _ in range(args.streams):
+                        client = yield send_stream(port, sd_blob, blobs, window)
+                        assert len(client.blob_hashes_sent) == len(blobs) + 1
+                    elapsed = time.time() - start
+                    results.append({
+                        'delay_ms': delay * 1000,
+                        'pipelined_blobs': window,
+                        'stream_blobs': args.blobs,
+                        'streams_per_sec': args.streams / elapsed,
+                        'mb_per_sec': args.streams * (args.blobs + 1) * args.blob_size / elapsed / 1024 / 1024,
+                    })
+            finally:
+                yield listening.stopListening()
+    finally:
+        shutil.rmtree(db_dir)
+    write_results('pipelining', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--blobs', type=int, default=50, help='blobs in each stream')
+    parser.add_argument('--blob-size', type=int, default=65536)
+    parser.add_argument('--streams', type=int, default=5, help='streams sent for each setting')
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Compare the threadpool RedisHelper with the reactor RESP client on a local redis-server,
+reports ops/sec and p99 latency at 1, 100 and 1000 concurrent callers
+
+python -m benchmarks.redis_helpers [--redis localhost] [--ops 20000] [--flush] [--output results.json]
+
+The keys are seeded in the default database of --redis, which has to be empty or flushed with
+--flush, and it is flushed again afterwards. Point it at a scratch redis-server, never a production one.
+"""
+
+import argparse
+import hashlib
+import itertools
+
+from redis import Redis
+from twisted.internet import defer
+
+from prism.storage.storage import BLOB_HASHES, CLUSTER_BLOBS, get_redis_helper
+from benchmarks.utils import run_concurrently, run_reactor, summarize_latencies, write_results
+
+CONCURRENCY = (1, 100, 1000)
+NUM_KEYS = 10000
+
+
+def seed(db):
+    pipe = db.pipeline(transaction=False)
+    blob_hashes = []
+    for i in range(NUM_KEYS):
+        blob_hash = hashlib.sha384(str(i)).hexdigest()
+        blob_hashes.append(blob_hash)
+        pipe.hset(BLOB_HASHES, blob_hash, '[2097152, 0, ""]')
+        if i % 2:
+            pipe.sadd(CLUSTER_BLOBS, blob_hash)
+    pipe.execute()
+    return blob_hashes
+
+
+@defer.inlineCallbacks
+def run_client(args, client, blob_hashes, results):
+    helper = get_redis_helper(args.redis, client)
+    keys = itertools.cycle(blob_hashes)
+
+    def op():
+        blob_hash = next(keys)
+        if ord(blob_hash[-1]) % 2:
+            return helper.hget(BLOB_HASHES, blob_hash)
+        return helper.sismember(CLUSTER_BLOBS, blob_hash)
+
+    # warm up the threadpool / connection pool
+    yield run_concurrently(10, 100, op)
+    for concurrency in CONCURRENCY:
+        elapsed, latencies = yield run_concurrently(concurrency, args.ops, op)
+        result = summarize_latencies(latencies)
+        result.update({
+            'client': client,
+            'concurrency': concurrency,
+            'ops_per_sec': len(latencies) / elapsed,
+        })
+        results.append(result)
+    if client == 'reactor':
+        helper.pool.disconnect()
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    db = Redis(args.redis)
+    if args.flush:
+        db.flushdb()
+    elif db.dbsize():
+        raise Exception("redis is not empty, use a scratch redis-server or --flush")
+    results = []
+    try:
+        blob_hashes = seed(db)
+        for client in ('thread', 'reactor'):
+            yield run_client(args, client, blob_hashes, results)
+    finally:
+        db.flushdb()
+    write_results('redis_helpers', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--ops', type=int, default=20000, help='operations per concurrency level')
+    parser.add_argument('--flush', action='store_true', help='flush the redis database first if it is not empty')
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
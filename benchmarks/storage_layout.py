@@ -0,0 +1,100 @@
+"""
+Compare the hex and raw storage layouts on a synthetic dataset, reports redis memory
+per million blobs and the latency of checking a stream for missing blobs
+
+python -m benchmarks.storage_layout [--redis localhost] [--db 15] [--blobs 10000000] [--output results.json]
+"""
+
+import time
+import random
+import hashlib
+import argparse
+
+from redis import Redis
+
+from prism.storage.storage import BLOB_HASHES, CLUSTER_BLOBS, SD_BLOB_HASHES, RedisHelper
+from benchmarks.utils import summarize_latencies, write_results
+
+PAGE_SIZE = 10000
+HOST = 'jack.lbry.tech'
+
+
+def seed(db, helper, num_blobs, stream_size):
+    # streams of stream_size blobs, every other stream is on a host
+    record = helper._encode_blob(2097152, time.time(), '')
+    sd_hashes = []
+    pipe = db.pipeline(transaction=False)
+    for i in range(0, num_blobs, stream_size):
+        sd_hash = hashlib.sha384('stream-%i' % i).hexdigest()
+        members = [helper.encode_hash(hashlib.sha384(str(j)).hexdigest())
+                   for j in range(i, min(i + stream_size, num_blobs))]
+        sd_hashes.append(sd_hash)
+        pipe.sadd(sd_hash, *members)
+        pipe.sadd(SD_BLOB_HASHES, helper.encode_hash(sd_hash))
+        pipe.hmset(BLOB_HASHES, dict((member, record) for member in members))
+        if len(sd_hashes) % 2:
+            pipe.sadd(CLUSTER_BLOBS, *members)
+            pipe.sadd(HOST, *members)
+        if len(pipe) >= PAGE_SIZE:
+            pipe.execute()
+    pipe.execute()
+    return sd_hashes
+
+
+def find_missing(db, helper, sd_hash):
+    # the commands of RedisHelper.find_missing_blobs without the script
+    blob_hashes = helper.decode_hashes(db.smembers(sd_hash))
+    pipe = db.pipeline(transaction=False)
+    for member in helper.encode_hashes(blob_hashes):
+        pipe.sismember(CLUSTER_BLOBS, member)
+        pipe.hexists(BLOB_HASHES, member)
+    results = pipe.execute()
+    return [blob_hash for i, blob_hash in enumerate(blob_hashes) if not results[2 * i]]
+
+
+def run_benchmark(args):
+    db = Redis(args.redis, db=args.db)
+    results = []
+    for layout in ('hex', 'raw'):
+        helper = RedisHelper(args.redis, layout)
+        db.flushdb()
+        before = db.info('memory')['used_memory']
+        sd_hashes = seed(db, helper, args.blobs, args.stream_size)
+        used = db.info('memory')['used_memory'] - before
+        sample = random.sample(sd_hashes, min(args.lookups, len(sd_hashes)))
+        compact = sum(1 for sd_hash in sample if db.object('encoding', sd_hash) in ('intset', 'listpack', 'ziplist'))
+        latencies = []
+        for sd_hash in sample:
+            start = time.time()
+            find_missing(db, helper, sd_hash)
+            latencies.append(time.time() - start)
+        result = summarize_latencies(latencies)
+        result.update({
+            'layout': layout,
+            'blobs': args.blobs,
+            'redis_bytes_per_million_blobs': used * 1000000.0 / args.blobs,
+            'compact_stream_sets': compact / float(len(sample)),
+        })
+        results.append(result)
+    db.flushdb()
+    results.append({
+        'layout': 'saved',
+        'redis_bytes_per_million_blobs': results[0]['redis_bytes_per_million_blobs'] -
+                                         results[1]['redis_bytes_per_million_blobs'],
+    })
+    write_results('storage_layout', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--db', type=int, default=15, help='redis database to use, it is flushed')
+    parser.add_argument('--blobs', type=int, default=10000000)
+    parser.add_argument('--stream-size', type=int, default=64, help='blobs in each stream')
+    parser.add_argument('--lookups', type=int, default=10000, help='streams checked for missing blobs')
+    parser.add_argument('--output', help='write the json results to this file')
+    run_benchmark(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Time the hot ClusterStorage and RedisHelper calls on a redis seeded at production scale, reports
+the latency of each call with the round trips it makes and the redis commands they run
+
+python -m benchmarks.storage_ops [--redis localhost] [--blobs 1000000] [--streams 100000] [--flush]
+                                 [--output results.json]
+
+Every other stream is on one of --hosts hosts, the rest are only on this server. The seeded
+data goes in the default database of --redis, which has to be empty or flushed with --flush.
+Point it at a scratch redis-server, never a production one.
+"""
+
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from redis import Redis
+from twisted.internet import defer
+
+from prism.storage.storage import BLOB_HASHES, CLUSTER_BLOBS, HOST_BLOB_COUNTS, SD_BLOB_HASHES
+from prism.storage.storage import ClusterStorage, get_redis_helper
+from benchmarks.utils import run_concurrently, run_reactor, summarize_latencies, write_results
+
+PAGE_SIZE = 10000
+BLOB_SIZE = 2097152
+
+
+def blob_hash_for(i):
+    return hashlib.sha384('blob-%i' % i).hexdigest()
+
+
+def sd_hash_for(i):
+    return hashlib.sha384('stream-%i' % i).hexdigest()
+
+
+def host_for(i, hosts):
+    # every other stream is on a host
+    return hosts[(i // 2) % len(hosts)] if i % 2 else ''
+
+
+def seed(db, helper, num_blobs, num_streams, hosts):
+    stream_size = num_blobs // num_streams
+    host_counts = dict((host, 0) for host in hosts)
+    timestamp = time.time()
+    pipe = db.pipeline(transaction=False)
+    for i in range(num_streams):
+        host = host_for(i, hosts)
+        sd_member = helper.encode_hash(sd_hash_for(i))
+        members = [helper.encode_hash(blob_hash_for(j)) for j in range(i * stream_size, (i + 1) * stream_size)]
+        record = helper._encode_blob(BLOB_SIZE, timestamp, host)
+        pipe.sadd(sd_hash_for(i), *members)
+        pipe.sadd(SD_BLOB_HASHES, sd_member)
+        pipe.hmset(BLOB_HASHES, dict((member, record) for member in [sd_member] + members))
+        if host:
+            pipe.sadd(CLUSTER_BLOBS, sd_member, *members)
+            pipe.sadd(host, sd_member, *members)
+            host_counts[host] += len(members) + 1
+        if len(pipe) >= PAGE_SIZE:
+            pipe.execute()
+    pipe.hmset(HOST_BLOB_COUNTS, host_counts)
+    pipe.execute()
+    return stream_size
+
+
+def command_count(db):
+    return sum(stats['calls'] for name, stats in db.info('commandstats').items())
+
+
+@defer.inlineCallbacks
+def time_op(db, helper, name, iterations, op):
+    helper.call_counter = [0]
+    commands = command_count(db)
+    elapsed, latencies = yield run_concurrently(1, iterations, op)
+    # the INFO that read the first count is counted in the second
+    commands = command_count(db) - commands - 1
+    result = summarize_latencies(latencies)
+    result.update({
+        'op': name,
+        'ops_per_sec': len(latencies) / elapsed,
+        'round_trips_per_op': helper.call_counter[0] / float(iterations),
+        'redis_commands_per_op': commands / float(iterations),
+    })
+    helper.call_counter = None
+    defer.returnValue(result)
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    db = Redis(args.redis)
+    if args.flush:
+        db.flushdb()
+    elif db.dbsize():
+        raise Exception("redis is not empty, use a scratch redis-server or --flush")
+    db_dir = tempfile.mkdtemp()
+    storage = ClusterStorage(db_dir, args.redis)
+    storage.db = helper = get_redis_helper(args.redis, args.client)
+    hosts = ['host%i.lbry.tech' % i for i in range(args.hosts)]
+    rand = random.Random(0)
+    results = []
+    try:
+        for host in hosts:
+            yield helper.get_host_id(host)
+        stream_size = seed(db, helper, args.blobs, args.streams, hosts)
+        num_blobs = stream_size * args.streams
+
+        def random_blob():
+            return blob_hash_for(rand.randrange(num_blobs))
+
+        def random_stream():
+            return sd_hash_for(rand.randrange(args.streams))
+
+        # unforwarded streams, their blobs are added to a host one at a time
+        local_blobs = (blob_hash_for(j) for i in range(0, args.streams, 2)
+                       for j in range(i * stream_size, (i + 1) * stream_size))
+        ops = [
+            ('blob_exists', args.iterations, lambda: storage.blob_exists(random_blob())),
+            ('blob_has_been_forwarded_to_host', args.iterations,
+             lambda: storage.blob_has_been_forwarded_to_host(random_blob())),
+            ('get_blobs_for_stream', args.iterations, lambda: storage.get_blobs_for_stream(random_stream())),
+            ('get_needed_blobs_for_stream', args.iterations,
+             lambda: storage.get_needed_blobs_for_stream(random_stream())),
+            ('get_all_unforwarded_sd_blobs', args.scan_iterations, storage.get_all_unforwarded_sd_blobs),
+            ('get_host_stream_count', args.scan_iterations,
+             lambda: helper.get_host_stream_count(rand.choice(hosts))),
+            ('add_blob_to_host', args.iterations, lambda: storage.add_blob_to_host(next(local_blobs), hosts[0])),
+        ]
+        for name, iterations, op in ops:
+            result = yield time_op(db, helper, name, iterations, op)
+            result.update({'blobs': num_blobs, 'streams': args.streams, 'client': args.client})
+            results.append(result)
+    finally:
+        shutil.rmtree(db_dir)
+        db.flushdb()
+    write_results('storage_ops', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--redis', default='localhost', help='redis address, must not be a production server')
+    parser.add_argument('--client', default='thread', choices=('thread', 'reactor'))
+    parser.add_argument('--blobs', type=int, default=1000000)
+    parser.add_argument('--streams', type=int, default=100000)
+    parser.add_argument('--hosts', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=1000, help='calls timed for each operation')
+    parser.add_argument('--scan-iterations', type=int, default=10,
+                        help='calls timed for the operations that read whole sets')
+    parser.add_argument('--flush', action='store_true', help='flush the redis database first if it is not empty')
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Send streams of large blobs to a local stand-in reflector host with FileSender, the large
+buffer producer and sendfile, and compare MB sent per second and per cpu second of the
+sending process
+
+python -m benchmarks.transfer [--streams 10] [--blobs 20] [--blob-size 2097152] [--output results.json]
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from twisted.internet import defer, reactor, task
+from twisted.protocols.basic import FileSender
+
+from prism.config import get_settings
+from prism.protocol import sender, stream_client
+from benchmarks.pipelining import make_blobs, send_stream
+from benchmarks.utils import run_reactor, write_results
+
+settings = get_settings()
+MODES = ('filesender', 'buffer', 'sendfile')
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def run_mode(args, mode, sd_blob, blobs):
+    stream_client.BlobSender = FileSender if mode == 'filesender' else sender.BlobSender
+    settings['sendfile'] = mode == 'sendfile'
+    cpu_start = cpu_time()
+    start = time.time()
+    for _ in range(args.streams):
+        client = yield send_stream(args.port, sd_blob, blobs, 0)
+        assert len(client.blob_hashes_sent) == len(blobs) + 1
+    elapsed = time.time() - start
+    cpu_used = cpu_time() - cpu_start
+    sent_mb = args.streams * (len(blobs) + 1) * args.blob_size / 1024.0 / 1024.0
+    defer.returnValue({
+        'mode': mode,
+        'blob_size': args.blob_size,
+        'mb_per_sec': sent_mb / elapsed,
+        'mb_per_cpu_sec': sent_mb / cpu_used if cpu_used else None,
+    })
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    if sender.sendfile is None:
+        raise Exception("sendfile isn't available on this platform")
+    host = subprocess.Popen([sys.executable, '-m', 'benchmarks.hosts', '--port', str(args.port)])
+    db_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        yield task.deferLater(reactor, 1, lambda: None)
+        sd_blob, blobs = make_blobs(db_dir, args.blobs, args.blob_size)
+        for mode in MODES:
+            result = yield run_mode(args, mode, sd_blob, blobs)
+            results.append(result)
+    finally:
+        stream_client.BlobSender = sender.BlobSender
+        shutil.rmtree(db_dir)
+        host.terminate()
+        host.wait()
+    write_results('transfer', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--streams', type=int, default=10)
+    parser.add_argument('--blobs', type=int, default=20, help='blobs in each stream')
+    parser.add_argument('--blob-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--port', type=int, default=5567)
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
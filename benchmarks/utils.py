@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import hashlib
+
+from twisted.internet import defer
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((pct / 100.0) * (len(values) - 1)))
+    return values[index]
+
+
+def summarize_latencies(latencies):
+    # latencies are in seconds, the summary is in milliseconds
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000.0,
+        'p99_ms': percentile(latencies, 99) * 1000.0,
+        'max_ms': (max(latencies) if latencies else 0.0) * 1000.0,
+    }
+
+
+def write_results(name, results, path=None):
+    out = json.dumps({'benchmark': name, 'time': time.time(), 'results': results},
+                     indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out + '\n')
+
+
+@defer.inlineCallbacks
+def run_concurrently(concurrency, total_ops, op):
+    """
+    Run total_ops calls of op, a function returning a deferred, from concurrency
+    callers at once. Returns (elapsed seconds, list of per call latencies)
+    """
+    latencies = []
+    remaining = [total_ops]
+
+    @defer.inlineCallbacks
+    def caller():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.time()
+            yield op()
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield defer.DeferredList([caller() for _ in range(concurrency)], fireOnOneErrback=True)
+    defer.returnValue((time.time() - start, latencies))
+
+
+def run_reactor(fn, *args):
+    """Run fn, which returns a deferred, on the reactor and stop it when it finishes"""
+    from twisted.internet import reactor
+    result = []
+
+    def _stop(r):
+        result.append(r)
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: defer.maybeDeferred(fn, *args).addBoth(_stop))
+    reactor.run()
+    if result and hasattr(result[0], 'raiseException'):
+        result[0].raiseException()
+    return result[0] if result else None
+
+
+@defer.inlineCallbacks
+def seed_stream(storage, name, num_blobs, blob_size):
+    """
+    Record a stream of num_blobs blobs as received and verified by storage, the
+    blob files are created with blob_size zero bytes. Returns the sd hash
+    """
+    sd_hash = hashlib.sha384('stream-%s' % name).hexdigest()
+    blob_hashes = [hashlib.sha384('%s-%i' % (name, i)).hexdigest() for i in range(num_blobs)]
+    yield storage.db.add_sd_blob(sd_hash, blob_hashes)
+    for blob_hash in [sd_hash] + blob_hashes:
+        blob = yield storage.get_blob(blob_hash, blob_size)
+        blob_path = blob.file_path
+        with open(blob_path, 'wb') as blob_file:
+            blob_file.truncate(blob_size)
+        st = os.stat(blob_path)
+        yield storage.completed(blob_hash, blob_size, st.st_mtime, st.st_ino)
+    defer.returnValue(sd_hash)
@@ -0,0 +1,119 @@
+"""
+Forward streams to a local stand-in reflector host with a forking rq worker, a reactor
+worker and a reactor worker reusing pooled host connections, and compare streams forwarded
+per second and per cpu second
+
+python -m benchmarks.worker [--streams 200] [--blobs 4] [--max-in-flight 32] [--output results.json]
+
+Jobs go through the configured redis server and the "default" queue, which must be
+empty. Point the settings at a local redis-server, never a production one.
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from twisted.internet import defer, reactor, task
+
+from prism.config import get_settings
+from prism.protocol.factory import build_prism_stream_client_factory
+from prism.protocol.task import enqueue_stream
+from prism.storage.storage import ClusterStorage, get_redis_connection
+from benchmarks.utils import run_reactor, seed_stream, write_results
+
+settings = get_settings()
+# benchmark mode: prism-worker --mode
+WORKER_MODES = {
+    'fork': 'fork',
+    'reactor': 'reactor',
+    'pooled': 'reactor',
+}
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def wait_for_exit(process):
+    while process.poll() is None:
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    defer.returnValue(process.returncode)
+
+
+@defer.inlineCallbacks
+def run_mode(args, mode, redis_address):
+    db_dir = tempfile.mkdtemp()
+    storage = ClusterStorage(db_dir, redis_address)
+    try:
+        sd_hashes = []
+        for i in range(args.streams):
+            sd_hash = yield seed_stream(storage, '%s-%i' % (mode, i), args.blobs, args.blob_size)
+            sd_hashes.append(sd_hash)
+        for sd_hash in sd_hashes:
+            enqueue_stream(sd_hash, args.blobs, db_dir, build_prism_stream_client_factory, redis_address,
+                           host_infos=('127.0.0.1', args.port, 0))
+
+        cpu_start = children_cpu_time()
+        start = time.time()
+        worker = subprocess.Popen([sys.executable, '-m', 'prism.worker', '--burst', '--mode', WORKER_MODES[mode],
+                                   '--max-in-flight', str(args.max_in_flight),
+                                   '--host-connections', str(args.host_connections if mode == 'pooled' else 0)])
+        yield wait_for_exit(worker)
+        elapsed = time.time() - start
+        cpu_time = children_cpu_time() - cpu_start
+
+        forwarded = 0
+        for sd_hash in sd_hashes:
+            in_cluster = yield storage.blob_has_been_forwarded_to_host(sd_hash)
+            forwarded += int(bool(in_cluster))
+    finally:
+        shutil.rmtree(db_dir)
+    defer.returnValue({
+        'mode': mode,
+        'streams': args.streams,
+        'forwarded': forwarded,
+        'streams_per_sec': forwarded / elapsed,
+        'streams_per_cpu_sec': forwarded / cpu_time if cpu_time else None,
+    })
+
+
+@defer.inlineCallbacks
+def run_benchmark(args):
+    redis_address = settings['redis server']
+    if get_redis_connection(redis_address).llen('rq:queue:default'):
+        raise Exception("the default queue is not empty")
+    host = subprocess.Popen([sys.executable, '-m', 'benchmarks.hosts', '--port', str(args.port),
+                             '--delay', str(args.delay)])
+    results = []
+    try:
+        for mode in ('fork', 'reactor', 'pooled'):
+            result = yield run_mode(args, mode, redis_address)
+            results.append(result)
+    finally:
+        host.terminate()
+        host.wait()
+    write_results('worker', results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--blobs', type=int, default=4, help='blobs in each stream')
+    parser.add_argument('--blob-size', type=int, default=65536)
+    parser.add_argument('--max-in-flight', type=int, default=32, help='jobs in flight for the reactor worker')
+    parser.add_argument('--host-connections', type=int, default=8, help='pooled connections to the host')
+    parser.add_argument('--delay', type=float, default=0.005,
+                        help='seconds the stand-in host waits before each response')
+    parser.add_argument('--port', type=int, default=5567)
+    parser.add_argument('--output', help='write the json results to this file')
+    run_reactor(run_benchmark, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
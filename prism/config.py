@@ -36,33 +36,168 @@ def get_settings():
     HOSTS = "hosts"
     MAX_BLOBS_PER_HOST = "max blobs"
     BLOB_DIR = "blob directory"
+    BLOB_DIR_LEVELS = "blob directory levels"
+    BLOB_DIR_FALLBACK = "blob directory fallback"
     LISTEN_ON = "listen"
+    SERVER_PROCESSES = "server processes"
+    IN_FLIGHT_BYTES = "in flight bytes"
+    CONNECTION_BUFFER_BYTES = "connection buffer bytes"
     WORKERS = "workers"
     REDIS_SERVER = "redis server"
+    REDIS_CLIENT = "redis client"
+    REDIS_CONNECTIONS = "redis connections"
+    REDIS_CONNECT_TIMEOUT = "redis connect timeout"
+    STORAGE_LAYOUT = "storage layout"
     ENQUEUE_ON_STARTUP = "enqueue on startup"
     VERBOSE = "verbose"
+    REACTOR = "reactor"
+    MAX_OPEN_FILES = "max open files"
+    VERIFICATION_CACHE_SIZE = "verification cache size"
+    WORKER_MODE = "worker mode"
+    WORKER_MAX_IN_FLIGHT = "worker max in flight"
+    HOST_CONNECTIONS = "host connections"
+    HOST_IDLE_TIMEOUT = "host idle timeout"
+    PIPELINED_BLOBS = "pipelined blobs"
+    SENDFILE = "sendfile"
+    HOST_COUNTS_TTL = "host counts ttl"
+    PLACEMENT = "placement"
+    HOST_WEIGHTS = "host weights"
+    VIRTUAL_NODES = "virtual nodes"
+    STREAM_LOCK_LEASE = "stream lock lease"
+    RECOVERY_RATE = "recovery rate"
+    STATS_INTERVAL = "stats interval"
+    METRICS_LISTEN = "metrics listen"
+    METRICS_PORT = "metrics port"
+    WORKER_METRICS_PORT = "worker metrics port"
+    TRACE_SAMPLE_RATE = "trace sample rate"
+    TRACE_SLOW_REQUEST = "trace slow request"
+    TRACE_LOG = "trace log"
 
     settings_types = {
         LISTEN_ON: str,
+        SERVER_PROCESSES: int,
+        IN_FLIGHT_BYTES: int,
+        CONNECTION_BUFFER_BYTES: int,
         HOSTS: list,
         MAX_BLOBS_PER_HOST: int,
         BLOB_DIR: str,
+        BLOB_DIR_LEVELS: int,
+        BLOB_DIR_FALLBACK: bool,
         WORKERS: int,
         REDIS_SERVER: str,
+        REDIS_CLIENT: str,
+        REDIS_CONNECTIONS: int,
+        REDIS_CONNECT_TIMEOUT: int,
+        STORAGE_LAYOUT: str,
         ENQUEUE_ON_STARTUP: bool,
         VERBOSE: bool,
+        REACTOR: str,
+        MAX_OPEN_FILES: int,
+        VERIFICATION_CACHE_SIZE: int,
+        WORKER_MODE: str,
+        WORKER_MAX_IN_FLIGHT: int,
+        HOST_CONNECTIONS: int,
+        HOST_IDLE_TIMEOUT: int,
+        PIPELINED_BLOBS: int,
+        SENDFILE: bool,
+        HOST_COUNTS_TTL: int,
+        PLACEMENT: str,
+        HOST_WEIGHTS: dict,
+        VIRTUAL_NODES: int,
+        STREAM_LOCK_LEASE: int,
+        RECOVERY_RATE: int,
+        STATS_INTERVAL: int,
+        METRICS_LISTEN: str,
+        METRICS_PORT: int,
+        WORKER_METRICS_PORT: int,
+        TRACE_SAMPLE_RATE: float,
+        TRACE_SLOW_REQUEST: float,
+        TRACE_LOG: str,
     }
 
     default_conf = {
         LISTEN_ON: "localhost",
+        # prism-server processes accepting connections on the listening port, each
+        # with its own reactor and storage. Above 1 a parent process restarts them
+        SERVER_PROCESSES: 1,
+        # bytes of accepted blobs each server process holds before they are written
+        # and recorded, clients wait to be told to send blobs past it. 0 for no limit
+        IN_FLIGHT_BYTES: 268435456,
+        # unhandled bytes buffered from a client connection before it stops being
+        # read from until they are handled, 0 for no limit
+        CONNECTION_BUFFER_BYTES: 4194304,
         HOSTS: [
             "jack.lbry.tech",
         ],
         MAX_BLOBS_PER_HOST: 480000, # assuming 1 terabyte disk / 2 mb blobs
         BLOB_DIR: os.path.expanduser("~/.prism"),
+        # levels of subdirectories named by the leading hex characters of the blob
+        # hash, two puts a blob in "ab/cd/abcd...", 0 keeps all of them in the blob directory
+        BLOB_DIR_LEVELS: 0,
+        # look for blob files missing from their subdirectory in the blob directory
+        # itself, turn it on while scripts/migrate_blob_directory.py moves the files
+        # of a flat layout and off once it's done
+        BLOB_DIR_FALLBACK: False,
         REDIS_SERVER: "localhost",
+        # "thread" sends each command through the reactor threadpool,
+        # "reactor" uses a pool of non-blocking connections on the reactor
+        REDIS_CLIENT: "thread",
+        REDIS_CONNECTIONS: 4,
+        # seconds the reactor client waits to connect to redis or for a connection
+        # to come back before the commands waiting for one fail
+        REDIS_CONNECT_TIMEOUT: 10,
+        # "hex" stores blob hashes in the redis sets and hashes as hex strings,
+        # "raw" as 48 byte digests, change it with scripts/migrate_storage_layout.py
+        STORAGE_LAYOUT: "hex",
         ENQUEUE_ON_STARTUP: True,
         VERBOSE: False,
+        # select, poll, epoll or kqueue, the default is epoll on linux and select elsewhere
+        REACTOR: None,
+        # the soft RLIMIT_NOFILE is raised to this on startup
+        MAX_OPEN_FILES: 65536,
+        # number of verified blob files remembered by each process, 0 disables it
+        VERIFICATION_CACHE_SIZE: 100000,
+        # "fork" runs each job in a forked rq work horse, "reactor" runs many
+        # jobs at once on the worker's reactor
+        WORKER_MODE: "fork",
+        WORKER_MAX_IN_FLIGHT: 32,
+        # connections a reactor worker keeps open to each host and reuses for
+        # the following streams, 0 opens a new connection for every stream
+        HOST_CONNECTIONS: 0,
+        # seconds an unused pooled connection is kept open
+        HOST_IDLE_TIMEOUT: 20,
+        # blob offers sent at once to hosts that support pipelining, 0 waits for
+        # the response to each offer and blob
+        PIPELINED_BLOBS: 0,
+        # send blob files to hosts with sendfile(2) when the connection allows it,
+        # otherwise they are written in large chunks
+        SENDFILE: True,
+        # seconds a worker reuses the blob counts of the hosts when picking one
+        HOST_COUNTS_TTL: 5,
+        # "random" picks a host for each stream weighted by free capacity,
+        # "consistent" places streams on a hash ring of the hosts
+        PLACEMENT: "random",
+        # share of the ring each host gets with consistent placement, 1 if not given
+        HOST_WEIGHTS: {},
+        # points on the ring for each host with a weight of 1
+        VIRTUAL_NODES: 160,
+        # seconds the lock taken to enqueue a stream is held if its holder dies
+        STREAM_LOCK_LEASE: 30,
+        # streams a second enqueued by "enqueue on startup"
+        RECOVERY_RATE: 200,
+        # seconds between the stats snapshots prism-server publishes for
+        # prism-supervisor, 0 turns them off
+        STATS_INTERVAL: 5,
+        # interface and port of the prometheus /metrics endpoint of prism-server,
+        # 0 turns it off. Reactor workers use "worker metrics port"
+        METRICS_LISTEN: "localhost",
+        METRICS_PORT: 0,
+        WORKER_METRICS_PORT: 0,
+        # share of the client connections whose requests are traced, 0 turns it off
+        TRACE_SAMPLE_RATE: 0.0,
+        # seconds a traced request has to take to be written to the trace log
+        TRACE_SLOW_REQUEST: 0.5,
+        TRACE_LOG: "~/prism-trace.log",
     }
 
     settings = {}
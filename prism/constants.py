@@ -1,5 +1,7 @@
 BLOB_HASH_LENGTH = 96
 MAXIMUM_QUERY_SIZE = 200
+# largest blob a client may offer, the size of a full lbry blob
+MAXIMUM_BLOB_SIZE = 2097152
 
 REFLECTOR_V1 = 0
 REFLECTOR_V2 = 1
@@ -14,3 +16,8 @@ BLOB_SIZE = 'blob_size'
 BLOB_HASH = 'blob_hash'
 SD_BLOB_SIZE = 'sd_blob_size'
 SD_BLOB_HASH = 'sd_blob_hash'
+
+# pipelined blob offers, see ReflectorServerProtocol.handle_handshake
+PIPELINED_BLOBS = 'pipelined_blobs'
+OFFERS_FOLLOWING = 'offers_following'
+MAXIMUM_PIPELINED_BLOBS = 32
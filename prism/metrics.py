@@ -0,0 +1,229 @@
+import bisect
+import logging
+
+log = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# content type of the prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+class Metric(object):
+    """
+    A metric with optional labels. Children for label values are made on first
+    use and kept, so recording is a dict lookup and an addition.
+    """
+
+    kind = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._children = {}
+        if not self.label_names:
+            self._children[()] = self._make_child()
+
+    def _make_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *label_values):
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._children[label_values] = self._make_child()
+        return child
+
+    def _samples(self):
+        # yields (suffix, label pairs, value)
+        raise NotImplementedError()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self._samples():
+            lines.append('%s%s %s' % (self.name + suffix, labels, repr(float(value))))
+        return lines
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _make_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+    def _samples(self):
+        for label_values, child in sorted(self._children.items()):
+            yield '', format_labels(self.label_names, label_values), child.value
+
+
+class Gauge(Metric):
+    """Gauge that is set, or read from function when the metrics are rendered"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, label_names=(), function=None):
+        Metric.__init__(self, name, description, label_names)
+        self.function = function
+
+    def _make_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._children[()].value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def _samples(self):
+        if self.function is not None:
+            yield '', '', self.function()
+            return
+        for label_values, child in sorted(self._children.items()):
+            yield '', format_labels(self.label_names, label_values), child.value
+
+
+class _HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, description, label_names)
+
+    def _make_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def _samples(self):
+        for label_values, child in sorted(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '_bucket', format_labels(self.label_names, label_values, [('le', le)]), cumulative
+            labels = format_labels(self.label_names, label_values)
+            yield '_sum', labels, child.sum
+            yield '_count', labels, child.count
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as err:
+                log.warning("Failed to render %s: %s", metric.name, err)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _threadpool_queue_depth():
+    from twisted.internet import reactor
+    return reactor.getThreadPool().q.qsize()
+
+
+# prism-server
+BLOBS_RECEIVED = REGISTRY.register(Counter(
+    'prism_blobs_received_total', 'Blobs received by prism-server by response and result',
+    ('response', 'result')))
+BLOB_BYTES_RECEIVED = REGISTRY.register(Counter(
+    'prism_blob_bytes_received_total', 'Bytes of the blobs received by prism-server by response and result',
+    ('response', 'result')))
+SERVER_CONNECTIONS = REGISTRY.register(Gauge(
+    'prism_server_connections', 'Open reflector client connections'))
+DESCRIPTOR_LATENCY = REGISTRY.register(Histogram(
+    'prism_descriptor_decision_seconds', 'Time to decide which blobs of a stream are needed'))
+BLOB_DECISION_LATENCY = REGISTRY.register(Histogram(
+    'prism_blob_decision_seconds', 'Time to decide if an offered blob is needed'))
+IN_FLIGHT_BYTES = REGISTRY.register(Gauge(
+    'prism_in_flight_bytes', 'Bytes of accepted blobs that have not been written and recorded yet'))
+PAUSED_CONNECTIONS = REGISTRY.register(Gauge(
+    'prism_paused_connections', 'Client connections not being read from by reason, "buffer" or "budget"',
+    ('reason',)))
+CONNECTION_PAUSES = REGISTRY.register(Counter(
+    'prism_connection_pauses_total', 'Times client connections stopped being read from by reason', ('reason',)))
+# shared
+REDIS_LATENCY = REGISTRY.register(Histogram(
+    'prism_redis_command_seconds', 'Latency of redis commands sent by RedisHelper, pipelines as "pipeline"',
+    ('command',)))
+THREADPOOL_QUEUE = REGISTRY.register(Gauge(
+    'prism_threadpool_queue_depth', 'Calls waiting for a reactor threadpool thread',
+    function=_threadpool_queue_depth))
+# workers
+FORWARDED_BLOBS = REGISTRY.register(Counter(
+    'prism_forwarded_blobs_total', 'Blobs forwarded to each cluster host', ('host',)))
+FORWARDED_BYTES = REGISTRY.register(Counter(
+    'prism_forwarded_bytes_total', 'Bytes of the blobs forwarded to each cluster host', ('host',)))
+FORWARDS = REGISTRY.register(Counter(
+    'prism_forwards_total', 'Connections made to forward blobs to each cluster host by result',
+    ('host', 'result')))
+
+
+def listen_metrics(port, interface='localhost', registry=REGISTRY):
+    """Serve registry on http://interface:port/metrics, returns the listening port"""
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('Content-Type', CONTENT_TYPE)
+            return registry.render()
+
+    root = Resource()
+    root.putChild('metrics', MetricsResource())
+    log.info("Serving metrics on http://%s:%i/metrics", interface, port)
+    return reactor.listenTCP(port, Site(root), interface=interface)
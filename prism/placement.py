@@ -0,0 +1,65 @@
+import bisect
+import hashlib
+
+# points each host gets on the ring for a weight of 1
+VIRTUAL_NODES = 160
+
+
+def ring_point(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of cluster hosts, a stream belongs to the host owning the
+    first point on the ring at or after its sd hash. Each host gets virtual_nodes
+    points times its weight, so adding or removing a host only moves the streams
+    between its points and the points before them, about 1/N of the streams.
+    """
+
+    def __init__(self, hosts, virtual_nodes=VIRTUAL_NODES, weights=None):
+        weights = weights or {}
+        points = []
+        for host in hosts:
+            for i in range(int(round(virtual_nodes * weights.get(host, 1)))):
+                points.append((ring_point("%s-%i" % (host, i)), host))
+        points.sort()
+        self._points = [point for point, host in points]
+        self._owners = [host for point, host in points]
+        self.hosts = set(self._owners)
+
+    def iter_hosts(self, key):
+        # hosts in ring order from the position of key, each once
+        if not self._points:
+            return
+        start = bisect.bisect_left(self._points, ring_point(key))
+        seen = set()
+        for i in xrange(len(self._points)):
+            host = self._owners[(start + i) % len(self._points)]
+            if host not in seen:
+                seen.add(host)
+                yield host
+                if len(seen) == len(self.hosts):
+                    return
+
+    def host_for(self, key, full_hosts=()):
+        # hosts in full_hosts are passed over for the next host on the ring,
+        # returns None if every host is full
+        for host in self.iter_hosts(key):
+            if host not in full_hosts:
+                return host
+        return None
+
+
+def plan_moves(placements, ring, full_hosts=()):
+    """
+    Return [(sd_hash, from host, to host)] for the streams in placements, a dict of
+    sd_hash: host the stream is on, that ring places on a different host. Streams
+    already on their host are left where they are.
+    """
+    moves = []
+    for sd_hash, host in sorted(placements.items()):
+        to_host = ring.host_for(sd_hash, full_hosts)
+        if to_host is not None and to_host != host:
+            moves.append((sd_hash, host, to_host))
+    return moves
@@ -0,0 +1,46 @@
+from collections import deque
+
+from twisted.internet import defer
+
+
+class InFlightBudget(object):
+    """
+    Bytes of blob data a server has accepted and not yet written and recorded.
+
+    A blob reserves its length before the client is told to send it, and the
+    reservation is released once the blob is recorded or fails. Reservations
+    that don't fit wait in order, so a burst of uploaders waits for room rather
+    than piling data up in memory. A blob larger than the limit is let in once
+    nothing else is reserved.
+    """
+
+    def __init__(self, limit=0):
+        # 0 for no limit
+        self.limit = limit
+        self.reserved = 0
+        # (length, deferred) waiting for room, in order
+        self._waiting = deque()
+
+    def _fits(self, length):
+        return not self.limit or not self.reserved or self.reserved + length <= self.limit
+
+    def reserve(self, length, force=False):
+        """
+        Returns a deferred that fires once length bytes are reserved, force
+        reserves them right away even over the limit. Cancelling the deferred
+        gives up the place in line.
+        """
+        if force or (not self._waiting and self._fits(length)):
+            self.reserved += length
+            return defer.succeed(length)
+        entry = [length, None]
+        entry[1] = defer.Deferred(lambda d: self._waiting.remove(entry))
+        self._waiting.append(entry)
+        return entry[1]
+
+    def release(self, length):
+        self.reserved -= length
+        while self._waiting and self._fits(self._waiting[0][0]):
+            length, d = self._waiting.popleft()
+            self.reserved += length
+            d.callback(length)
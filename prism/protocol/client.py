@@ -1,20 +1,23 @@
 import json
 import logging
 
-from twisted.protocols.basic import FileSender
 from twisted.internet.protocol import Protocol
 from twisted.internet import defer, error, reactor
-from prism.error import IncompleteResponse
+from prism.protocol.decoder import ReflectorMessageDecoder
+from prism.protocol.sender import BlobSender
 
 
 log = logging.getLogger(__name__)
 
 
 class BlobReflectorClient(Protocol):
+    # set when the client is given a handshaked connection from a ReflectorConnectionPool
+    pooled_connection = None
+
     #  Protocol stuff
 
     def connectionMade(self):
-        self.response_buff = ''
+        self.decoder = ReflectorMessageDecoder()
         self.outgoing_buff = ''
         self.next_blob_to_send = None
         self.blob_read_handle = None
@@ -23,18 +26,21 @@ class BlobReflectorClient(Protocol):
         self.producer = None
         self.streaming = False
         self.sent_blobs = False
-        d = self.send_handshake()
+        if self.pooled_connection is not None:
+            # the pool did the handshake
+            self.received_handshake_response = True
+            d = defer.maybeDeferred(self.send_next_request)
+        else:
+            d = self.send_handshake()
         d.addErrback(lambda err: log.warning("An error occurred immediately: %s", err.getTraceback()))
 
     def dataReceived(self, data):
         log.debug('Received %s', data)
-        self.response_buff += data
-        try:
-            msg = self.parse_response(self.response_buff)
-        except IncompleteResponse:
-            pass
-        else:
-            self.response_buff = ''
+        offset = 0
+        while offset < len(data):
+            msg, offset = self.decoder.decode(data, offset)
+            if msg is None:
+                break
             d = self.handle_response(msg)
             d.addCallback(lambda _: self.send_next_request())
             d.addErrback(self.response_failure_handler)
@@ -67,12 +73,6 @@ class BlobReflectorClient(Protocol):
         self.write(json.dumps({'version': self.protocol_version}))
         return defer.succeed(None)
 
-    def parse_response(self, buff):
-        try:
-            return json.loads(buff)
-        except ValueError:
-            raise IncompleteResponse()
-
     def response_failure_handler(self, err):
         log.warning("An error occurred handling the response: %s", err.getTraceback())
         return self.disconnect(err)
@@ -114,7 +114,7 @@ class BlobReflectorClient(Protocol):
             if 'send_blob' not in response_dict:
                 raise ValueError("I don't know whether to send the blob or not!")
             if response_dict['send_blob'] is True:
-                self.file_sender = FileSender()
+                self.file_sender = BlobSender()
                 return defer.succeed(True)
             else:
                 return self.set_not_uploading()
@@ -146,6 +146,13 @@ class BlobReflectorClient(Protocol):
     def disconnect(self, err):
         self.transport.loseConnection()
 
+    def finish(self):
+        # all the blobs were sent and answered
+        if self.pooled_connection is not None:
+            self.pooled_connection.release()
+        else:
+            self.transport.loseConnection()
+
     @defer.inlineCallbacks
     def send_next_request(self):
         if self.file_sender is not None:
@@ -167,4 +174,4 @@ class BlobReflectorClient(Protocol):
         else:
             # close connection
             log.debug('No more blob hashes, closing connection')
-            self.transport.loseConnection()
+            self.finish()
@@ -0,0 +1,114 @@
+import re
+import json
+
+from prism.error import ReflectorRequestDecodeError
+
+# characters that change the brace depth or string state
+_SPECIAL_CHARS = re.compile(r'[{}"\\]')
+_WHITESPACE = ' \t\r\n'
+_json_decoder = json.JSONDecoder()
+
+
+class ReflectorMessageDecoder(object):
+    """
+    Incremental decoder for the json messages exchanged by reflector peers.
+
+    A message that arrives whole is decoded in one pass of the C json
+    scanner. Otherwise every byte is scanned once, the brace depth and string
+    state are kept across chunks so a message split over many reads is not
+    re-parsed from its start each time. Messages larger than max_size are
+    rejected as soon as the limit is crossed.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._reset()
+
+    def _reset(self):
+        # pieces of the message received so far
+        self._chunks = []
+        self._size = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    @property
+    def buffered(self):
+        return self._size
+
+    def decode(self, data, offset=0):
+        """
+        Scan data from offset. Returns (message, offset) with the decoded message
+        and the position right after it, or (None, len(data)) if the message is
+        not complete yet. Bytes after the message are not consumed, they are
+        either the next message or raw blob data.
+        """
+        end = len(data)
+        pos = offset
+        if not self._size:
+            while pos < end and data[pos] in _WHITESPACE:
+                pos += 1
+            if pos == end:
+                return None, end
+            if data[pos] != '{':
+                raise ReflectorRequestDecodeError("Invalid message start: %r" % data[pos:pos + 16])
+            try:
+                if self.max_size is None:
+                    message, next_pos = _json_decoder.raw_decode(data, pos)
+                else:
+                    window = data[pos:pos + self.max_size]
+                    message, window_end = _json_decoder.raw_decode(window)
+                    next_pos = pos + window_end
+            except ValueError:
+                # incomplete or invalid, scan it
+                pass
+            else:
+                return message, next_pos
+        start = pos
+
+        if self.max_size is None:
+            scan_end = end
+        else:
+            scan_end = min(end, start + self.max_size - self._size)
+
+        if self._escaped and pos < scan_end:
+            # the previous chunk ended with a backslash in a string
+            self._escaped = False
+            pos += 1
+
+        while True:
+            match = _SPECIAL_CHARS.search(data, pos, scan_end)
+            if match is None:
+                if scan_end < end:
+                    raise ReflectorRequestDecodeError("Message exceeds %i bytes" % self.max_size)
+                self._chunks.append(data[start:end])
+                self._size += end - start
+                return None, end
+            i = match.start()
+            char = data[i]
+            pos = i + 1
+            if self._in_string:
+                if char == '"':
+                    self._in_string = False
+                elif char == '\\':
+                    if pos < scan_end:
+                        pos += 1
+                    else:
+                        self._escaped = True
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    break
+
+        self._chunks.append(data[start:pos])
+        raw = ''.join(self._chunks)
+        self._reset()
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            raise ReflectorRequestDecodeError("Error decoding message: %r" % raw)
+        return message, pos
@@ -2,6 +2,7 @@ import logging
 from twisted.internet.protocol import ServerFactory, ClientFactory
 from twisted.internet import defer
 
+from prism.protocol.budget import InFlightBudget
 from prism.protocol.server import ReflectorServerProtocol
 from prism.protocol.client import BlobReflectorClient
 from prism.protocol.stream_client import StreamReflectorClient
@@ -24,6 +25,10 @@ class PrismServerFactory(ServerFactory):
     def __init__(self, storage):
         self.storage = storage
         self.protocol_version = 1
+        # open client connections, kept by the protocols
+        self.connections = 0
+        # bytes of the blobs being received by all of the connections
+        self.in_flight = InFlightBudget(settings['in flight bytes'])
 
     def buildProtocol(self, addr):
         p = self.protocol(self.storage, build_prism_stream_client_factory)
@@ -69,11 +74,14 @@ class PrismClientFactory(ClientFactory):
 class PrismStreamClientFactory(ClientFactory):
     protocol = StreamReflectorClient
 
-    def __init__(self, storage, sd_blob, blobs):
+    def __init__(self, storage, sd_blob, blobs, pipelined_blobs=None):
         self.storage = storage
         self.sd_blob = sd_blob
         self.blobs = blobs
         self.protocol_version = 1
+        if pipelined_blobs is None:
+            pipelined_blobs = settings['pipelined blobs']
+        self.pipelined_blobs = pipelined_blobs
         self.p = None
         #this deferred is fired when this protocol is disconnected
         #(when connectionLost() is called)
@@ -89,6 +97,7 @@ class PrismStreamClientFactory(ClientFactory):
         p.factory = self
         p.addr = addr
         p.protocol_version = self.protocol_version
+        p.pipelined_blobs = self.pipelined_blobs
         self.p = p
         return p
 
@@ -106,40 +115,43 @@ def build_prism_stream_client_factory(sd_hash, blob_storage, host_to_send):
     blob_storage - blob storage class
     host_to_send - host to send to, None if not known yet
     """
-    blob_exists = yield blob_storage.blob_exists(sd_hash)
-    if not blob_exists:
+    blob_hashes, states = yield blob_storage.get_stream_state(sd_hash)
+    sd_length, sd_hash_host, sd_forwarded, sd_verified = states[sd_hash]
+    if sd_length is None:
         raise Exception("blob does not exist in cluster")
 
-    blob_forwarded = yield blob_storage.blob_has_been_forwarded_to_host(sd_hash)
-    sd_blob = yield blob_storage.get_blob(sd_hash)
-    if blob_forwarded:
+    if sd_forwarded:
         # if sd blob has already been forwarded to some other host,
         # raise exception
-        sd_hash_host = yield blob_storage.get_blob_host(sd_hash)
         if host_to_send !=  sd_hash_host:
             raise Exception("sd blob has been forwarded to some other host:%s", sd_hash_host)
     else:
         # if sd blob hasn't been forwarded make sure we have it
-        if not sd_blob.verified:
+        if not sd_verified:
             raise Exception("cannot send unverified sd blob")
 
-    blobs = yield blob_storage.get_blobs_for_stream(sd_hash)
-    for b in blobs:
-        blob_forwarded = yield blob_storage.blob_has_been_forwarded_to_host(b.blob_hash)
+    for blob_hash in blob_hashes:
+        length, blob_host, blob_forwarded, verified = states[blob_hash]
         if blob_forwarded:
             # if blob has been forwarded, make sure its not on some other host
-            blob_host = yield blob_storage.get_blob_host(b.blob_hash)
             if host_to_send != blob_host:
                 raise Exception("blob has been forwarded to some other host:%s", blob_host)
         else:
             # if blob is not forwarded, make sure we have it
-            if not b.verified:
-                raise Exception("blob %s is not verified", b.blob_hash)
+            if not verified:
+                raise Exception("blob %s is not verified", blob_hash)
 
     host_count = yield blob_storage.get_host_count(host_to_send)
-    if host_count + len(blobs)+1 > settings['max blobs']:
+    if host_count + len(blob_hashes)+1 > settings['max blobs']:
         raise Exception("Host %s will exceed max blobs", host_to_send)
 
+    # lengths are known, so these don't go back to redis
+    sd_blob = yield blob_storage.get_blob(sd_hash, sd_length)
+    blobs = []
+    for blob_hash in blob_hashes:
+        blob = yield blob_storage.get_blob(blob_hash, states[blob_hash][0])
+        blobs.append(blob)
+
     defer.returnValue(PrismStreamClientFactory(blob_storage, sd_blob, blobs))
 
 
@@ -0,0 +1,277 @@
+import json
+import errno
+import socket
+import logging
+from collections import deque
+
+from twisted.internet import defer, error, task
+from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.python.failure import Failure
+
+from prism.constants import PIPELINED_BLOBS
+from prism.error import ReflectorClientVersionError
+from prism.protocol.decoder import ReflectorMessageDecoder
+
+log = logging.getLogger(__name__)
+
+
+class PooledReflectorConnection(Protocol):
+    """
+    A reflector connection to a host that is handshaked once and then used by one
+    client at a time. The client is given the transport and the data received,
+    when all of its blobs were sent and answered it releases the connection back
+    to the pool instead of closing it.
+    """
+
+    def __init__(self, pool, host, port):
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.client = None
+        # the factory and PooledConnector of the client, and whether the host has
+        # answered it, a client whose reused connection is closed before that is
+        # started over on a fresh one
+        self.factory = None
+        self.connector = None
+        self.answered = False
+        self.connected = False
+        self.uses = 0
+        # pipelined blob offers agreed with the host
+        self.pipelined_blobs = 0
+        self.last_used = pool.clock.seconds()
+        # fires with this connection once the handshake is done
+        self.handshake_d = defer.Deferred()
+
+    def connectionMade(self):
+        self.connected = True
+        self.decoder = ReflectorMessageDecoder()
+        handshake = {'version': self.pool.protocol_version}
+        if self.pool.pipelined_blobs:
+            handshake[PIPELINED_BLOBS] = self.pool.pipelined_blobs
+        self.transport.write(json.dumps(handshake))
+
+    def dataReceived(self, data):
+        if self.client is not None:
+            self.answered = True
+            self.client.dataReceived(data)
+        elif self.handshake_d.called:
+            # nothing is expected on an idle connection
+            log.warning("Unexpected data from idle connection to %s: %r", self.host, data[:64])
+            self.transport.loseConnection()
+        else:
+            msg, offset = self.decoder.decode(data)
+            if msg is None:
+                return
+            if msg.get('version') != self.pool.protocol_version:
+                self.handshake_d.errback(ReflectorClientVersionError(
+                    "%s responded with version %s" % (self.host, msg.get('version'))))
+                self.transport.loseConnection()
+            else:
+                self.pipelined_blobs = min(self.pool.pipelined_blobs, int(msg.get(PIPELINED_BLOBS, 0)))
+                self.handshake_d.callback(self)
+
+    def connectionLost(self, reason=None):
+        self.connected = False
+        if not self.handshake_d.called:
+            self.handshake_d.errback(reason)
+        client, self.client = self.client, None
+        if client is not None and self.uses > 1 and not self.answered and self.connector is not None:
+            # the host closed the connection while it was idle, nothing of the
+            # client's was answered so it starts over once on a fresh connection
+            log.info("Reused connection to %s:%i was closed, retrying on a new one", self.host, self.port)
+            if hasattr(client, 'setTimeout'):
+                client.setTimeout(None)
+            self.pool._connection_lost(self)
+            self.pool._connect(self.host, self.port, self.factory, self.connector, reuse=False)
+            return
+        if client is not None:
+            try:
+                client.connectionLost(reason)
+            except Exception:
+                # the clients re-raise the reason after handling it
+                pass
+        self.pool._connection_lost(self)
+
+    def peer_closed(self):
+        # the protocol has no ping, this peeks at the socket for a close or reset
+        # of the host the reactor hasn't read yet. Data on an idle connection is
+        # unexpected too
+        try:
+            self.transport.getHandle().recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except socket.error as err:
+            return err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)
+        return True
+
+    def is_healthy(self):
+        idle_time = self.pool.clock.seconds() - self.last_used
+        return self.connected and self.client is None and idle_time < self.pool.idle_timeout and \
+            not self.peer_closed()
+
+    def attach(self, factory, connector=None):
+        client = factory.buildProtocol(self.transport.getPeer())
+        client.pooled_connection = self
+        self.client = client
+        self.factory = factory
+        self.connector = connector
+        self.answered = False
+        self.uses += 1
+        client.makeConnection(self.transport)
+        return client
+
+    def release(self):
+        # called by the client once all of its requests were answered
+        client, self.client = self.client, None
+        self.last_used = self.pool.clock.seconds()
+        self.pool._release(self)
+        client.connectionLost(Failure(error.ConnectionDone()))
+
+    def close(self):
+        if self.connected:
+            self.transport.loseConnection()
+
+
+class PooledConnector(object):
+    """
+    Stands in for the IConnector returned by connectTCP, disconnect() closes the
+    connection if the client it was made for is still using it
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.client = None
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+        if self.connection is not None and self.connection.client is self.client:
+            self.connection.close()
+
+
+class PooledConnectionFactory(ClientFactory):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def buildProtocol(self, addr):
+        return self.connection
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connection.connectionLost(reason)
+
+
+class ReflectorConnectionPool(object):
+    """
+    Handshaked reflector connections to the cluster hosts, reused by the
+    consecutive streams and blobs sent to the same host. At most max_per_host
+    connections are opened to a host, further requests wait for one to be
+    released. Connections idle for idle_timeout seconds are closed.
+    """
+
+    def __init__(self, max_per_host, idle_timeout, connect_timeout=15, protocol_version=1, pipelined_blobs=0,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.protocol_version = protocol_version
+        self.pipelined_blobs = pipelined_blobs
+        # (host, port): idle connections, the most recently used last
+        self._idle = {}
+        # (host, port): number of connections open or being opened
+        self._open = {}
+        # (host, port): deferreds waiting for a connection
+        self._waiting = {}
+        self._evict_loop = task.LoopingCall(self.evict_idle)
+        self._evict_loop.clock = clock
+
+    def start(self):
+        self._evict_loop.start(self.idle_timeout / 2.0, now=False)
+
+    def stop(self):
+        if self._evict_loop.running:
+            self._evict_loop.stop()
+        for connections in self._idle.values():
+            for connection in list(connections):
+                connection.close()
+
+    def open_connections(self, host, port):
+        return self._open.get((host, port), 0)
+
+    def idle_connections(self, host, port):
+        return len(self._idle.get((host, port), []))
+
+    def _open_connection(self, host, port):
+        from twisted.internet import reactor
+        key = (host, port)
+        self._open[key] = self._open.get(key, 0) + 1
+        connection = PooledReflectorConnection(self, host, port)
+        reactor.connectTCP(host, port, PooledConnectionFactory(connection), timeout=self.connect_timeout)
+        return connection.handshake_d
+
+    def acquire(self, host, port, reuse=True):
+        """
+        Returns a deferred that fires with a handshaked connection to host:port
+        that is not in use, a new one unless reuse is True or it has to wait
+        for one to be released
+        """
+        key = (host, port)
+        idle = self._idle.get(key, []) if reuse else []
+        while idle:
+            connection = idle.pop()
+            if connection.is_healthy():
+                return defer.succeed(connection)
+            connection.close()
+        if self._open.get(key, 0) < self.max_per_host:
+            return self._open_connection(host, port)
+        d = defer.Deferred()
+        self._waiting.setdefault(key, deque()).append(d)
+        return d
+
+    def connect(self, host, port, factory):
+        """
+        Attach a client built by factory to a pooled connection to host:port, like
+        connectTCP failures are reported to factory.clientConnectionFailed
+        """
+        connector = PooledConnector()
+        self._connect(host, port, factory, connector)
+        return connector
+
+    def _connect(self, host, port, factory, connector, reuse=True):
+        def _attach(connection):
+            if connector.disconnected:
+                connection.last_used = self.clock.seconds()
+                self._release(connection)
+                return
+            connector.connection = connection
+            connector.client = connection.attach(factory, connector)
+
+        d = self.acquire(host, port, reuse)
+        d.addCallbacks(_attach, lambda err: factory.clientConnectionFailed(connector, err))
+
+    def _release(self, connection):
+        key = (connection.host, connection.port)
+        waiting = self._waiting.get(key)
+        if waiting:
+            waiting.popleft().callback(connection)
+        else:
+            self._idle.setdefault(key, []).append(connection)
+
+    def _connection_lost(self, connection):
+        key = (connection.host, connection.port)
+        idle = self._idle.get(key, [])
+        if connection in idle:
+            idle.remove(connection)
+        self._open[key] -= 1
+        waiting = self._waiting.get(key)
+        if waiting and self._open[key] < self.max_per_host:
+            self._open_connection(connection.host, connection.port).chainDeferred(waiting.popleft())
+
+    def evict_idle(self):
+        for connections in self._idle.values():
+            for connection in list(connections):
+                if not connection.is_healthy():
+                    log.debug("Closing idle connection to %s:%i", connection.host, connection.port)
+                    connections.remove(connection)
+                    connection.close()
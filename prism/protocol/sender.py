@@ -0,0 +1,168 @@
+import os
+import sys
+import errno
+import select
+import logging
+import ctypes
+import ctypes.util
+
+from zope.interface import implementer
+from twisted.internet import defer, threads
+from twisted.internet.interfaces import IPushProducer, ISSLTransport, ITCPTransport
+from twisted.python.failure import Failure
+
+from prism.config import get_settings
+
+log = logging.getLogger(__name__)
+settings = get_settings()
+
+# bytes read from the blob file at a time when sendfile can't be used
+CHUNK_SIZE = 2 ** 18
+# seconds the sendfile thread waits for the socket to be writable before
+# checking if the connection is still open
+POLL_TIMEOUT = 1
+
+
+def _load_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+sendfile = _load_sendfile()
+
+
+def transport_is_idle(transport):
+    # True if nothing is waiting in the transport's write buffer, so bytes
+    # sent directly to its socket are not reordered with bytes written to it
+    try:
+        return not transport._tempDataLen and transport.offset == len(transport.dataBuffer) and \
+               transport.producer is None
+    except AttributeError:
+        return False
+
+
+def can_sendfile(transport, file_handle):
+    if sendfile is None or not settings['sendfile']:
+        return False
+    if not ITCPTransport.providedBy(transport) or ISSLTransport.providedBy(transport):
+        return False
+    if not hasattr(file_handle, 'fileno'):
+        return False
+    return transport_is_idle(transport)
+
+
+def _sendfile_all(transport, out_fd, in_fd, offset, count):
+    # runs in a thread, the socket is non-blocking so wait for it to be
+    # writable when its send buffer is full
+    poller = select.poll()
+    poller.register(out_fd, select.POLLOUT)
+    sent_total = 0
+    while sent_total < count:
+        if transport.disconnected or transport.disconnecting:
+            raise IOError("connection closed after %i of %i bytes" % (sent_total, count))
+        try:
+            sent = sendfile(out_fd, in_fd, offset + sent_total, count - sent_total)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                poller.poll(POLL_TIMEOUT * 1000)
+                continue
+            raise
+        if not sent:
+            raise IOError("blob file ended after %i of %i bytes" % (sent_total, count))
+        sent_total += sent
+    return sent_total
+
+
+@implementer(IPushProducer)
+class BlobSender(object):
+    """
+    Sends a blob file to the transport of a reflector client, a drop in for
+    FileSender.
+
+    If the transport is a plain TCP socket with nothing waiting to be written
+    the file is sent with sendfile(2) from a thread, the blob is never copied
+    into python. Otherwise it's written in CHUNK_SIZE pieces as a streaming
+    producer, so the transport's flow control pauses it instead of a
+    callLater per chunk.
+    """
+
+    def __init__(self):
+        self.deferred = None
+        self.file = None
+        self.transport = None
+        self.paused = False
+        self.used_sendfile = False
+
+    def beginFileTransfer(self, file, consumer):
+        self.file = file
+        self.transport = consumer.transport
+        self.deferred = defer.Deferred()
+        if can_sendfile(self.transport, file):
+            self.used_sendfile = True
+            self._start_sendfile()
+        else:
+            self.transport.registerProducer(self, True)
+            self.resumeProducing()
+        return self.deferred
+
+    def _start_sendfile(self):
+        in_fd = self.file.fileno()
+        offset = self.file.tell()
+        count = os.fstat(in_fd).st_size - offset
+        # the socket is duplicated so its descriptor can't be closed and reused
+        # by the reactor while the thread is sending to it
+        out_fd = os.dup(self.transport.getHandle().fileno())
+
+        def _close(result):
+            os.close(out_fd)
+            return result
+
+        d = threads.deferToThread(_sendfile_all, self.transport, out_fd, in_fd, offset, count)
+        d.addBoth(_close)
+        d.addCallbacks(self._sent, self._failed)
+
+    def _sent(self, sent):
+        self.file.seek(sent, os.SEEK_CUR)
+        self.deferred, d = None, self.deferred
+        d.callback(None)
+
+    def _failed(self, err):
+        log.warning("Failed to send %s: %s", self.file, err.getErrorMessage())
+        self.deferred, d = None, self.deferred
+        d.errback(err)
+
+    def resumeProducing(self):
+        self.paused = False
+        while not self.paused and self.deferred is not None:
+            chunk = self.file.read(CHUNK_SIZE)
+            if not chunk:
+                self.transport.unregisterProducer()
+                self._sent(0)
+                return
+            # the transport pauses us if this fills its buffer
+            self.transport.write(chunk)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        if self.deferred is not None:
+            self.transport.unregisterProducer()
+            self._failed(Failure(IOError("transfer stopped")))
@@ -1,9 +1,11 @@
 import json
 import os
+import time
 import random
 import logging
+from collections import deque
 
-from twisted.internet import defer, error, reactor
+from twisted.internet import defer, error, reactor, threads
 from twisted.internet.protocol import Protocol
 from twisted.internet.error import ConnectionDone
 from twisted.protocols.policies import TimeoutMixin
@@ -12,10 +14,16 @@ from lbrynet.core.utils import is_valid_blobhash
 
 from prism.constants import BLOB_HASH, RECEIVED_BLOB, RECEIVED_SD_BLOB, SEND_BLOB, SEND_SD_BLOB
 from prism.constants import BLOB_SIZE, MAXIMUM_QUERY_SIZE, SD_BLOB_HASH, SD_BLOB_SIZE, VERSION
-from prism.constants import NEEDED_BLOBS, REFLECTOR_V1, REFLECTOR_V2
+from prism.constants import MAXIMUM_BLOB_SIZE, NEEDED_BLOBS, REFLECTOR_V1, REFLECTOR_V2
+from prism.constants import MAXIMUM_PIPELINED_BLOBS, OFFERS_FOLLOWING, PIPELINED_BLOBS
 from prism.error import DownloadCanceledError, InvalidBlobHashError, ReflectorRequestError
 from prism.error import ReflectorClientVersionError
+from prism.metrics import BLOB_BYTES_RECEIVED, BLOB_DECISION_LATENCY, BLOBS_RECEIVED, DESCRIPTOR_LATENCY
+from prism.metrics import CONNECTION_PAUSES, PAUSED_CONNECTIONS
 from prism.protocol.task import enqueue_stream
+from prism.protocol.decoder import ReflectorMessageDecoder
+from prism.storage.verification import stat_key
+from prism.tracing import ConnectionTracer, sample_connection
 from prism.config import get_settings
 
 
@@ -26,6 +34,9 @@ BLOB_DIR = os.path.expandvars(settings['blob directory'])
 SETTINGS = get_settings()
 HOSTS = SETTINGS['hosts']
 NUM_HOSTS = len(HOSTS) - 1
+# a connection isn't read from while more than this many of its bytes wait to be
+# handled, it is read from again once they're down to half of it
+CONNECTION_BUFFER_BYTES = settings['connection buffer bytes']
 
 log = logging.getLogger(__name__)
 
@@ -40,8 +51,15 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
     def connectionMade(self):
         peer_info = self.transport.getPeer()
         log.debug('Connected to %s:%i', peer_info.host, peer_info.port)
+        self.factory.connections += 1
         self.protocol_version = self.factory.protocol_version
         self.peer = peer_info
+        # ConnectionTracer if the requests of this connection are traced, they
+        # use its storage so the redis calls are counted
+        self.tracer = None
+        if sample_connection():
+            self.tracer = ConnectionTracer(self.blob_storage, peer_info.host)
+            self.blob_storage = self.tracer.blob_storage
         self.received_handshake = False
         self.peer_version = None
         # If we received an sd blob, indicating that we are receiving
@@ -51,7 +69,27 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
         self.incoming_blob = None
         self.blob_writer = None
         self.blob_finished_d = None
-        self.request_buff = ""
+        # bytes of the incoming blob that have not been received yet
+        self.blob_bytes_remaining = 0
+        self.decoder = ReflectorMessageDecoder(MAXIMUM_QUERY_SIZE)
+        # requests are handled one at a time, (data, offset) received while a
+        # request or blob is being handled waits here
+        self.pending_data = deque()
+        # bytes in pending_data that haven't been handled
+        self.buffered_bytes = 0
+        # reasons the transport is paused, "buffer" for buffered_bytes and
+        # "budget" while waiting for room in the factory's in flight budget
+        self.paused_for = set()
+        # bytes this connection holds in the in flight budget, and the
+        # reservation it waits for
+        self.reserved_bytes = 0
+        self.reserve_d = None
+        self.handling_request = False
+        self.processing_data = False
+        # number of blob offers the client may send at once, 0 if it doesn't pipeline
+        self.pipelined_blobs = 0
+        # blobs accepted from a group of pipelined offers, received in order
+        self.accepted_blobs = deque()
         # If a stream has been enqueued to be sent to host, set it to
         # True, so it does not somehow get enqueued more than once
         self.enqueued_stream = False
@@ -63,19 +101,92 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
 
     def connectionLost(self, reason=None):
         log.debug("Connection lost to %s: %s", self.peer.host, reason)
+        self.factory.connections -= 1
+        if self.reserve_d is not None:
+            self.reserve_d.cancel()
+        self.release(self.reserved_bytes)
+        for pause_reason in self.paused_for:
+            PAUSED_CONNECTIONS.labels(pause_reason).inc(-1)
+        self.paused_for.clear()
+        self.setTimeout(None)
         if not reason or reason.check(error.ConnectionDone):
-            self.setTimeout(None)
             self.enqueue()
         else:
             log.warning("connection lost: %s", reason)
 
     def handle_error(self, err):
+        if err.check(defer.CancelledError):
+            # the connection was lost while waiting for the in flight budget
+            return
         log.error(err.getTraceback())
         self.transport.loseConnection()
 
     def send_response(self, response_dict):
         self.transport.write(json.dumps(response_dict))
 
+    ################
+    # Flow control #
+    ################
+
+    def pause_reading(self, reason):
+        if reason in self.paused_for:
+            return
+        if not self.paused_for:
+            self.transport.pauseProducing()
+        self.paused_for.add(reason)
+        PAUSED_CONNECTIONS.labels(reason).inc()
+        CONNECTION_PAUSES.labels(reason).inc()
+
+    def resume_reading(self, reason):
+        if reason not in self.paused_for:
+            return
+        self.paused_for.remove(reason)
+        PAUSED_CONNECTIONS.labels(reason).inc(-1)
+        if not self.paused_for:
+            self.transport.resumeProducing()
+
+    @defer.inlineCallbacks
+    def reserve(self, length):
+        """
+        Reserve room for a blob the client is about to be told to send, the
+        connection isn't read from while it waits for room. The rest of a group
+        of pipelined offers is reserved right away, its accepted blobs can't
+        arrive until all of the offers in the group are answered. fits_group
+        keeps what a group reserves that way within the in flight limit.
+        """
+        d = self.factory.in_flight.reserve(length, force=bool(self.accepted_blobs))
+        if not d.called:
+            # the client isn't timed out for waiting on the server
+            self.reserve_d = d
+            self.pause_reading('budget')
+            self.setTimeout(None)
+            try:
+                yield d
+            finally:
+                self.reserve_d = None
+                if self.transport.connected:
+                    self.resume_reading('budget')
+                    self.setTimeout(self.PROTOCOL_TIMEOUT)
+        else:
+            yield d
+        self.reserved_bytes += length
+        if self.tracer is not None:
+            self.tracer.mark('in flight budget')
+
+    def fits_group(self, length):
+        # the offers of a pipelined group after the first are reserved without
+        # waiting, together they may take up to the in flight limit
+        limit = self.factory.in_flight.limit
+        return not self.accepted_blobs or not limit or \
+            sum(blob.length for blob in self.accepted_blobs) + length <= limit
+
+    def release(self, length):
+        # after a blob was recorded or failed, or the connection was lost
+        length = min(length, self.reserved_bytes)
+        if length:
+            self.reserved_bytes -= length
+            self.factory.in_flight.release(length)
+
     ############################
     # Incoming blob file stuff #
     ############################
@@ -91,49 +202,72 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
 
     @defer.inlineCallbacks
     def _on_completed_blob(self, blob, response_key):
-        yield self.blob_storage.completed(blob.blob_hash, blob.length)
+        # the writer checked the hash of the blob as it was received, record
+        # that so the blob isn't checked again before it's forwarded
+        if self.tracer is not None:
+            self.tracer.mark('blob written')
+        BLOBS_RECEIVED.labels(response_key, 'true').inc()
+        BLOB_BYTES_RECEIVED.labels(response_key, 'true').inc(blob.length)
+        size, inode, mtime = stat_key(self.blob_storage.get_blob_path(blob.blob_hash))
+        yield self.blob_storage.completed(blob.blob_hash, blob.length, mtime, inode)
+        if self.tracer is not None:
+            self.tracer.mark('blob recorded')
         if response_key == RECEIVED_SD_BLOB:
             yield self.blob_storage.load_sd_blob(blob)
+            if self.tracer is not None:
+                self.tracer.mark('sd blob loaded')
         self.close_blob()
+        self.release(blob.length)
         yield self.send_response({response_key: True})
         log.info("Received %s from %s", blob, self.peer.host)
+        self._blob_done()
 
     @defer.inlineCallbacks
     def _enqueue(self, results):
         # Enqueue stream if we finished getting all blobs.
         # Make sure we haven't forwarded it already or we haven't
-        # called enqueue_stream already. This can happen since
-        # there is no lock on a specific stream and simultaneous calls
-        # to enqueue_stream can occur.
-        # TODO: create lock on stream so simultaneous calls to
-        # enqueue_stream on the same stream can't occur
+        # called enqueue_stream already. Other connections uploading
+        # the same stream are handled by the stream lock and job id in
+        # enqueue_stream.
         if not all(r[0] for r in results):
             raise Exception("failed to write some blobs")
-        if self.sd_hash_receiving_stream is None:
-            raise Exception("no sd_hash to enqueue")
         ready = yield self.blob_storage.verify_stream_ready_to_forward(self.sd_hash_receiving_stream)
         if ready and not self.enqueued_stream:
             log.info("enqueuing stream %s", self.sd_hash_receiving_stream)
-            blobs = yield self.blob_storage.get_blobs_for_stream(self.sd_hash_receiving_stream)
-            total_blobs = len(blobs)
+            total_blobs = yield self.blob_storage.get_stream_blob_count(self.sd_hash_receiving_stream)
             self.enqueued_stream = True
             yield self.stream_client_factory
-            enqueue_stream(self.sd_hash_receiving_stream, total_blobs, self.blob_storage.db_dir,
-                           self.stream_client_factory, redis_address=self.blob_storage._redis_address)
+            # enqueue_stream makes blocking redis calls, as in enqueue_on_start
+            # it runs in a thread
+            sd_hash = self.sd_hash_receiving_stream
+            d = threads.deferToThread(enqueue_stream, sd_hash, total_blobs, self.blob_storage.db_dir,
+                                      self.stream_client_factory, redis_address=self.blob_storage._redis_address)
+            d.addErrback(lambda err: log.error("Failed to enqueue stream %s: %s", sd_hash, err.getErrorMessage()))
+            yield d
 
     def enqueue(self):
+        if self.sd_hash_receiving_stream is None:
+            # blobs sent without a stream are enqueued with the stream they belong to
+            return
         d = defer.DeferredList(self.blob_finished_ds)
         # It's possible that protocol finished in the middle
         # of writing a blob, in such case the finished_deferred
         # for the blob may not fire
         d.addTimeout(60, reactor)
         d.addCallback(self._enqueue)
+        d.addErrback(lambda err: log.warning("Failed to enqueue stream %s: %s", self.sd_hash_receiving_stream,
+                                             err.getErrorMessage()))
 
     @defer.inlineCallbacks
     def _on_failed_blob(self, err, response_key):
-        yield self.clean_up_failed_upload(err, self.incoming_blob)
+        BLOBS_RECEIVED.labels(response_key, 'false').inc()
+        BLOB_BYTES_RECEIVED.labels(response_key, 'false').inc(self.incoming_blob.length - self.blob_bytes_remaining)
+        blob = self.incoming_blob
+        yield self.clean_up_failed_upload(err, blob)
         self.close_blob()
+        self.release(blob.length)
         yield self.send_response({response_key: False})
+        self._blob_done()
 
     def handle_incoming_blob(self, response_key):
         """
@@ -144,6 +278,7 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
         """
         blob = self.incoming_blob
 
+        self.blob_bytes_remaining = blob.length
         self.blob_writer, self.blob_finished_d  = blob.open_for_writing(self.peer)
         self.blob_finished_ds.append(self.blob_finished_d)
         self.blob_finished_d.addCallback(self._on_completed_blob, response_key)
@@ -161,41 +296,84 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
 
     def dataReceived(self, data):
         self.setTimeout(self.PROTOCOL_TIMEOUT)
-        if self.receiving_blob:
+        self.pending_data.append((data, 0))
+        self.buffered_bytes += len(data)
+        self._process_pending()
+
+    def _process_pending(self):
+        if self.processing_data:
+            # called from a request that was handled right away, the loop
+            # below carries on with the rest of the data
+            return
+        self.processing_data = True
+        try:
+            while self.pending_data and not self.handling_request:
+                data, offset = self.pending_data.popleft()
+                if self.receiving_blob:
+                    handled = self._write_blob_data(data, offset)
+                else:
+                    handled = self._process_request(data, offset)
+                self.buffered_bytes -= handled - offset
+                if handled < len(data):
+                    self.pending_data.appendleft((data, handled))
+        finally:
+            self.processing_data = False
+        if CONNECTION_BUFFER_BYTES and self.transport.connected:
+            if self.buffered_bytes > CONNECTION_BUFFER_BYTES:
+                self.pause_reading('buffer')
+            elif self.buffered_bytes <= CONNECTION_BUFFER_BYTES // 2:
+                self.resume_reading('buffer')
+
+    def _write_blob_data(self, data, offset):
+        length = min(len(data) - offset, self.blob_bytes_remaining)
+        self.blob_bytes_remaining -= length
+        if not self.blob_bytes_remaining:
+            # anything after the blob waits until it has been handled
+            self.handling_request = True
+            if self.tracer is not None:
+                self.tracer.mark('blob data received')
+        if offset == 0 and length == len(data):
             self.blob_writer.write(data)
         else:
-            log.debug('Not yet recieving blob, data needs further processing')
-            self.request_buff += data
-            msg, extra_data = self._get_valid_response(self.request_buff)
-            if msg is not None:
-                self.request_buff = ''
-                d = self.handle_request(msg)
-                d.addErrback(self.handle_error)
-                if self.receiving_blob and extra_data:
-                    log.debug('Writing extra data to blob')
-                    self.blob_writer.write(extra_data)
-
-    def _get_valid_response(self, response_msg):
-        extra_data = None
-        response = None
-        curr_pos = 0
-        while not self.receiving_blob:
-            next_close_paren = response_msg.find('}', curr_pos)
-            if next_close_paren != -1:
-                curr_pos = next_close_paren + 1
-                try:
-                    response = json.loads(response_msg[:curr_pos])
-                except ValueError:
-                    if curr_pos > MAXIMUM_QUERY_SIZE:
-                        raise ValueError("Error decoding response: %s" % str(response_msg))
-                    else:
-                        pass
-                else:
-                    extra_data = response_msg[curr_pos:]
-                    break
-            else:
-                break
-        return response, extra_data
+            # hand the writer its part of the chunk without copying it
+            self.blob_writer.write(buffer(data, offset, length))
+        return offset + length
+
+    def _process_request(self, data, offset):
+        msg, offset = self.decoder.decode(data, offset)
+        if msg is not None:
+            if self.tracer is not None:
+                self.tracer.start('handshake' if self.need_handshake() else
+                                  'descriptor' if SD_BLOB_HASH in msg else 'blob')
+            d = self.handle_request(msg)
+            d.addErrback(self.handle_error)
+            if not self.receiving_blob:
+                # the blob requests start receiving once they are answered
+                self.handling_request = True
+                d.addBoth(self._request_handled)
+        return offset
+
+    def _request_handled(self, result):
+        if self.tracer is not None and not self.receiving_blob:
+            self.tracer.finish()
+        self.handling_request = False
+        self._process_pending()
+        return result
+
+    def _blob_done(self):
+        if self.tracer is not None:
+            self.tracer.finish()
+        if self.accepted_blobs:
+            self._receive_accepted_blob()
+        self.handling_request = False
+        self._process_pending()
+
+    def _receive_accepted_blob(self):
+        if self.tracer is not None:
+            self.tracer.start('pipelined blob')
+        self.incoming_blob = self.accepted_blobs.popleft()
+        self.receiving_blob = True
+        self.handle_incoming_blob(RECEIVED_BLOB)
 
     def need_handshake(self):
         return self.received_handshake is False
@@ -228,12 +406,22 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
         Upon connecting, the client sends a version handshake:
         {
             'version': int,
+            'pipelined_blobs': int, optional
         }
 
         The server replies with the same version if it is supported
         {
             'version': int,
+            'pipelined_blobs': int, if the client sent it
         }
+
+        pipelined_blobs is the number of blob offers the client would like to
+        send at once, the server replies with the number it accepts. A client
+        that pipelines sends groups of offers, each with an offers_following
+        field counting the offers after it in the group. The server answers
+        each offer in order and then receives the accepted blobs in the order
+        they were offered, the client may send the next group right after the
+        last blob without waiting for the received_blob responses.
         """
 
         if VERSION not in request_dict:
@@ -245,10 +433,15 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
         self.peer_version = int(request_dict[VERSION])
         log.debug('Handling handshake for client version %i', self.peer_version)
         self.received_handshake = True
-        return self.send_handshake_response()
-
-    def send_handshake_response(self):
-        d = defer.succeed({VERSION: self.peer_version})
+        if PIPELINED_BLOBS in request_dict:
+            self.pipelined_blobs = max(0, min(int(request_dict[PIPELINED_BLOBS]), MAXIMUM_PIPELINED_BLOBS))
+        return self.send_handshake_response(PIPELINED_BLOBS in request_dict)
+
+    def send_handshake_response(self, pipelined=False):
+        response = {VERSION: self.peer_version}
+        if pipelined:
+            response[PIPELINED_BLOBS] = self.pipelined_blobs
+        d = defer.succeed(response)
         d.addCallback(self.send_response)
         return d
 
@@ -293,8 +486,14 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
 
     @defer.inlineCallbacks
     def get_descriptor_response(self, sd_hash, sd_size):
+        if not 0 <= sd_size <= MAXIMUM_BLOB_SIZE:
+            raise ReflectorRequestError("Invalid sd blob size: %s" % sd_size)
         self.sd_hash_receiving_stream = sd_hash
+        start = time.time()
         needed = yield self.blob_storage.get_needed_blobs_for_stream(sd_hash)
+        DESCRIPTOR_LATENCY.observe(time.time() - start)
+        if self.tracer is not None:
+            self.tracer.mark('descriptor decision')
 
         if needed is not None:
             response = {
@@ -303,6 +502,7 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
             }
         else:
             sd_blob = yield self.blob_storage.get_blob(sd_hash, sd_size)
+            yield self.reserve(sd_blob.length)
             self.incoming_blob = sd_blob
             self.receiving_blob = True
             self.handle_incoming_blob(RECEIVED_SD_BLOB)
@@ -332,6 +532,9 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
         blob_hash = request_dict[BLOB_HASH]
         blob_size = request_dict[BLOB_SIZE]
 
+        if OFFERS_FOLLOWING in request_dict:
+            return self.handle_pipelined_blob_request(blob_hash, blob_size, request_dict[OFFERS_FOLLOWING])
+
         if self.blob_writer is None:
             log.debug('Received info for blob: %s', blob_hash[:16])
             d = self.get_blob_response(blob_hash, blob_size)
@@ -343,18 +546,46 @@ class ReflectorServerProtocol(Protocol, TimeoutMixin):
         return d
 
     @defer.inlineCallbacks
-    def get_blob_response(self, blob_hash, blob_size):
+    def handle_pipelined_blob_request(self, blob_hash, blob_size, offers_following):
+        if not 0 <= offers_following < self.pipelined_blobs or \
+                len(self.accepted_blobs) + offers_following >= self.pipelined_blobs:
+            raise ReflectorRequestError("Too many pipelined offers")
+        log.debug('Received pipelined info for blob: %s', blob_hash[:16])
+        response = yield self.get_blob_response(blob_hash, blob_size, receive=False)
+        yield self.send_response(response)
+        if not offers_following and self.accepted_blobs:
+            # the accepted blobs follow the last offer of the group
+            self._receive_accepted_blob()
+
+    @defer.inlineCallbacks
+    def get_blob_response(self, blob_hash, blob_size, receive=True):
+        # if receive is False an accepted blob is added to accepted_blobs instead
+        # of being received right away
+        if not 0 <= blob_size <= MAXIMUM_BLOB_SIZE:
+            log.warning("Declined %s from %s, %s bytes is not a valid blob size", blob_hash[:16],
+                        self.peer.host, blob_size)
+            defer.returnValue({SEND_BLOB: False})
+        start = time.time()
+        blob = None
         in_cluster = yield self.blob_storage.blob_has_been_forwarded_to_host(blob_hash)
-        if in_cluster:
-            response = {SEND_BLOB: False}
-        else:
+        if not in_cluster:
             exists_locally = yield self.blob_storage.blob_exists(blob_hash)
-            if exists_locally:
-                response = {SEND_BLOB: False}
-            else:
+            if not exists_locally and blob_hash not in [b.blob_hash for b in self.accepted_blobs]:
                 blob = yield self.blob_storage.get_blob(blob_hash, blob_size)
-                self.incoming_blob = blob
-                self.receiving_blob = True
-                self.handle_incoming_blob(RECEIVED_BLOB)
-                response = {SEND_BLOB: True}
-        defer.returnValue(response)
+        BLOB_DECISION_LATENCY.observe(time.time() - start)
+        if self.tracer is not None:
+            self.tracer.mark('blob decision')
+        if blob is not None and not receive and not self.fits_group(blob.length):
+            # the client may offer it again in a later group
+            log.debug("Declined %s, the pipelined group is over the in flight limit", blob_hash[:16])
+            blob = None
+        if blob is None:
+            defer.returnValue({SEND_BLOB: False})
+        yield self.reserve(blob.length)
+        if receive:
+            self.incoming_blob = blob
+            self.receiving_blob = True
+            self.handle_incoming_blob(RECEIVED_BLOB)
+        else:
+            self.accepted_blobs.append(blob)
+        defer.returnValue({SEND_BLOB: True})
@@ -1,12 +1,15 @@
 import json
 import logging
+from collections import deque
 
-from twisted.protocols.basic import FileSender
 from twisted.internet.protocol import Protocol
 from twisted.internet import defer, error, reactor
 from twisted.protocols.policies import TimeoutMixin
 
-from prism.error import IncompleteResponse, ReflectorRequestError
+from prism.constants import OFFERS_FOLLOWING, PIPELINED_BLOBS, RECEIVED_BLOB, SEND_BLOB
+from prism.error import ReflectorRequestError
+from prism.protocol.decoder import ReflectorMessageDecoder
+from prism.protocol.sender import BlobSender
 
 
 log = logging.getLogger(__name__)
@@ -14,6 +17,11 @@ log = logging.getLogger(__name__)
 
 class StreamReflectorClient(Protocol, TimeoutMixin):
     PROTOCOL_TIMEOUT = 30
+    # set when the client is given a handshaked connection from a ReflectorConnectionPool
+    pooled_connection = None
+    # number of blob offers to send at once if the server supports it, 0 to
+    # wait for the response to each offer and blob
+    pipelined_blobs = 0
 
     def __init__(self, sd_blob, blobs):
         # sd blob to send
@@ -25,7 +33,7 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
 
     def connectionMade(self):
         log.debug("Connection made")
-        self.response_buff = ''
+        self.decoder = ReflectorMessageDecoder()
         self.outgoing_buff = ''
         self.next_blob_to_send = None
         self.blob_read_handle = None
@@ -35,23 +43,36 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
         self.producer = None
         self.streaming = False
         self.sent_stream_info = False
+        # the number of pipelined offers agreed with the server, 0 if not pipelining
+        self.pipeline_window = 0
+        # (response key, blob) expected from the server in order, when pipelining
+        self.expected_responses = deque()
+        # offers sent that have not been answered yet
+        self.offers_pending = 0
+        # blobs the server accepted that have not been sent yet
+        self.accepted_blobs = deque()
+        self.transferring = False
         # needed for TimeoutMixin
         self.callLater = reactor.callLater
         self.setTimeout(self.PROTOCOL_TIMEOUT)
 
-        d = self.send_handshake()
+        if self.pooled_connection is not None:
+            # the pool did the handshake
+            self.received_handshake_response = True
+            self.pipeline_window = min(self.pipelined_blobs, self.pooled_connection.pipelined_blobs)
+            d = defer.maybeDeferred(self.send_next_request)
+        else:
+            d = self.send_handshake()
         d.addErrback(lambda err: log.warning("An error occurred immediately: %s", err.getTraceback()))
 
     def dataReceived(self, data):
         self.setTimeout(self.PROTOCOL_TIMEOUT)
         log.debug('Received %s', data)
-        self.response_buff += data
-        try:
-            msg = self.parse_response(self.response_buff)
-        except IncompleteResponse:
-            pass
-        else:
-            self.response_buff = ''
+        offset = 0
+        while offset < len(data):
+            msg, offset = self.decoder.decode(data, offset)
+            if msg is None:
+                break
             d = self.handle_response(msg)
             d.addCallback(lambda _: self.send_next_request())
             d.addErrback(self.response_failure_handler)
@@ -83,15 +104,12 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
 
     def send_handshake(self):
         log.debug('Sending handshake')
-        self.write(json.dumps({'version': self.protocol_version}))
+        handshake = {'version': self.protocol_version}
+        if self.pipelined_blobs:
+            handshake[PIPELINED_BLOBS] = self.pipelined_blobs
+        self.write(json.dumps(handshake))
         return defer.succeed(None)
 
-    def parse_response(self, buff):
-        try:
-            return json.loads(buff)
-        except ValueError:
-            raise IncompleteResponse()
-
     def response_failure_handler(self, err):
         log.warning("An error occurred handling the response: %s", err.getTraceback())
 
@@ -126,6 +144,8 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
         if self.protocol_version != server_version:
             raise ValueError("I can't handle protocol version {}!".format(self.protocol_version))
         self.received_handshake_response = True
+        # servers that don't support pipelining leave it out of the response
+        self.pipeline_window = min(self.pipelined_blobs, int(response_dict.get(PIPELINED_BLOBS, 0)))
         return defer.succeed(True)
 
     def get_blobs_to_send(self):
@@ -142,7 +162,7 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
                 raise ReflectorRequestError("I don't know whether to send the sd blob or not!")
             if response_dict['send_sd_blob'] is True:
                 self.open_blob_for_reading(self.sd_blob)
-                self.file_sender = FileSender()
+                self.file_sender = BlobSender()
             else:
                 self.received_descriptor_response = True
             self.descriptor_needed = response_dict['send_sd_blob']
@@ -162,11 +182,13 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
                 return self.set_not_uploading()
 
     def handle_normal_response(self, response_dict):
+        if self.pipeline_window:
+            return self.handle_pipelined_response(response_dict)
         if self.file_sender is None:  # Expecting Server Info Response
             if 'send_blob' not in response_dict:
                 raise ValueError("I don't know whether to send the blob or not!")
             if response_dict['send_blob'] is True:
-                self.file_sender = FileSender()
+                self.file_sender = BlobSender()
                 return defer.succeed(True)
             else:
                 return self.set_not_uploading()
@@ -176,6 +198,63 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
             else:
                 return self.set_not_uploading()
 
+    def handle_pipelined_response(self, response_dict):
+        if not self.expected_responses:
+            raise ValueError("Unexpected response: %s" % response_dict)
+        response_key, blob = self.expected_responses.popleft()
+        if response_key not in response_dict:
+            raise ValueError("Expected %s for %s, got %s" % (response_key, blob.blob_hash, response_dict))
+        if response_key == SEND_BLOB:
+            self.offers_pending -= 1
+            if response_dict[SEND_BLOB] is True:
+                self.accepted_blobs.append(blob)
+        elif not response_dict[RECEIVED_BLOB]:
+            log.warning("Reflector failed to receive %s", blob)
+        return defer.succeed(True)
+
+    def send_offers(self):
+        # offer the next group of blobs, each offer says how many follow it
+        offers = self.blobs_to_send[:self.pipeline_window]
+        self.blobs_to_send = self.blobs_to_send[self.pipeline_window:]
+        for i, blob in enumerate(offers):
+            self.write(json.dumps({
+                'blob_hash': blob.blob_hash,
+                'blob_size': blob.length,
+                OFFERS_FOLLOWING: len(offers) - i - 1,
+            }))
+            self.expected_responses.append((SEND_BLOB, blob))
+        self.offers_pending += len(offers)
+
+    @defer.inlineCallbacks
+    def send_accepted_blobs(self):
+        # send the accepted blobs back to back, the received_blob responses are
+        # checked as they come in
+        self.transferring = True
+        try:
+            while self.accepted_blobs:
+                blob = self.accepted_blobs.popleft()
+                self.open_blob_for_reading(blob)
+                self.expected_responses.append((RECEIVED_BLOB, blob))
+                self.file_sender = BlobSender()
+                yield self.start_transfer()
+                yield self.set_not_uploading()
+        finally:
+            self.transferring = False
+
+    def send_next_pipelined_request(self):
+        if self.transferring or self.offers_pending:
+            return defer.succeed(True)
+        if self.accepted_blobs:
+            d = self.send_accepted_blobs()
+            d.addCallback(lambda _: self.send_next_pipelined_request())
+            return d
+        if self.blobs_to_send:
+            self.send_offers()
+        elif not self.expected_responses:
+            log.debug('No more blob hashes, closing connection')
+            self.finish()
+        return defer.succeed(True)
+
     def open_blob_for_reading(self, blob):
         if blob.verified:
             read_handle = blob.open_for_reading()
@@ -207,8 +286,19 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
     def disconnect(self, err):
         self.transport.loseConnection()
 
+    def finish(self):
+        # all the blobs were sent and answered
+        if self.pooled_connection is not None:
+            self.pooled_connection.release()
+        else:
+            self.transport.loseConnection()
+
     def send_next_request(self):
-        if self.file_sender is not None:
+        if self.transferring:
+            # pipelined blobs are being sent, the responses are checked as they come
+            return defer.succeed(True)
+
+        elif self.file_sender is not None:
             # send the blob
             log.debug('Sending the blob')
             return self.start_transfer()
@@ -218,6 +308,9 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
             self.send_descriptor_info()
             return defer.succeed(True)
 
+        elif self.pipeline_window:
+            return self.send_next_pipelined_request()
+
         elif self.blobs_to_send:
             # open the next blob to send
             blob = self.blobs_to_send[0]
@@ -228,4 +321,4 @@ class StreamReflectorClient(Protocol, TimeoutMixin):
         else:
             # close connection
             log.debug('No more blob hashes, closing connection')
-            self.transport.loseConnection()
+            self.finish()
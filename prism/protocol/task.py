@@ -1,17 +1,24 @@
 import os
+import errno
 import sys
 import time
 import logging
 import random
+import bisect
 
 from rq import Queue
-from redis.exceptions import ConnectionError
+from rq.job import Job, JobStatus
+from rq.registry import StartedJobRegistry
+from redis.exceptions import ConnectionError, WatchError
 from rq.timeouts import JobTimeoutException
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
+from prism.storage.storage import HOST_BLOB_COUNTS, STREAM_LOCK_PREFIX, SUPPRESSED_STREAM_JOBS
 from prism.storage.storage import ClusterStorage, get_redis_connection
 from prism.config import get_settings
+from prism.metrics import FORWARDED_BLOBS, FORWARDED_BYTES, FORWARDS
+from prism.placement import HashRing
 
 settings = get_settings()
 BLOB_DIR = os.path.expandvars(settings['blob directory'])
@@ -20,6 +27,7 @@ SETTINGS = get_settings()
 HOSTS = SETTINGS['hosts']
 NUM_HOSTS = len(HOSTS) - 1
 TCP_CONNECT_TIMEOUT = 15
+STREAM_LOCK_LEASE = settings['stream lock lease']
 
 log = logging.getLogger(__name__)
 
@@ -35,77 +43,180 @@ def retry_redis(fn):
     return _wrapper
 
 
-def next_host(redis_conn):
-    host_info = {}
-    for host in HOSTS:
-        if ":" in host:
-            address, port = host.split(":")
-            port = int(port)
-        else:
-            address, port = host, 5566
-        count = redis_conn.scard(address)
+def parse_host(host):
+    if ":" in host:
+        address, port = host.split(":")
+        return address, int(port)
+    return host, 5566
+
+
+HOST_ADDRESSES = [parse_host(host) for host in HOSTS]
+HOST_COUNTS_TTL = settings['host counts ttl']
+# (time read, hosts with free capacity as (address, port, blob count), cumulative free capacity)
+_host_weights = [0, [], []]
+# "random" or "consistent", see prism.placement
+PLACEMENT = settings['placement']
+_ring = []
+
+
+def get_host_counts(redis_conn):
+    # blob counts of the hosts in one round trip, hosts that don't have a count yet
+    # get one from the size of their table
+    addresses = [address for address, port in HOST_ADDRESSES]
+    counts = redis_conn.hmget(HOST_BLOB_COUNTS, addresses)
+    missing = [address for address, count in zip(addresses, counts) if count is None]
+    if missing:
+        pipe = redis_conn.pipeline(transaction=False)
+        for address in missing:
+            pipe.scard(address)
+        for address, count in zip(missing, pipe.execute()):
+            pipe.hsetnx(HOST_BLOB_COUNTS, address, count)
+        pipe.hmget(HOST_BLOB_COUNTS, addresses)
+        counts = pipe.execute()[-1]
+    return dict(zip(addresses, [int(count) for count in counts]))
+
+
+def get_host_weights(redis_conn):
+    read_at, hosts, cumulative = _host_weights
+    if hosts and time.time() - read_at < HOST_COUNTS_TTL:
+        return hosts, cumulative
+    counts = get_host_counts(redis_conn)
+    hosts, cumulative, total = [], [], 0
+    for address, port in HOST_ADDRESSES:
+        count = counts[address]
         if count < settings['max blobs']:
-            host_info["%s:%i" % (address, port)] = count
+            hosts.append((address, port, count))
+            total += settings['max blobs'] - count
+            cumulative.append(total)
+    _host_weights[:] = [time.time(), hosts, cumulative]
+    return hosts, cumulative
+
 
-    host = random.choice(host_info.keys())
-    address, port = host.split(":")
-    blob_count = host_info[host]
-    return address, int(port), blob_count
+def next_host(redis_conn):
+    # pick a host with free capacity, weighted by how much it has left
+    hosts, cumulative = get_host_weights(redis_conn)
+    if not hosts:
+        raise Exception("all hosts have %i blobs" % settings['max blobs'])
+    return hosts[bisect.bisect_right(cumulative, random.random() * cumulative[-1])]
+
+
+def get_ring():
+    # the ring is built the first time a stream is placed
+    if not _ring:
+        weights = dict(("%s:%i" % parse_host(host), weight) for host, weight in settings['host weights'].items())
+        _ring.append(HashRing(["%s:%i" % host for host in HOST_ADDRESSES], settings['virtual nodes'], weights))
+    return _ring[0]
+
+
+def stream_host(sd_hash, redis_conn):
+    # pick the host to send a stream to, with "consistent" placement hosts
+    # that are full are passed over for the next host on the ring
+    if PLACEMENT == 'random':
+        return next_host(redis_conn)
+    if PLACEMENT != 'consistent':
+        raise ValueError("unknown placement: %s" % PLACEMENT)
+    hosts, cumulative = get_host_weights(redis_conn)
+    counts = dict(("%s:%i" % (address, port), count) for address, port, count in hosts)
+    ring = get_ring()
+    host = ring.host_for(sd_hash, ring.hosts.difference(counts))
+    if host is None:
+        raise Exception("all hosts have %i blobs" % settings['max blobs'])
+    address, port = parse_host(host)
+    return address, port, counts[host]
 
 
 def get_blob_path(blob_hash, blob_storage):
-    return os.path.join(blob_storage.db_dir, blob_hash)
+    return blob_storage.get_blob_path(blob_hash)
 
 
 @defer.inlineCallbacks
 def update_sent_blobs(blob_hashes_sent, host, blob_storage):
+    log.debug("updating %i sent blobs", len(blob_hashes_sent))
+    sent_bytes = yield blob_storage.add_blobs_to_host(blob_hashes_sent, host)
+    FORWARDED_BLOBS.labels(host).inc(len(blob_hashes_sent))
+    FORWARDED_BYTES.labels(host).inc(sent_bytes)
     for blob_hash in blob_hashes_sent:
-        log.debug("updating sent blob %s", blob_hash)
-        res = yield blob_storage.add_blob_to_host(blob_hash, host)
         blob_path = get_blob_path(blob_hash, blob_storage)
-        if os.path.isfile(blob_path):
-            log.debug('removing %s', blob_path)
+        log.debug('removing %s', blob_path)
+        try:
             os.remove(blob_path)
-
-
-def connect_factory(host, port, factory, blob_storage, hash_to_process):
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def forward_factory(host, port, factory, blob_storage, hash_to_process, timeout=None, pool=None):
+    """
+    Connect factory to host:port and send its blobs. Returns a deferred that fires
+    with True once the connection is done, or False if it failed. The blobs that
+    were sent are recorded either way. If timeout is given the connection is
+    dropped after that many seconds. If pool is given, a handshaked connection
+    from the ReflectorConnectionPool is used instead of a new one.
+    """
     from twisted.internet import reactor
+    finished = defer.Deferred()
+
     @defer.inlineCallbacks
     def on_finish(result):
         log.info("Finished sending %s to %s", hash_to_process, host)
+        FORWARDS.labels(host, 'finished').inc()
         yield update_sent_blobs(factory.p.blob_hashes_sent, host, blob_storage)
         connection.disconnect()
-        reactor.fireSystemEvent("shutdown")
+        defer.returnValue(True)
 
     @defer.inlineCallbacks
     def on_error(error):
         log.error("Error when sending %s: %s. Hashes sent %s", hash_to_process, error,
                                                             factory.p.blob_hashes_sent)
+        FORWARDS.labels(host, 'error').inc()
         yield update_sent_blobs(factory.p.blob_hashes_sent, host, blob_storage)
         connection.disconnect()
-        reactor.fireSystemEvent("shutdown")
+        defer.returnValue(False)
 
     def on_connection_fail(result):
         log.error("Failed to connect to %s:%s", host, port)
-        reactor.fireSystemEvent("shutdown")
+        FORWARDS.labels(host, 'connection failed').inc()
+        return False
 
     def _error(failure):
         log.error("Failed on_connection_lost_d callback: %s", failure)
-        reactor.fireSystemEvent("shutdown")
+        return False
+
+    def _done(result):
+        if timeout_call is not None and timeout_call.active():
+            timeout_call.cancel()
+        if not finished.called:
+            finished.callback(result)
 
     factory.on_connection_lost_d.addCallbacks(on_finish, on_error)
     factory.on_connection_lost_d.addErrback(_error)
+    factory.on_connection_lost_d.addCallback(_done)
 
     factory.on_connection_fail_d.addCallback(on_connection_fail)
-    try:
-        log.debug("Connecting factory to %s:%s", host, port)
+    factory.on_connection_fail_d.addCallback(_done)
+
+    log.debug("Connecting factory to %s:%s", host, port)
+    timeout_call = None
+    if pool is not None:
+        connection = pool.connect(host, port, factory)
+    else:
         connection = reactor.connectTCP(host, port, factory, timeout=TCP_CONNECT_TIMEOUT)
+    if timeout is not None:
+        timeout_call = reactor.callLater(timeout, connection.disconnect)
+    return finished
+
+
+def connect_factory(host, port, factory, blob_storage, hash_to_process):
+    from twisted.internet import reactor
+    try:
+        d = forward_factory(host, port, factory, blob_storage, hash_to_process)
     except JobTimeoutException:
         log.error("Failed to forward %s --> %s", hash_to_process[:8], host)
         return sys.exit(0)
     except Exception as err:
         log.exception("Job (pid %s) encountered unexpected error")
         return sys.exit(1)
+    d.addCallback(lambda _: reactor.fireSystemEvent("shutdown"))
 
 
 def factory_setup_error(error):
@@ -138,7 +249,7 @@ def process_blob(blob_hash, db_dir, client_factory_class, redis_address, host_in
 def process_stream(sd_hash, db_dir, client_factory_class, redis_address, host_infos=None, setup_d=None):
     log.info("processing %s pid %s", sd_hash, os.getpid())
     if host_infos is None:
-        host, port, host_blob_count = next_host(get_redis_connection(redis_address))
+        host, port, host_blob_count = stream_host(sd_hash, get_redis_connection(redis_address))
     else:
         host, port, host_blob_count = host_infos
     blob_storage = ClusterStorage(db_dir, redis_address)
@@ -154,13 +265,136 @@ def process_stream(sd_hash, db_dir, client_factory_class, redis_address, host_in
     return sys.exit(0)
 
 
+@defer.inlineCallbacks
+def forward_blob(blob_hash, blob_storage, client_factory_class, redis_connection, host_infos=None,
+                 timeout=None, pool=None):
+    """
+    process_blob for a reactor that is already running, returns a deferred that
+    fires with the result of forward_factory. Errors setting up the factory are
+    raised.
+    """
+    if host_infos is None:
+        host_infos = yield threads.deferToThread(next_host, redis_connection)
+    host, port, host_blob_count = host_infos
+    factory = yield client_factory_class(blob_hash, blob_storage)
+    result = yield forward_factory(host, port, factory, blob_storage, blob_hash, timeout, pool)
+    defer.returnValue(result)
+
+
+@defer.inlineCallbacks
+def forward_stream(sd_hash, blob_storage, client_factory_class, redis_connection, host_infos=None,
+                   timeout=None, pool=None):
+    """
+    process_stream for a reactor that is already running, returns a deferred that
+    fires with the result of forward_factory. Errors setting up the factory are
+    raised.
+    """
+    if host_infos is None:
+        host_infos = yield threads.deferToThread(stream_host, sd_hash, redis_connection)
+    host, port, host_blob_count = host_infos
+    factory = yield client_factory_class(sd_hash, blob_storage, host)
+    result = yield forward_factory(host, port, factory, blob_storage, sd_hash, timeout, pool)
+    defer.returnValue(result)
+
+
+def stream_job_id(sd_hash):
+    # one job id per stream, so the job for a stream can be looked up
+    return "stream-%s" % sd_hash
+
+
+def acquire_stream_locks(redis_connection, sd_hashes, lease=STREAM_LOCK_LEASE):
+    # returns a token to release each lock with, or None for the locks that are
+    # held, the lease frees a lock if its holder dies
+    tokens = [os.urandom(16).encode('hex') for _ in sd_hashes]
+    pipe = redis_connection.pipeline(transaction=False)
+    for sd_hash, token in zip(sd_hashes, tokens):
+        pipe.set(STREAM_LOCK_PREFIX + sd_hash, token, nx=True, px=int(lease * 1000))
+    return [token if acquired else None for token, acquired in zip(tokens, pipe.execute())]
+
+
+def release_stream_locks(redis_connection, locks):
+    # locks is a list of (sd_hash, token), a lock is only deleted if its lease
+    # hasn't run out and been taken by someone else
+    keys = [STREAM_LOCK_PREFIX + sd_hash for sd_hash, token in locks]
+    if not keys:
+        return
+    with redis_connection.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*keys)
+                held = [key for key, (sd_hash, token), value in zip(keys, locks, pipe.mget(keys))
+                        if value == token]
+                pipe.multi()
+                if held:
+                    pipe.delete(*held)
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+
+def pending_stream_jobs(redis_connection, queue, job_ids):
+    # True for each job that is waiting in the queue or is being run by a live worker,
+    # the started registry scores are the times the jobs time out
+    started_registry = StartedJobRegistry(queue.name, redis_connection)
+    pipe = redis_connection.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hget(Job.key_for(job_id), 'status')
+        pipe.zscore(started_registry.key, job_id)
+    results = pipe.execute()
+    now = time.time()
+    pending = []
+    for status, expires_at in zip(results[::2], results[1::2]):
+        pending.append(status == JobStatus.QUEUED or
+                       (status == JobStatus.STARTED and expires_at is not None and expires_at > now))
+    return pending
+
+
 @retry_redis
-def enqueue_stream(sd_hash, num_blobs_in_stream, db_dir, client_factory_class, redis_address=settings['redis server'],
-                   host_infos=None):
-    timeout = (num_blobs_in_stream+1)*30
+def enqueue_streams(streams, db_dir, client_factory_class, redis_address=settings['redis server'], host_infos=None):
+    """
+    Enqueue process_stream jobs for streams, a list of (sd_hash, number of blobs in the
+    stream), skipping the streams that already have a job queued or running. The check
+    and the enqueue are done holding the stream locks, so concurrent uploads of a stream
+    can't both enqueue it. Each step is one pipelined round trip for all of the streams.
+
+    Returns a list of True for the streams that were enqueued, the ones that weren't
+    are counted in SUPPRESSED_STREAM_JOBS
+    """
     redis_connection = get_redis_connection(redis_address)
     q = Queue(connection=redis_connection)
-    q.enqueue(process_stream, sd_hash, db_dir, client_factory_class, redis_address, host_infos, timeout=timeout)
+    sd_hashes = [sd_hash for sd_hash, num_blobs_in_stream in streams]
+    job_ids = [stream_job_id(sd_hash) for sd_hash in sd_hashes]
+    tokens = acquire_stream_locks(redis_connection, sd_hashes)
+    locks = [(sd_hash, token) for sd_hash, token in zip(sd_hashes, tokens) if token is not None]
+    try:
+        pending = pending_stream_jobs(redis_connection, q, job_ids)
+        enqueued = [token is not None and not job_pending for token, job_pending in zip(tokens, pending)]
+        pipe = redis_connection.pipeline()
+        for (sd_hash, num_blobs_in_stream), job_id, enqueue in zip(streams, job_ids, enqueued):
+            if not enqueue:
+                continue
+            timeout = (num_blobs_in_stream+1)*30
+            job = Job.create(process_stream, args=(sd_hash, db_dir, client_factory_class, redis_address, host_infos),
+                             connection=redis_connection, status=JobStatus.QUEUED, timeout=timeout, id=job_id,
+                             origin=q.name)
+            q.enqueue_job(job, pipeline=pipe)
+        if not all(enqueued):
+            pipe.incrby(SUPPRESSED_STREAM_JOBS, enqueued.count(False))
+        pipe.execute()
+    finally:
+        release_stream_locks(redis_connection, locks)
+    for sd_hash, enqueue in zip(sd_hashes, enqueued):
+        if not enqueue:
+            log.info("%s already has a job, not enqueuing it again", sd_hash)
+    return enqueued
+
+
+def enqueue_stream(sd_hash, num_blobs_in_stream, db_dir, client_factory_class, redis_address=settings['redis server'],
+                   host_infos=None):
+    # returns True if the stream was enqueued, see enqueue_streams
+    return enqueue_streams([(sd_hash, num_blobs_in_stream)], db_dir, client_factory_class, redis_address,
+                           host_infos)[0]
 
 
 @retry_redis
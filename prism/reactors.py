@@ -0,0 +1,65 @@
+import sys
+import logging
+import resource
+import importlib
+
+from twisted.internet import error
+
+log = logging.getLogger(__name__)
+
+REACTORS = {
+    'select': 'twisted.internet.selectreactor',
+    'poll': 'twisted.internet.pollreactor',
+    'epoll': 'twisted.internet.epollreactor',
+    'kqueue': 'twisted.internet.kqreactor',
+}
+
+# select() can't watch file descriptors above this
+FD_SETSIZE = 1024
+
+
+def default_reactor_name():
+    if sys.platform.startswith('linux'):
+        return 'epoll'
+    return 'select'
+
+
+def install_reactor(name=None):
+    name = name or default_reactor_name()
+    if name not in REACTORS:
+        raise ValueError("unknown reactor: %s, choose from %s" % (name, ", ".join(sorted(REACTORS))))
+    reactor_module = importlib.import_module(REACTORS[name])
+    try:
+        reactor_module.install()
+    except error.ReactorAlreadyInstalledError:
+        from twisted.internet import reactor
+        if reactor.__class__.__module__ != reactor_module.__name__:
+            log.warning("Failed to install %s reactor because %s is already installed",
+                        name, reactor.__class__.__name__)
+
+
+def raise_open_files_limit(target):
+    """
+    Raise the soft RLIMIT_NOFILE to target (capped at the hard limit),
+    returns the resulting soft limit
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= target:
+        return soft
+    new_soft = target if hard == resource.RLIM_INFINITY else min(target, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+    except (ValueError, OSError) as err:
+        log.warning("Failed to raise open file limit from %i to %i: %s", soft, new_soft, err)
+        return soft
+    if new_soft < target:
+        log.warning("Open file limit is %i, below the configured %i. Raise the hard limit "
+                    "(ulimit -Hn) to allow more connections", new_soft, target)
+    return new_soft
+
+
+def check_reactor_capacity(open_files_limit):
+    from twisted.internet import reactor
+    if reactor.__class__.__name__ == "SelectReactor" and open_files_limit > FD_SETSIZE:
+        log.warning("The select reactor can't use more than %i file descriptors, "
+                    "use the epoll or poll reactor to handle more connections", FD_SETSIZE)
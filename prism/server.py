@@ -1,58 +1,357 @@
 import os
+import sys
+import json
+import socket
 import logging
-from twisted.internet import defer, reactor
+import argparse
+import psutil
+
+# the configured reactor is installed before anything imports the default one
+from prism.config import get_settings
+from prism.reactors import check_reactor_capacity, install_reactor, raise_open_files_limit
+install_reactor(get_settings()['reactor'])
+
+from twisted.internet import defer, protocol, reactor, task, threads
 from twisted.application import service
-from rq import Queue
+from rq import Queue, Worker
 
 from prism.protocol.factory import build_prism_stream_server_factory
 from prism.protocol.factory import build_prism_stream_client_factory
-from prism.protocol.task import enqueue_stream
+from prism.protocol.task import enqueue_streams
+from prism.storage.storage import BLOB_HASHES, CLUSTER_BLOBS, HOST_BLOB_COUNTS, LOCAL_BLOB_BYTES, STATS_SNAPSHOT
 from prism.storage.storage import ClusterStorage, get_redis_connection
-from prism.config import get_settings
+from prism.metrics import IN_FLIGHT_BYTES, SERVER_CONNECTIONS, listen_metrics
+from prism.tracing import TRACE_LOG_PATH, TRACE_SAMPLE_RATE, init_trace_log
 
 settings = get_settings()
 log = logging.getLogger(__name__)
 
 LISTEN_ON = settings['listen']
+LISTEN_BACKLOG = 1024
+# streams read from sd_blob_hashes at a time when recovering on startup
+RECOVERY_PAGE_SIZE = 500
+# batches of streams being enqueued at once when recovering
+RECOVERY_CONCURRENCY = 4
+# seconds of the recovery rate enqueued in each batch
+RECOVERY_INTERVAL = 0.1
+RECOVERY_RATE = settings['recovery rate']
+STATS_INTERVAL = settings['stats interval']
+QUEUE_KEY = Queue.redis_queue_namespace_prefix + 'default'
+FAILED_QUEUE_KEY = Queue.redis_queue_namespace_prefix + 'failed'
+SERVER_PROCESSES = settings['server processes']
+# file descriptors of the listening socket and of the pipe the connection counts are
+# reported to the parent on, in the server processes started by PrismServerSupervisor
+CHILD_LISTEN_FD = 3
+CHILD_STATS_FD = 4
+# seconds before a server process that exited is started again, doubled each time it
+# exits again before running for MAX_RESTART_DELAY seconds, up to MAX_RESTART_DELAY
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
 
 
 class PrismServer(service.Service):
-    def __init__(self, port_num=5566):
+    def __init__(self, port_num=5566, cluster_storage=None, listen_on=LISTEN_ON, listen_fd=None, stats_fd=None):
         self.port_num = port_num
-        self.cluster_storage = ClusterStorage()
+        self.cluster_storage = cluster_storage or ClusterStorage()
+        self.listen_on = listen_on
+        # listening socket to accept connections on instead of listening on port_num
+        self.listen_fd = listen_fd
+        # pipe to report the connection and open file counts on instead of publishing the stats
+        self.stats_fd = stats_fd
+        self.factory = None
         self._port = None
+        self._stats_loop = None
 
     def startService(self):
-        log.info("Starting prism server (pid %i), listening on %s (reactor: %s)", os.getpid(),
-                 LISTEN_ON, reactor)
-        factory = build_prism_stream_server_factory(self.cluster_storage)
-        self._port = reactor.listenTCP(self.port_num, factory, 50, LISTEN_ON)
+        self.factory = build_prism_stream_server_factory(self.cluster_storage)
+        if self.listen_fd is None:
+            log.info("Starting prism server (pid %i), listening on %s (reactor: %s)", os.getpid(),
+                     self.listen_on, reactor)
+            self._port = reactor.listenTCP(self.port_num, self.factory, LISTEN_BACKLOG, self.listen_on)
+        else:
+            log.info("Starting prism server (pid %i) on the shared listening socket (reactor: %s)",
+                     os.getpid(), reactor)
+            self._port = reactor.adoptStreamPort(self.listen_fd, socket.AF_INET, self.factory)
+        SERVER_CONNECTIONS.set_function(lambda: self.factory.connections)
+        IN_FLIGHT_BYTES.set_function(lambda: self.factory.in_flight.reserved)
+        if STATS_INTERVAL:
+            self._stats_loop = task.LoopingCall(self.publish_stats)
+            self._stats_loop.start(STATS_INTERVAL)
 
     def stopService(self):
+        if self._stats_loop is not None and self._stats_loop.running:
+            self._stats_loop.stop()
         return self._port.stopListening()
 
+    def publish_stats(self):
+        if self.stats_fd is not None:
+            # the parent publishes the stats with the counts of all of its server processes
+            os.write(self.stats_fd, '%i %i\n' % (self.factory.connections, open_files()))
+            return defer.succeed(None)
+        d = publish_stats(self.cluster_storage, self.factory.connections, open_files())
+        d.addErrback(lambda err: log.warning("Failed to publish stats: %s", err.getErrorMessage()))
+        return d
+
+
+def listening_socket(port_num, listen_on, backlog=LISTEN_BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((listen_on, port_num))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class ServerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        # the last connection and open file counts the process reported
+        self.connections = 0
+        self.open_files = 0
+        self.started = None
+        self._buffer = ''
+
+    def childDataReceived(self, childFD, data):
+        if childFD != CHILD_STATS_FD:
+            return
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        if lines:
+            self.connections, self.open_files = map(int, lines[-1].split())
+
+    def processEnded(self, reason):
+        self.supervisor.process_ended(self, reason)
+
+
+class PrismServerSupervisor(service.Service):
+    """
+    Runs a number of prism-server processes that accept connections on one listening
+    socket opened here, so the uploads are spread over that many cores. Each process
+    has its own reactor and ClusterStorage, and is started again if it exits.
+
+    The stats are published from here with the connection and open file counts the
+    processes report, and enqueue on startup is run only here. A process that keeps exiting
+    is restarted with an exponential backoff.
+    """
+
+    def __init__(self, processes, port_num=5566, cluster_storage=None, listen_on=LISTEN_ON, clock=None):
+        self.processes = processes
+        self.port_num = port_num
+        self.cluster_storage = cluster_storage or ClusterStorage()
+        self.listen_on = listen_on
+        self.clock = clock or reactor
+        # index: ServerProcessProtocol of the running processes
+        self.running = {}
+        # index: delayed call restarting the process
+        self.restarts = {}
+        # index: delay before the process is restarted the next time it exits
+        self._restart_delays = {}
+        self._socket = None
+        self._stats_loop = None
+        self._stopped_d = None
+
+    def startService(self):
+        log.info("Starting %i prism server processes (pid %i), listening on %s", self.processes, os.getpid(),
+                 self.listen_on)
+        self._socket = listening_socket(self.port_num, self.listen_on)
+        for index in range(self.processes):
+            self.spawn(index)
+        if STATS_INTERVAL:
+            self._stats_loop = task.LoopingCall(self.publish_stats)
+            self._stats_loop.start(STATS_INTERVAL, now=False)
+
+    def spawn(self, index):
+        self.restarts.pop(index, None)
+        if self._stopped_d is not None:
+            return
+        process = ServerProcessProtocol(self, index)
+        # the processes use the blob directory and redis server of the supervisor's storage
+        args = [sys.executable, '-m', 'prism.server', '--child', str(index),
+                '--blob-dir', self.cluster_storage.db_dir, '--redis', self.cluster_storage._redis_address]
+        reactor.spawnProcess(process, sys.executable, args, env=os.environ, childFDs={
+            1: 1, 2: 2, CHILD_LISTEN_FD: self._socket.fileno(), CHILD_STATS_FD: 'r'})
+        process.started = self.clock.seconds()
+        self.running[index] = process
+
+    def process_ended(self, process, reason):
+        del self.running[process.index]
+        if self._stopped_d is not None:
+            if not self.running:
+                self._stopped_d.callback(None)
+            return
+        delay = self._restart_delays.get(process.index, RESTART_DELAY)
+        if process.started is not None and self.clock.seconds() - process.started >= MAX_RESTART_DELAY:
+            delay = RESTART_DELAY
+        self._restart_delays[process.index] = min(delay * 2, MAX_RESTART_DELAY)
+        log.warning("prism server process %i exited (%s), restarting it in %i seconds", process.index,
+                    reason.getErrorMessage(), delay)
+        self.restarts[process.index] = self.clock.callLater(delay, self.spawn, process.index)
+
+    def connections(self):
+        return sum(process.connections for process in self.running.values())
+
+    def open_files(self):
+        # those of the server processes holding the client connections and this one's
+        return sum(process.open_files for process in self.running.values()) + open_files()
+
+    def publish_stats(self):
+        d = publish_stats(self.cluster_storage, self.connections(), self.open_files())
+        d.addErrback(lambda err: log.warning("Failed to publish stats: %s", err.getErrorMessage()))
+        return d
+
+    def stopService(self):
+        if self._stats_loop is not None and self._stats_loop.running:
+            self._stats_loop.stop()
+        self._stopped_d = defer.Deferred()
+        for restart in self.restarts.values():
+            restart.cancel()
+        self.restarts.clear()
+        if not self.running:
+            self._stopped_d.callback(None)
+        for process in self.running.values():
+            process.transport.signalProcess('TERM')
+        self._socket.close()
+        return self._stopped_d
+
+
+def open_files():
+    return psutil.Process().num_fds()
+
+
 @defer.inlineCallbacks
-def enqueue_on_start():
-    cluster_storage = ClusterStorage()
-    sd_hashes = yield cluster_storage.get_all_unforwarded_sd_blobs()
-    for sd_hash in sd_hashes:
-        blobs = yield cluster_storage.get_blobs_for_stream(sd_hash)
-        enqueue_stream(sd_hash, len(blobs), cluster_storage.db_dir, build_prism_stream_client_factory)
-        log.info("enqueued stream {}".format(sd_hash))
+def publish_stats(cluster_storage, connections, open_files, interval=STATS_INTERVAL):
+    """
+    Publish a json snapshot of the cluster to STATS_SNAPSHOT for prism-supervisor.
+
+    The counts are read in one round trip from counters and set sizes that redis
+    keeps, nothing is listed or scanned. The snapshot expires if the server stops
+    publishing it.
+    """
+    batch = cluster_storage.db.batch()
+    batch.hlen(BLOB_HASHES)
+    batch.scard(CLUSTER_BLOBS)
+    batch.get(LOCAL_BLOB_BYTES)
+    batch.hgetall(HOST_BLOB_COUNTS)
+    batch.llen(QUEUE_KEY)
+    batch.llen(FAILED_QUEUE_KEY)
+    batch.scard(Worker.redis_workers_keys)
+    blobs, cluster_blobs, local_bytes, host_counts, queued, failed, workers = yield batch.execute()
+    snapshot = {
+        'time': reactor.seconds(),
+        'blobs': blobs,
+        'cluster_blobs': cluster_blobs,
+        'local_blobs': blobs - cluster_blobs,
+        'local_bytes': int(local_bytes or 0),
+        'hosts': dict((host, int(count)) for host, count in host_counts.items()),
+        'queued': queued,
+        'failed': failed,
+        'workers': workers,
+        'connections': connections,
+        'open_files': open_files,
+    }
+    batch.set(STATS_SNAPSHOT, json.dumps(snapshot))
+    batch.expire(STATS_SNAPSHOT, max(interval * 3, 1))
+    yield batch.execute()
+    defer.returnValue(snapshot)
+
+@defer.inlineCallbacks
+def enqueue_on_start(cluster_storage=None, rate=RECOVERY_RATE, clock=None):
+    """
+    Enqueue the streams that were received but not forwarded, while the server runs.
+
+    sd_blob_hashes is paged through with SSCAN, each page is checked against
+    cluster_blobs and its streams counted in one round trip, and the unforwarded
+    ones are enqueued in batches from a thread. Up to RECOVERY_CONCURRENCY
+    batches are enqueued while the next pages are read. A batch holds
+    RECOVERY_INTERVAL seconds worth of streams and waits until the streams
+    before it are within rate streams a second, so the rate applies from the
+    first stream.
+    """
+    cluster_storage = cluster_storage or ClusterStorage()
+    clock = clock or reactor
+    semaphore = defer.DeferredSemaphore(RECOVERY_CONCURRENCY)
+    batch_size = max(1, int(rate * RECOVERY_INTERVAL))
+    enqueued = []
+    pending = []
+    start = clock.seconds()
+    cursor, checked, submitted = 0, 0, 0
+    while True:
+        cursor, sd_hashes = yield cluster_storage.db.scan_sd_blobs(cursor, RECOVERY_PAGE_SIZE)
+        streams = yield cluster_storage.db.get_unforwarded_streams(sd_hashes)
+        checked += len(sd_hashes)
+        for i in range(0, len(streams), batch_size):
+            wait = submitted / float(rate) - (clock.seconds() - start)
+            if wait > 0:
+                yield task.deferLater(clock, wait, lambda: None)
+            yield semaphore.acquire()
+            batch = streams[i:i + batch_size]
+            d = threads.deferToThread(enqueue_streams, batch, cluster_storage.db_dir,
+                                      build_prism_stream_client_factory, cluster_storage._redis_address)
+            d.addCallback(lambda results: enqueued.extend(r for r in results if r))
+            d.addErrback(lambda err: log.error("Failed to enqueue streams: %s", err.getErrorMessage()))
+            d.addBoth(lambda _: semaphore.release())
+            pending.append(d)
+            submitted += len(batch)
+        log.info("checked %i streams, %i unforwarded, %i enqueued", checked, submitted, len(enqueued))
+        if cursor == 0:
+            break
+    yield defer.DeferredList(pending)
+    log.info("finished checking %i streams, enqueued %i of %i unforwarded streams in %.1f seconds",
+             checked, len(enqueued), submitted, clock.seconds() - start)
+
+
+def run_server_process(index, blob_dir=None, redis_address=None):
+    # a server process started by PrismServerSupervisor, the metrics and trace log
+    # of each process are kept apart by its index
+    if settings['metrics port']:
+        listen_metrics(settings['metrics port'] + index, settings['metrics listen'])
+    if TRACE_SAMPLE_RATE:
+        init_trace_log('%s.%i' % (TRACE_LOG_PATH, index))
+    prism_server = PrismServer(cluster_storage=ClusterStorage(blob_dir, redis_address), listen_fd=CHILD_LISTEN_FD,
+                               stats_fd=CHILD_STATS_FD)
+    reactor.addSystemEventTrigger("before", "startup", prism_server.startService)
+    reactor.addSystemEventTrigger("before", "shutdown", prism_server.stopService)
+    reactor.run()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Receive streams from reflector clients for the cluster")
+    parser.add_argument('--processes', type=int, default=SERVER_PROCESSES,
+                        help='processes accepting connections on the port, each runs on its own core')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--blob-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--redis', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    open_files_limit = raise_open_files_limit(settings['max open files'])
+    check_reactor_capacity(open_files_limit)
+
+    if args.child is not None:
+        return run_server_process(args.child, args.blob_dir, args.redis)
+
     # clear the failed task queue
     redis_connection = get_redis_connection(settings['redis server'])
     qfail = Queue("failed", connection=redis_connection)
     qfail.empty()
 
     # start up server
-    prism_server = PrismServer()
+    if args.processes > 1:
+        prism_server = PrismServerSupervisor(args.processes)
+    else:
+        if settings['metrics port']:
+            listen_metrics(settings['metrics port'], settings['metrics listen'])
+        if TRACE_SAMPLE_RATE:
+            init_trace_log()
+        prism_server = PrismServer()
     reactor.addSystemEventTrigger("before", "startup", prism_server.startService)
     reactor.addSystemEventTrigger("before", "shutdown", prism_server.stopService)
 
     # attempt to redistribute any local blobs
     if settings['enqueue on startup']:
-        d = enqueue_on_start()
+        reactor.callWhenRunning(enqueue_on_start)
     reactor.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
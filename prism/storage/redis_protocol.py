@@ -0,0 +1,333 @@
+import logging
+from collections import deque
+
+from redis.exceptions import ConnectionError, NoScriptError, ResponseError, InvalidResponse
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+
+from prism.storage.storage import RedisHelper
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 6379
+
+# redis-py method names that don't map directly to a redis command
+COMMAND_NAMES = {
+    'delete': ('DEL',),
+    'script_load': ('SCRIPT', 'LOAD'),
+}
+
+
+def _to_bool(reply):
+    return bool(reply)
+
+
+def _to_set(reply):
+    return set(reply) if reply is not None else set()
+
+
+def _to_dict(reply):
+    return dict(zip(reply[::2], reply[1::2]))
+
+
+def _to_ok(reply):
+    return reply == 'OK'
+
+
+def _to_scan(reply):
+    cursor, members = reply
+    return int(cursor), members
+
+
+# converts raw replies to the types returned by the equivalent redis-py methods
+RESPONSE_CALLBACKS = {
+    'exists': _to_bool,
+    'hexists': _to_bool,
+    'sismember': _to_bool,
+    'smembers': _to_set,
+    'sdiff': _to_set,
+    'sinter': _to_set,
+    'hgetall': _to_dict,
+    'set': _to_ok,
+    'sscan': _to_scan,
+    'hscan': lambda reply: (int(reply[0]), _to_dict(reply[1])),
+}
+
+_INCOMPLETE = object()
+
+
+class ReplyError(object):
+    def __init__(self, message):
+        self.message = message
+
+    def to_exception(self):
+        if self.message.startswith('NOSCRIPT'):
+            return NoScriptError(self.message)
+        return ResponseError(self.message)
+
+
+def encode_command(args):
+    out = ['*%i\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        elif isinstance(arg, float):
+            arg = repr(arg)
+        elif not isinstance(arg, str):
+            arg = str(arg)
+        out.append('$%i\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(out)
+
+
+def command_args(command, args):
+    return COMMAND_NAMES.get(command, (command.upper(),)) + tuple(args)
+
+
+class ReplyParser(object):
+    """
+    Incremental RESP parser. Data is fed in as it arrives and parsed once, the
+    position in the buffer and the arrays being read are kept between chunks.
+    Chunks are only joined once there are enough bytes for the reply they are
+    part of, so a large reply split over many reads is joined once
+    """
+
+    def __init__(self):
+        self._buff = ''
+        self._pos = 0
+        # chunks received since the buffer was last joined and their length
+        self._chunks = []
+        self._buffered = 0
+        # bytes from _pos the next element needs before it can be parsed
+        self._needed = 0
+        # [items left, items] of the arrays being read, innermost last
+        self._arrays = []
+
+    def feed(self, data):
+        """
+        Add data received from redis, returns a list of the replies completed
+        """
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if len(self._buff) - self._pos + self._buffered < self._needed:
+            return []
+        self._buff = self._buff[self._pos:] + ''.join(self._chunks)
+        self._pos = 0
+        self._chunks, self._buffered = [], 0
+        replies = []
+        while True:
+            item = self._parse_element()
+            if item is _INCOMPLETE:
+                break
+            while self._arrays and item is not _INCOMPLETE:
+                array = self._arrays[-1]
+                array[1].append(item)
+                array[0] -= 1
+                item = self._arrays.pop()[1] if not array[0] else _INCOMPLETE
+            if not self._arrays:
+                replies.append(item)
+        return replies
+
+    def _parse_element(self):
+        # returns the next reply or array item, or _INCOMPLETE if it isn't all
+        # here yet or if it was the header of an array, which is pushed
+        buff, pos = self._buff, self._pos
+        end = buff.find('\r\n', pos)
+        if end == -1:
+            self._needed = len(buff) - pos + 1
+            return _INCOMPLETE
+        prefix, line, next_pos = buff[pos], buff[pos + 1:end], end + 2
+        if prefix == '+':
+            item = line
+        elif prefix == '-':
+            item = ReplyError(line)
+        elif prefix == ':':
+            item = int(line)
+        elif prefix == '$':
+            length = int(line)
+            if length == -1:
+                item = None
+            elif len(buff) < next_pos + length + 2:
+                self._needed = next_pos + length + 2 - pos
+                return _INCOMPLETE
+            else:
+                item, next_pos = buff[next_pos:next_pos + length], next_pos + length + 2
+        elif prefix == '*':
+            count = int(line)
+            if count > 0:
+                self._arrays.append([count, []])
+                self._pos = next_pos
+                return self._parse_element()
+            item = None if count == -1 else []
+        else:
+            raise InvalidResponse("Protocol error, got %r as reply type byte" % prefix)
+        self._pos = next_pos
+        self._needed = 0
+        return item
+
+
+class RedisProtocol(Protocol):
+    """
+    Pipelining RESP client, any number of commands may be outstanding and replies
+    are matched to them in order
+    """
+
+    def __init__(self):
+        self._parser = ReplyParser()
+        # (deferred, [callbacks], [replies]) per outstanding request
+        self._pending = deque()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def connectionMade(self):
+        self.factory.pool.connection_ready(self)
+
+    def connectionLost(self, reason=None):
+        self.factory.pool.connection_lost(self)
+        pending, self._pending = self._pending, deque()
+        for d, _, _ in pending:
+            d.errback(ConnectionError("Lost connection to redis: %s" % reason))
+
+    def dataReceived(self, data):
+        for reply in self._parser.feed(data):
+            if not self._pending:
+                log.warning("Unexpected reply from redis: %r", reply)
+                continue
+            d, callbacks, replies = self._pending[0]
+            replies.append(reply)
+            if len(replies) == len(callbacks):
+                self._pending.popleft()
+                self._fire(d, callbacks, replies)
+
+    def _fire(self, d, callbacks, replies):
+        results = []
+        for callback, reply in zip(callbacks, replies):
+            if isinstance(reply, ReplyError):
+                return d.errback(reply.to_exception())
+            results.append(callback(reply) if callback is not None else reply)
+        d.callback(results)
+
+    def execute_commands(self, commands):
+        """
+        Send commands, a list of (redis-py method name, args), in one write.
+        Returns a deferred that fires with the list of their replies
+        """
+        d = defer.Deferred()
+        self._pending.append((d, [RESPONSE_CALLBACKS.get(c) for c, _ in commands], []))
+        self.transport.write(''.join(encode_command(command_args(c, a)) for c, a in commands))
+        return d
+
+
+class RedisClientFactory(ReconnectingClientFactory):
+    protocol = RedisProtocol
+    maxDelay = 10
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return ReconnectingClientFactory.buildProtocol(self, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        log.warning("Failed to connect to redis: %s", reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+
+class RedisConnectionPool(object):
+    """
+    A small pool of reconnecting redis connections, each request goes on the
+    connected protocol with the fewest outstanding replies. Requests made while
+    none is connected wait up to connect_timeout seconds for one
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, size=4, connect_timeout=10, _reactor=reactor):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self._reactor = _reactor
+        self._factories = []
+        self._connections = []
+        # deferreds waiting for a connection to be made
+        self._waiting = deque()
+
+    def connect(self):
+        for _ in range(self.size):
+            factory = RedisClientFactory(self)
+            self._factories.append(factory)
+            self._reactor.connectTCP(self.host, self.port, factory, timeout=self.connect_timeout)
+
+    def disconnect(self):
+        for factory in self._factories:
+            factory.stopTrying()
+        for connection in list(self._connections):
+            connection.transport.loseConnection()
+
+    def connection_ready(self, connection):
+        self._connections.append(connection)
+        waiting, self._waiting = self._waiting, deque()
+        for d in waiting:
+            d.callback(None)
+
+    def connection_lost(self, connection):
+        if connection in self._connections:
+            self._connections.remove(connection)
+
+    def _get_connection(self):
+        if self._connections:
+            return defer.succeed(min(self._connections, key=lambda c: c.pending))
+        d = defer.Deferred(lambda d: self._waiting.remove(d))
+        self._waiting.append(d)
+        timeout = self._reactor.callLater(self.connect_timeout, self._timed_out, d)
+
+        def _stop_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        d.addBoth(_stop_timeout)
+        d.addCallback(lambda _: self._get_connection())
+        return d
+
+    def _timed_out(self, d):
+        self._waiting.remove(d)
+        d.errback(ConnectionError("Timed out waiting for a connection to redis at %s:%i" % (self.host, self.port)))
+
+    def execute_commands(self, commands):
+        d = self._get_connection()
+        d.addCallback(lambda connection: connection.execute_commands(commands))
+        return d
+
+
+def parse_redis_address(redis_address):
+    if ":" in redis_address:
+        host, port = redis_address.split(":")
+        return host, int(port)
+    return redis_address, DEFAULT_PORT
+
+
+class ReactorRedisHelper(RedisHelper):
+    """
+    RedisHelper that speaks RESP to redis on the reactor instead of sending
+    every command through the threadpool
+    """
+
+    def __init__(self, redis_address, pool_size=4, layout=None, connect_timeout=10):
+        RedisHelper.__init__(self, redis_address, layout)
+        host, port = parse_redis_address(redis_address)
+        self.pool = RedisConnectionPool(host, port, pool_size, connect_timeout)
+        self.pool.connect()
+
+    def _send_command(self, command, args):
+        d = self.pool.execute_commands([(command, args)])
+        d.addCallback(lambda results: results[0])
+        return d
+
+    def _send_batch(self, commands):
+        return self.pool.execute_commands(commands)
+
+    def sscan(self, name, cursor=0, count=None):
+        args = (name, cursor) if count is None else (name, cursor, 'COUNT', count)
+        return self.execute_command('sscan', *args)
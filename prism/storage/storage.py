@@ -1,8 +1,12 @@
 import os
 import json
+import errno
 import logging
 import time
+import hashlib
+import struct
 from redis import Redis
+from redis.exceptions import NoScriptError
 
 from lbrynet.blob.blob_file import BlobFile
 from lbrynet.core.utils import is_valid_blobhash
@@ -12,18 +16,40 @@ from twisted.internet import defer, threads
 from prism.config import get_settings
 from prism.constants import BLOB_HASH_LENGTH
 from prism.error import InvalidBlobHashError
+from prism.metrics import REDIS_LATENCY
+from prism.storage.verification import VerificationCache, record_matches, stat_key
 
 log = logging.getLogger(__name__)
 
 conf = get_settings()
 
 # table names
-# contains all blob hashes (including SD blob hashes), value is json encoded length, timestamp, host
+# contains all blob hashes (including SD blob hashes), value is length, timestamp, host
+# packed with BLOB_RECORD, entries written before that are json encoded
 BLOB_HASHES = "blob_hashes"
+# the ids hosts are stored as in blob_hashes, host: id and id: host
+HOST_IDS = "host_ids"
+HOST_NAMES = "host_names"
+# last host id given out
+HOST_ID_COUNTER = "host_id_counter"
 # contains blob hases that have been sent to a reflector node
 CLUSTER_BLOBS = "cluster_blobs"
 # contain all SD blob hashes
 SD_BLOB_HASHES = "sd_blob_hashes"
+# blobs that were verified when they were received and are stored locally,
+# value is json encoded length, mtime, inode of the blob file
+VERIFIED_BLOBS = "verified_blobs"
+# number of blobs on each host, kept up to date with the host tables so hosts
+# can be picked without counting their tables
+HOST_BLOB_COUNTS = "host_blob_counts"
+# lease taken while a stream is being enqueued, the key is the prefix and the sd hash
+STREAM_LOCK_PREFIX = "stream_lock:"
+# number of stream jobs that weren't enqueued because the stream already had one
+SUPPRESSED_STREAM_JOBS = "suppressed_stream_jobs"
+# total length of the blobs that are stored locally and not on a host
+LOCAL_BLOB_BYTES = "local_blob_bytes"
+# json snapshot of the cluster counters, published by prism-server
+STATS_SNAPSHOT = "prism_stats"
 # each sd_blob_hash is its own table, stores blobs is stream
 # each host is its own table, stores all blob hashes it has
 
@@ -32,7 +58,82 @@ SD_BLOB_HASHES = "sd_blob_hashes"
 CLUSTER_NODE_ADDRESSES = conf['hosts']
 MAX_BLOBS_PER_HOST = conf['max blobs']
 
+# version, length, timestamp, host id (0 for none) of a blob_hashes entry
+BLOB_RECORD = struct.Struct('>BIdH')
+BLOB_RECORD_VERSION = 1
+
 REDIS_ADDRESS = conf['redis server']
+BLOB_DIR_LEVELS = conf['blob directory levels']
+BLOB_DIR_FALLBACK = conf['blob directory fallback']
+# hex characters of the blob hash naming each level of blob subdirectories
+BLOB_DIR_PREFIX_LENGTH = 2
+STORAGE_LAYOUT = conf['storage layout']
+REDIS_CLIENT = conf['redis client']
+REDIS_CONNECTIONS = conf['redis connections']
+REDIS_CONNECT_TIMEOUT = conf['redis connect timeout']
+VERIFICATION_CACHE_SIZE = conf['verification cache size']
+
+
+class RedisScript(object):
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+
+# Returns {number of blobs checked, {blob hashes missing from the cluster}}.
+# KEYS are cluster_blobs, blob_hashes and optionally a stream set whose members
+# are checked, otherwise the blob hashes to check are ARGV[2:]. If ARGV[1] is "1"
+# blobs that are stored locally (in blob_hashes) are not counted as missing.
+MISSING_BLOBS_SCRIPT = RedisScript("""
+local check_local = ARGV[1] == '1'
+local blob_hashes
+if #KEYS == 3 then
+    blob_hashes = redis.call('SMEMBERS', KEYS[3])
+else
+    blob_hashes = {}
+    for i = 2, #ARGV do
+        blob_hashes[#blob_hashes + 1] = ARGV[i]
+    end
+end
+local missing = {}
+for _, blob_hash in ipairs(blob_hashes) do
+    if redis.call('SISMEMBER', KEYS[1], blob_hash) == 0 then
+        if not check_local or redis.call('HEXISTS', KEYS[2], blob_hash) == 0 then
+            missing[#missing + 1] = blob_hash
+        end
+    end
+end
+return {#blob_hashes, missing}
+""")
+
+
+# Returns 1 if the blob_hashes entry was created. KEYS are blob_hashes,
+# verified_blobs and local_blob_bytes, ARGV is the blob hash, its entry, its
+# verification record or "" for none, and its length, which is added to
+# local_blob_bytes only for a new entry.
+COMPLETED_BLOB_SCRIPT = RedisScript("""
+local created = redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+end
+if created == 1 then
+    redis.call('INCRBY', KEYS[3], ARGV[4])
+end
+return created
+""")
+
+
+# Returns the blob count of a host, set from the size of its table if it has
+# none. KEYS are host_blob_counts and the host's table, ARGV is the host.
+INIT_HOST_COUNT_SCRIPT = RedisScript("""
+redis.call('HSETNX', KEYS[1], ARGV[1], redis.call('SCARD', KEYS[2]))
+return redis.call('HGET', KEYS[1], ARGV[1])
+""")
+
+
+def is_packed_blob(blob_val):
+    # json entries start with "[" or a digit
+    return len(blob_val) == BLOB_RECORD.size and ord(blob_val[0]) == BLOB_RECORD_VERSION
 
 
 def get_redis_connection(address):
@@ -44,130 +145,583 @@ def get_redis_connection(address):
         return Redis(address)
 
 
+class RedisBatch(object):
+    """
+    Queue of redis commands that are sent to the server in a single pipelined
+    round trip, execute() returns a deferred that fires with a list of the
+    results in the order the commands were queued
+    """
+
+    def __init__(self, helper):
+        self._helper = helper
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def _queue(self, command, *args):
+        self.commands.append((command, args))
+        return self
+
+    def delete(self, key):
+        return self._queue('delete', key)
+
+    def get(self, name):
+        return self._queue('get', name)
+
+    def set(self, name, value):
+        return self._queue('set', name, value)
+
+    def expire(self, name, seconds):
+        return self._queue('expire', name, seconds)
+
+    def incrby(self, name, amount):
+        return self._queue('incrby', name, amount)
+
+    def llen(self, name):
+        return self._queue('llen', name)
+
+    def hget(self, name, key):
+        return self._queue('hget', name, key)
+
+    def hlen(self, name):
+        return self._queue('hlen', name)
+
+    def hgetall(self, name):
+        return self._queue('hgetall', name)
+
+    def hset(self, name, key, value):
+        return self._queue('hset', name, key, value)
+
+    def hdel(self, name, *keys):
+        return self._queue('hdel', name, *keys)
+
+    def hexists(self, name, key):
+        return self._queue('hexists', name, key)
+
+    def hmget(self, name, keys):
+        # keys is a list as with redis-py, the reactor client sends each as an argument
+        return self._queue('hmget', name, *keys)
+
+    def hsetnx(self, name, key, value):
+        return self._queue('hsetnx', name, key, value)
+
+    def hincrby(self, name, key, amount):
+        return self._queue('hincrby', name, key, amount)
+
+    def sismember(self, name, value):
+        return self._queue('sismember', name, value)
+
+    def smembers(self, name):
+        return self._queue('smembers', name)
+
+    def sadd(self, name, *values):
+        return self._queue('sadd', name, *values)
+
+    def srem(self, name, *values):
+        return self._queue('srem', name, *values)
+
+    def scard(self, name):
+        return self._queue('scard', name)
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return defer.succeed([])
+        return self._helper.execute_batch(commands)
+
+
 class RedisHelper(object):
-    def __init__(self, redis_address):
+    # [count] of the commands and batches sent, set on a copy of the helper to
+    # count the calls made through it, see prism.tracing
+    call_counter = None
+
+    def __init__(self, redis_address, layout=None):
         self.db = get_redis_connection(redis_address)
+        # "raw" stores blob hashes in the tables as their 48 byte digests, the
+        # tables are converted with scripts/migrate_storage_layout.py
+        self.layout = layout or STORAGE_LAYOUT
+        if self.layout not in ('hex', 'raw'):
+            raise ValueError("unknown storage layout: %s" % self.layout)
         if redis_address == 'fake':
             # fakeredis is not thread safe
             self.defer_func = defer.execute
+            # and it has no lua support
+            self.scripting = False
         else:
             self.defer_func = threads.deferToThread
+            self.scripting = True
+        # host: id and id: host of the hosts in HOST_IDS seen by this process
+        self._host_ids = {}
+        self._host_names = {}
+
+    def _execute_pipeline(self, commands):
+        pipe = self.db.pipeline(transaction=False)
+        for command, args in commands:
+            getattr(pipe, command)(*args)
+        return pipe.execute()
+
+    def _send_command(self, command, args):
+        return self.defer_func(getattr(self.db, command), *args)
+
+    def _send_batch(self, commands):
+        # all of the commands are run in one thread hop and one round trip
+        return self.defer_func(self._execute_pipeline, commands)
+
+    def _timed(self, d, command, start):
+        if self.call_counter is not None:
+            self.call_counter[0] += 1
+        latency = REDIS_LATENCY.labels(command)
+
+        def _observe(result):
+            latency.observe(time.time() - start)
+            return result
+        return d.addBoth(_observe)
+
+    def execute_command(self, command, *args):
+        return self._timed(self._send_command(command, args), command, time.time())
+
+    def execute_batch(self, commands):
+        return self._timed(self._send_batch(commands), 'pipeline', time.time())
+
+    def batch(self):
+        return RedisBatch(self)
 
     def delete(self, key):
-        return self.defer_func(self.db.delete, key)
+        return self.execute_command('delete', key)
 
     def hget(self, name, key):
-        return self.defer_func(self.db.hget, name, key)
+        return self.execute_command('hget', name, key)
 
     def hset(self, name, key, value):
-        return self.defer_func(self.db.hset, name, key, value)
+        return self.execute_command('hset', name, key, value)
 
     def hdel(self, name, *keys):
-        return self.defer_func(self.db.hdel, name, *keys)
+        return self.execute_command('hdel', name, *keys)
 
     def hexists(self, name, key):
-        return self.defer_func(self.db.hexists, name, key)
+        return self.execute_command('hexists', name, key)
 
     def sismember(self, name, value):
-        return self.defer_func(self.db.sismember, name, value)
+        return self.execute_command('sismember', name, value)
 
     def smembers(self, name):
-        return self.defer_func(self.db.smembers, name)
+        return self.execute_command('smembers', name)
 
     def sadd(self, name, *values):
-        return self.defer_func(self.db.sadd, name, *values)
+        return self.execute_command('sadd', name, *values)
 
     def srem(self, name, *values):
-        return self.defer_func(self.db.srem, name, *values)
+        return self.execute_command('srem', name, *values)
 
     def sdiff(self, name, *values):
-        return self.defer_func(self.db.sdiff, name, *values)
+        return self.execute_command('sdiff', name, *values)
 
     def scard(self, name):
-        return self.defer_func(self.db.scard, name)
+        return self.execute_command('scard', name)
+
+    def hgetall(self, name):
+        return self.execute_command('hgetall', name)
+
+    def incr(self, name):
+        return self.execute_command('incr', name)
 
     def sinter(self, name1, name2):
-        return self.defer_func(self.db.sinter, name1, name2)
+        return self.execute_command('sinter', name1, name2)
+
+    def sscan(self, name, cursor=0, count=None):
+        return self.execute_command('sscan', name, cursor, None, count)
+
+    def evalsha(self, sha, keys, args):
+        return self.execute_command('evalsha', sha, len(keys), *(tuple(keys) + tuple(args)))
+
+    def script_load(self, source):
+        return self.execute_command('script_load', source)
+
+    @defer.inlineCallbacks
+    def run_script(self, script, keys, args):
+        # scripts are loaded the first time they are run, or after redis restarts
+        try:
+            result = yield self.evalsha(script.sha, keys, args)
+        except NoScriptError:
+            log.debug("loading script %s", script.sha)
+            yield self.script_load(script.source)
+            result = yield self.evalsha(script.sha, keys, args)
+        defer.returnValue(result)
+
+    def encode_hash(self, blob_hash):
+        # blob hash as it is stored in the tables, keys stay hex
+        return blob_hash.decode('hex') if self.layout == 'raw' else blob_hash
+
+    def encode_hashes(self, blob_hashes):
+        return [self.encode_hash(blob_hash) for blob_hash in blob_hashes]
+
+    def decode_hash(self, member):
+        return member.encode('hex') if self.layout == 'raw' else member
+
+    def decode_hashes(self, members):
+        return [self.decode_hash(member) for member in members]
+
+    def _encode_blob(self, blob_length, timestamp, host):
+        # the host needs an id from get_host_id first
+        host_id = self._host_ids[host] if host else 0
+        return BLOB_RECORD.pack(BLOB_RECORD_VERSION, blob_length, timestamp, host_id)
+
+    def _decode_blob(self, blob_val):
+        # raises KeyError for host ids this process hasn't loaded, see decode_blobs
+        if is_packed_blob(blob_val):
+            version, length, timestamp, host_id = BLOB_RECORD.unpack(blob_val)
+            return length, timestamp, self._host_names[host_id] if host_id else ''
+        try:
+            [length, timestamp, host] = json.loads(blob_val)
+        except TypeError as e:
+            # older blob entries just had length as blob_val
+            length = int(blob_val)
+            timestamp = 0
+            host = ''
+        return length, timestamp, host
+
+    @defer.inlineCallbacks
+    def decode_blobs(self, blob_vals):
+        # returns (length, timestamp, host) or None for each blob_hashes value,
+        # the host table is reloaded if an entry has a host added by another process
+        try:
+            decoded = [self._decode_blob(blob_val) if blob_val is not None else None for blob_val in blob_vals]
+        except KeyError:
+            yield self.load_host_table()
+            decoded = [self._decode_blob(blob_val) if blob_val is not None else None for blob_val in blob_vals]
+        defer.returnValue(decoded)
+
+    @defer.inlineCallbacks
+    def load_host_table(self):
+        host_names = yield self.hgetall(HOST_NAMES)
+        for host_id, host in host_names.items():
+            self._host_ids[host] = int(host_id)
+            self._host_names[int(host_id)] = host
+
+    @defer.inlineCallbacks
+    def get_host_id(self, host):
+        # ids are given out with INCR, the id: host entry is written before the
+        # host: id entry so any id found in a blob entry can be looked up
+        if host not in self._host_ids:
+            host_id = yield self.hget(HOST_IDS, host)
+            if host_id is None:
+                new_id = yield self.incr(HOST_ID_COUNTER)
+                if new_id >= 2 ** 16:
+                    raise Exception("too many host ids")
+                batch = self.batch()
+                batch.hset(HOST_NAMES, new_id, host)
+                batch.hsetnx(HOST_IDS, host, new_id)
+                batch.hget(HOST_IDS, host)
+                results = yield batch.execute()
+                host_id = results[2]
+            self._host_ids[host] = int(host_id)
+            self._host_names[int(host_id)] = host
+        defer.returnValue(self._host_ids[host])
+
+    def _encode_verified(self, blob_length, mtime, inode):
+        return json.dumps([blob_length, mtime, inode])
+
+    def _decode_verified(self, verified_val):
+        record = json.loads(verified_val)
+        if len(record) == 2:
+            # records without the inode
+            return record[0], record[1], None
+        length, mtime, inode = record
+        return length, mtime, inode
 
     @defer.inlineCallbacks
     def is_sd_blob(self, blob_hash):
-        out = yield self.sismember(SD_BLOB_HASHES, blob_hash)
+        out = yield self.sismember(SD_BLOB_HASHES, self.encode_hash(blob_hash))
         defer.returnValue(out)
 
     @defer.inlineCallbacks
     def add_blob_to_host(self, blob_hash, host):
-        yield self.sadd(host, blob_hash)
-        yield self.sadd(CLUSTER_BLOBS, blob_hash)
-        length, timestamp, prev_host = yield self.get_blob(blob_hash)
-        yield self.set_blob(blob_hash, length, timestamp, host)
+        yield self.add_blobs_to_host([blob_hash], host)
+
+    @defer.inlineCallbacks
+    def add_blobs_to_host(self, blob_hashes, host):
+        # the host sets are updated and the blob entries are read in one round
+        # trip, the updated blob entries and host count are written back in a
+        # second one. Returns the total length of the blobs
+        if not blob_hashes:
+            defer.returnValue(0)
+        yield self.get_host_id(host)
+        members = self.encode_hashes(blob_hashes)
+        batch = self.batch()
+        batch.sadd(host, *members)
+        batch.sadd(CLUSTER_BLOBS, *members)
+        batch.hexists(HOST_BLOB_COUNTS, host)
+        for member in members:
+            batch.hget(BLOB_HASHES, member)
+        results = yield batch.execute()
+        added, counted = results[0], results[2]
+        blobs = yield self.decode_blobs(results[3:])
+        local_bytes, total_bytes = 0, 0
+        for member, blob in zip(members, blobs):
+            if blob is None:
+                raise Exception("Blob does not exist")
+            length, timestamp, prev_host = blob
+            total_bytes += length
+            if not prev_host:
+                local_bytes += length
+            batch.hset(BLOB_HASHES, member, self._encode_blob(length, timestamp, host))
+        # the local copies are removed once they are on a host
+        batch.hdel(VERIFIED_BLOBS, *members)
+        if local_bytes:
+            batch.incrby(LOCAL_BLOB_BYTES, -local_bytes)
+        if counted:
+            batch.hincrby(HOST_BLOB_COUNTS, host, added)
+        yield batch.execute()
+        if not counted:
+            yield self.init_host_count(host)
+        defer.returnValue(total_bytes)
 
     @defer.inlineCallbacks
     def add_sd_blob(self, sd_blob_hash, blob_hashes):
-        yield self.sadd(sd_blob_hash, *tuple(blob_hashes))
-        yield self.sadd(SD_BLOB_HASHES, sd_blob_hash)
+        batch = self.batch()
+        batch.sadd(sd_blob_hash, *self.encode_hashes(blob_hashes))
+        batch.sadd(SD_BLOB_HASHES, self.encode_hash(sd_blob_hash))
+        yield batch.execute()
 
     @defer.inlineCallbacks
     def blob_exists(self, blob_hash):
-        exists = yield self.hexists(BLOB_HASHES, blob_hash)
+        exists = yield self.hexists(BLOB_HASHES, self.encode_hash(blob_hash))
         defer.returnValue(exists)
 
     @defer.inlineCallbacks
     def blob_has_been_forwarded_to_host(self, blob_hash):
-        sent_to_host = yield self.sismember(CLUSTER_BLOBS, blob_hash)
+        sent_to_host = yield self.sismember(CLUSTER_BLOBS, self.encode_hash(blob_hash))
         defer.returnValue(sent_to_host)
 
     @defer.inlineCallbacks
     def get_all_unforwarded_sd_blobs(self):
         # returns a set of sd_blob hashes that have not been sent to a host
         out = yield self.sdiff(SD_BLOB_HASHES, CLUSTER_BLOBS)
-        defer.returnValue(out)
+        defer.returnValue(set(self.decode_hashes(out)))
+
+    @defer.inlineCallbacks
+    def get_unforwarded_streams(self, sd_hashes):
+        # returns [(sd_hash, number of blobs in the stream)] for the streams in
+        # sd_hashes that have not been sent to a host, in one round trip
+        batch = self.batch()
+        for sd_hash in sd_hashes:
+            batch.sismember(CLUSTER_BLOBS, self.encode_hash(sd_hash))
+            batch.scard(sd_hash)
+        results = yield batch.execute()
+        defer.returnValue([(sd_hash, count) for sd_hash, forwarded, count
+                           in zip(sd_hashes, results[::2], results[1::2]) if not forwarded])
 
     @defer.inlineCallbacks
     def get_blobs_for_stream(self, sd_hash):
         blobs_in_stream = yield self.smembers(sd_hash)
-        defer.returnValue(blobs_in_stream)
+        defer.returnValue(set(self.decode_hashes(blobs_in_stream)))
+
+    @defer.inlineCallbacks
+    def scan_sd_blobs(self, cursor=0, count=None):
+        # returns (next cursor, page of sd hashes), the cursor is 0 after the last page
+        cursor, members = yield self.sscan(SD_BLOB_HASHES, cursor, count)
+        defer.returnValue((cursor, self.decode_hashes(members)))
+
+    @defer.inlineCallbacks
+    def find_missing_blobs(self, sd_hash=None, blob_hashes=None, check_local=True):
+        """
+        Return (number of blobs checked, list of blob hashes not in the cluster) for
+        the blobs in the stream with sd_hash, or for blob_hashes if given.
+        If check_local is True blobs that are stored locally are not missing.
+        """
+        if self.scripting:
+            keys = [CLUSTER_BLOBS, BLOB_HASHES]
+            args = ['1' if check_local else '0']
+            if blob_hashes is None:
+                keys.append(sd_hash)
+            else:
+                args.extend(self.encode_hashes(blob_hashes))
+            num_blobs, missing = yield self.run_script(MISSING_BLOBS_SCRIPT, keys, args)
+            defer.returnValue((num_blobs, self.decode_hashes(missing)))
+
+        if blob_hashes is None:
+            blob_hashes = yield self.get_blobs_for_stream(sd_hash)
+        blob_hashes = list(blob_hashes)
+        batch = self.batch()
+        for member in self.encode_hashes(blob_hashes):
+            batch.sismember(CLUSTER_BLOBS, member)
+            batch.hexists(BLOB_HASHES, member)
+        results = yield batch.execute()
+        missing = []
+        for i, blob_hash in enumerate(blob_hashes):
+            in_cluster, exists_locally = results[2 * i], results[2 * i + 1]
+            if not in_cluster and not (check_local and exists_locally):
+                missing.append(blob_hash)
+        defer.returnValue((len(blob_hashes), missing))
 
     @defer.inlineCallbacks
     def set_blob(self, blob_hash, blob_length, timestamp, host=''):
-        blob_val = json.dumps([blob_length, timestamp, host])
-        was_set = yield self.hset(BLOB_HASHES, blob_hash, blob_val)
+        if host:
+            yield self.get_host_id(host)
+        blob_val = self._encode_blob(blob_length, timestamp, host)
+        was_set = yield self.hset(BLOB_HASHES, self.encode_hash(blob_hash), blob_val)
         defer.returnValue(was_set)
 
+    @defer.inlineCallbacks
+    def set_completed_blob(self, blob_hash, blob_length, timestamp, mtime, inode):
+        # record the blob along with its verification in one round trip, blobs
+        # without a file to stat (mtime None) are verified when they're next read.
+        # Only a new entry adds to the local bytes, a blob received again is
+        # already counted
+        member = self.encode_hash(blob_hash)
+        blob_val = self._encode_blob(blob_length, timestamp, '')
+        verified_val = self._encode_verified(blob_length, mtime, inode) if mtime is not None else ''
+        if self.scripting:
+            created = yield self.run_script(COMPLETED_BLOB_SCRIPT, [BLOB_HASHES, VERIFIED_BLOBS, LOCAL_BLOB_BYTES],
+                                            [member, blob_val, verified_val, blob_length])
+            defer.returnValue(created)
+        batch = self.batch()
+        batch.hset(BLOB_HASHES, member, blob_val)
+        if verified_val:
+            batch.hset(VERIFIED_BLOBS, member, verified_val)
+        results = yield batch.execute()
+        if results[0]:
+            yield self.batch().incrby(LOCAL_BLOB_BYTES, blob_length).execute()
+        defer.returnValue(results[0])
+
+    @defer.inlineCallbacks
+    def set_verified_blobs(self, verified_blobs):
+        # verified_blobs is a list of (blob_hash, length, mtime, inode)
+        batch = self.batch()
+        for blob_hash, blob_length, mtime, inode in verified_blobs:
+            batch.hset(VERIFIED_BLOBS, self.encode_hash(blob_hash), self._encode_verified(blob_length, mtime, inode))
+        yield batch.execute()
+
+    @defer.inlineCallbacks
+    def get_blob_states(self, blob_hashes):
+        """
+        Return {blob_hash: (blob entry or None, in cluster, verification record or None)}
+        for blob_hashes in one round trip
+        """
+        batch = self.batch()
+        for member in self.encode_hashes(blob_hashes):
+            batch.hget(BLOB_HASHES, member)
+            batch.sismember(CLUSTER_BLOBS, member)
+            batch.hget(VERIFIED_BLOBS, member)
+        results = yield batch.execute()
+        blobs = yield self.decode_blobs(results[::3])
+        states = {}
+        for i, blob_hash in enumerate(blob_hashes):
+            blob_val, in_cluster, verified_val = results[3 * i:3 * i + 3]
+            states[blob_hash] = (
+                blobs[i],
+                in_cluster,
+                self._decode_verified(verified_val) if verified_val is not None else None,
+            )
+        defer.returnValue(states)
+
+    @defer.inlineCallbacks
+    def find_blob(self, blob_hash):
+        # returns (length, timestamp, host), or None if the blob does not exist
+        blob_val = yield self.hget(BLOB_HASHES, self.encode_hash(blob_hash))
+        blobs = yield self.decode_blobs([blob_val])
+        defer.returnValue(blobs[0])
+
     @defer.inlineCallbacks
     def get_blob(self, blob_hash):
-        blob_val = yield self.hget(BLOB_HASHES, blob_hash)
-        if blob_val is None:
+        blob = yield self.find_blob(blob_hash)
+        if blob is None:
             raise Exception("Blob does not exist")
-        try:
-            [length, timestamp, host] = json.loads(blob_val)
-        except TypeError as e:
-            # older blob entries just had length as blob_val
-            length = int(blob_val)
-            timestamp = 0
-            host = ''
-        defer.returnValue((length, timestamp, host))
+        defer.returnValue(blob)
+
+    @defer.inlineCallbacks
+    def get_blob_info(self, blob_hash):
+        # returns ((length, timestamp, host) or None, is_sd_blob) in one round trip
+        member = self.encode_hash(blob_hash)
+        batch = self.batch()
+        batch.hget(BLOB_HASHES, member)
+        batch.sismember(SD_BLOB_HASHES, member)
+        blob_val, is_sd_blob = yield batch.execute()
+        blobs = yield self.decode_blobs([blob_val])
+        defer.returnValue((blobs[0], is_sd_blob))
 
     @defer.inlineCallbacks
-    def delete_blob(self, blob_hash):
-        was_deleted = yield self.hdel(BLOB_HASHES, blob_hash)
-        defer.returnValue(was_deleted)
+    def delete_blob(self, blob_hash, is_sd_blob=False, local_length=0):
+        # if the blob is an sd blob its stream entries are removed in the same round
+        # trip, local_length is the length of the blob if it was stored locally
+        member = self.encode_hash(blob_hash)
+        batch = self.batch()
+        batch.hdel(BLOB_HASHES, member)
+        batch.hdel(VERIFIED_BLOBS, member)
+        if local_length:
+            batch.incrby(LOCAL_BLOB_BYTES, -local_length)
+        if is_sd_blob:
+            batch.srem(SD_BLOB_HASHES, member)
+            batch.delete(blob_hash)
+        results = yield batch.execute()
+        defer.returnValue(results[0])
 
     @defer.inlineCallbacks
     def delete_blob_from_host(self, blob_hash, host):
         # set blob so that its no longer in a host
-        yield self.srem(CLUSTER_BLOBS, blob_hash)
-        yield self.srem(host, blob_hash)
+        member = self.encode_hash(blob_hash)
+        batch = self.batch()
+        batch.srem(CLUSTER_BLOBS, member)
+        batch.srem(host, member)
+        batch.hexists(HOST_BLOB_COUNTS, host)
+        results = yield batch.execute()
+        yield self._removed_from_host(host, *results[1:])
+
+    @defer.inlineCallbacks
+    def reset_blob_host(self, blob_hash, blob_length, timestamp, host):
+        # clear the host from the blob entry and remove the blob from the host
+        # in one round trip
+        member = self.encode_hash(blob_hash)
+        batch = self.batch()
+        batch.hset(BLOB_HASHES, member, self._encode_blob(blob_length, timestamp, ''))
+        batch.incrby(LOCAL_BLOB_BYTES, blob_length)
+        batch.srem(CLUSTER_BLOBS, member)
+        batch.srem(host, member)
+        batch.hexists(HOST_BLOB_COUNTS, host)
+        results = yield batch.execute()
+        yield self._removed_from_host(host, *results[3:])
+
+    def _removed_from_host(self, host, removed, counted):
+        # hosts without a count yet get one from their table when it's first read
+        if removed and counted:
+            return self.batch().hincrby(HOST_BLOB_COUNTS, host, -removed).execute()
+        return defer.succeed(None)
 
     @defer.inlineCallbacks
     def delete_sd_blob(self, blob_hash):
-        yield self.srem(SD_BLOB_HASHES, blob_hash)
-        yield self.delete(blob_hash)
+        batch = self.batch()
+        batch.srem(SD_BLOB_HASHES, self.encode_hash(blob_hash))
+        batch.delete(blob_hash)
+        yield batch.execute()
+
+    @defer.inlineCallbacks
+    def get_stream_blob_count(self, sd_hash):
+        count = yield self.scard(sd_hash)
+        defer.returnValue(count)
 
     @defer.inlineCallbacks
     def get_host_count(self, host):
         # get number of blobs on host
+        count = yield self.hget(HOST_BLOB_COUNTS, host)
+        if count is None:
+            count = yield self.init_host_count(host)
+        defer.returnValue(int(count))
+
+    @defer.inlineCallbacks
+    def init_host_count(self, host):
+        # hosts that had blobs before their counts were kept start from the size
+        # of their table, read and set in one script so a blob added to the host
+        # in between can't be missed. HSETNX leaves a count another process set
+        if self.scripting:
+            count = yield self.run_script(INIT_HOST_COUNT_SCRIPT, [HOST_BLOB_COUNTS, host], [host])
+            defer.returnValue(int(count))
         count = yield self.scard(host)
-        defer.returnValue(count)
+        batch = self.batch()
+        batch.hsetnx(HOST_BLOB_COUNTS, host, count)
+        batch.hget(HOST_BLOB_COUNTS, host)
+        results = yield batch.execute()
+        defer.returnValue(int(results[1]))
 
     @defer.inlineCallbacks
     def get_host_stream_count(self, host):
@@ -175,13 +729,72 @@ class RedisHelper(object):
         defer.returnValue(len(blobs))
 
 
+def get_redis_helper(redis_address, client=None, layout=None):
+    client = client or REDIS_CLIENT
+    if client not in ('thread', 'reactor'):
+        raise ValueError("unknown redis client: %s" % client)
+    if client == 'reactor' and redis_address != 'fake':
+        from prism.storage.redis_protocol import ReactorRedisHelper
+        return ReactorRedisHelper(redis_address, REDIS_CONNECTIONS, layout, REDIS_CONNECT_TIMEOUT)
+    return RedisHelper(redis_address, layout)
+
+
+def blob_subdir(blob_hash, levels):
+    # directory of the blob relative to the blob directory, '' for a flat layout
+    prefixes = [blob_hash[i:i + BLOB_DIR_PREFIX_LENGTH]
+                for i in range(0, levels * BLOB_DIR_PREFIX_LENGTH, BLOB_DIR_PREFIX_LENGTH)]
+    return os.path.join('', *prefixes)
+
+
+def make_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
 class ClusterStorage(object):
-    def __init__(self, path=None, redis_address=None):
+    def __init__(self, path=None, redis_address=None, dir_levels=None, dir_fallback=None):
         self._redis_address = redis_address or conf['redis server']
-        self.db = RedisHelper(self._redis_address)
+        self.db = get_redis_helper(self._redis_address)
         self.db_dir = path or os.path.expandvars(conf['blob directory'])
         if not os.path.isdir(self.db_dir):
             raise OSError("blob storage directory \"%s\" does not exist" % self.db_dir)
+        self.dir_levels = BLOB_DIR_LEVELS if dir_levels is None else dir_levels
+        self.dir_fallback = BLOB_DIR_FALLBACK if dir_fallback is None else dir_fallback
+        self.verification_cache = VerificationCache(VERIFICATION_CACHE_SIZE)
+        # directories known to exist
+        self._blob_dirs = set([self.db_dir])
+
+    def get_blob_dir(self, blob_hash):
+        """
+        Return the directory of the blob file. With dir_fallback blob files still
+        in the blob directory from a flat layout are found there until
+        scripts/migrate_blob_directory.py moves them
+        """
+        if not self.dir_levels:
+            return self.db_dir
+        blob_dir = os.path.join(self.db_dir, blob_subdir(blob_hash, self.dir_levels))
+        if self.dir_fallback and not os.path.isfile(os.path.join(blob_dir, blob_hash)) and \
+                os.path.isfile(os.path.join(self.db_dir, blob_hash)):
+            return self.db_dir
+        return blob_dir
+
+    @defer.inlineCallbacks
+    def make_blob_dir(self, blob_hash):
+        """
+        Return the directory of the blob file, creating it in a thread the first
+        time it's used by this process
+        """
+        blob_dir = self.get_blob_dir(blob_hash)
+        if blob_dir not in self._blob_dirs:
+            yield threads.deferToThread(make_dir, blob_dir)
+            self._blob_dirs.add(blob_dir)
+        defer.returnValue(blob_dir)
+
+    def get_blob_path(self, blob_hash):
+        return os.path.join(self.get_blob_dir(blob_hash), blob_hash)
 
     @defer.inlineCallbacks
     def blob_exists(self, blob_hash):
@@ -203,6 +816,12 @@ class ClusterStorage(object):
     def add_blob_to_host(self, blob_hash, host):
         yield self.db.add_blob_to_host(blob_hash, host)
 
+    @defer.inlineCallbacks
+    def add_blobs_to_host(self, blob_hashes, host):
+        # returns the total length of the blobs
+        sent_bytes = yield self.db.add_blobs_to_host(blob_hashes, host)
+        defer.returnValue(sent_bytes)
+
     @defer.inlineCallbacks
     def get_blobs_for_stream(self, sd_hash):
         """
@@ -225,17 +844,9 @@ class ClusterStorage(object):
         that we do not have
         """
 
-        blobs_in_stream = yield self.db.get_blobs_for_stream(sd_hash)
-        missing_blobs = []
-
-        if blobs_in_stream:
-            for blob_hash in blobs_in_stream:
-                blob_in_cluster = yield self.blob_has_been_forwarded_to_host(blob_hash)
-                if not blob_in_cluster:
-                    blob_exists = yield self.blob_exists(blob_hash)
-                    if not blob_exists:
-                        missing_blobs.append(blob_hash)
-        else:
+        num_blobs, missing_blobs = yield self.db.find_missing_blobs(sd_hash=sd_hash)
+
+        if not num_blobs:
             sd_exists_locally = yield self.blob_exists(sd_hash)
             if sd_exists_locally:
                 sd_blob = yield self.get_blob(sd_hash)
@@ -249,14 +860,21 @@ class ClusterStorage(object):
     def determine_missing_local_blobs(self, sd_blob):
         needed = []
         decoded_sd = yield self.load_sd_blob(sd_blob)
-        for blob_info in decoded_sd['blobs']:
-            if 'blob_hash' in blob_info and 'length' in blob_info:
-                blob_hash, blob_len = blob_info['blob_hash'], blob_info['length']
-                in_cluster = yield self.blob_has_been_forwarded_to_host(blob_hash)
-                if not in_cluster:
-                    blob = yield self.get_blob(blob_hash, blob_len)
-                    if not blob.verified:
-                        needed.append(blob_hash)
+        blob_infos = [b for b in decoded_sd['blobs'] if 'blob_hash' in b and 'length' in b]
+        for blob_info in blob_infos:
+            if not is_valid_blobhash(blob_info['blob_hash']):
+                raise InvalidBlobHashError(blob_info['blob_hash'])
+        # one call for the cluster membership of every blob, then a local
+        # check of the ones that are not in the cluster
+        _, not_in_cluster = yield self.db.find_missing_blobs(
+            blob_hashes=[b['blob_hash'] for b in blob_infos], check_local=False)
+        not_in_cluster = set(not_in_cluster)
+        for blob_info in blob_infos:
+            blob_hash, blob_len = blob_info['blob_hash'], blob_info['length']
+            if blob_hash in not_in_cluster:
+                blob = yield self.get_blob(blob_hash, blob_len)
+                if not blob.verified:
+                    needed.append(blob_hash)
         defer.returnValue(needed)
 
     @defer.inlineCallbacks
@@ -282,10 +900,11 @@ class ClusterStorage(object):
     @defer.inlineCallbacks
     def get_blob(self, blob_hash, length=None):
         if length is None:
-            blob_exists = yield self.db.blob_exists(blob_hash)
-            if blob_exists:
-                length, timestamp, host = yield self.db.get_blob(blob_hash)
-        blob = BlobFile(self.db_dir, blob_hash, length)
+            blob_info = yield self.db.find_blob(blob_hash)
+            if blob_info is not None:
+                length, timestamp, host = blob_info
+        blob_dir = yield self.make_blob_dir(blob_hash)
+        blob = BlobFile(blob_dir, blob_hash, length)
         defer.returnValue(blob)
 
     @defer.inlineCallbacks
@@ -310,61 +929,116 @@ class ClusterStorage(object):
     @defer.inlineCallbacks
     def delete(self, blob_hash):
         log.info("Delete %s", blob_hash)
-        exists = yield self.blob_exists(blob_hash)
-        if exists:
-            blob_length, timestamp, host = yield self.db.get_blob(blob_hash)
+        if not is_valid_blobhash(blob_hash):
+            raise InvalidBlobHashError()
+        blob_info, is_sd_blob = yield self.db.get_blob_info(blob_hash)
+        if blob_info is not None:
+            blob_length, timestamp, host = blob_info
             if len(host) > 0: # blob is on a host
                 raise Exception("Cannot delete blob on a host, use delete_from_host")
-            blob = BlobFile(self.db_dir, blob_hash, blob_length)
+            blob = BlobFile(self.get_blob_dir(blob_hash), blob_hash, blob_length)
             yield blob.delete()
-            was_deleted = yield self.db.delete_blob(blob_hash)
-            is_sd_blob = yield self.is_sd_blob(blob_hash)
-            if is_sd_blob:
-                yield self.db.delete_sd_blob(blob_hash)
-
+            self.verification_cache.invalidate(blob_hash)
+            was_deleted = yield self.db.delete_blob(blob_hash, is_sd_blob, blob_length)
             defer.returnValue(was_deleted)
         else:
             defer.returnValue(False)
 
     @defer.inlineCallbacks
     def delete_blob_from_host(self, blob_hash):
-        exists = yield self.blob_exists(blob_hash)
-        if not exists:
+        blob_info = yield self.db.find_blob(blob_hash)
+        if blob_info is None:
             raise Exception('blob not found')
 
-        blob_length, timestamp, host = yield self.db.get_blob(blob_hash)
+        blob_length, timestamp, host = blob_info
         if len(host) == 0:# blob is not on a host
             raise Exception('blob must be on a host for delete_blob_from_host')
         # this will set host to empty
-        yield self.db.set_blob(blob_hash, blob_length, timestamp)
-        yield self.db.delete_blob_from_host(blob_hash, host)
+        yield self.db.reset_blob_host(blob_hash, blob_length, timestamp, host)
 
     @defer.inlineCallbacks
-    def completed(self, blob_hash, blob_length):
+    def completed(self, blob_hash, blob_length, mtime=None, inode=None):
+        """
+        Record a blob that was received and verified, mtime and inode are
+        those of the blob file and are read from it if they aren't given
+        """
         if not is_valid_blobhash(blob_hash):
             raise InvalidBlobHashError()
+        if mtime is None or inode is None:
+            key = stat_key(self.get_blob_path(blob_hash))
+            if key is not None:
+                size, inode, mtime = key
         timestamp = time.time()
-        was_set = yield self.db.set_blob(blob_hash, blob_length, timestamp)
+        was_set = yield self.db.set_completed_blob(blob_hash, blob_length, timestamp, mtime, inode)
+        if mtime is not None and inode is not None:
+            self.verification_cache.add(blob_hash, (blob_length, inode, mtime))
         defer.returnValue(was_set)
 
+    def _is_verified(self, blob_hash, length, record, unrecorded):
+        # a blob is verified if its file still matches the record made when it
+        # was verified, blobs without one are checked like BlobFile does and
+        # added to unrecorded
+        key = stat_key(self.get_blob_path(blob_hash))
+        if key is None:
+            self.verification_cache.invalidate(blob_hash)
+            return False
+        if self.verification_cache.is_verified(blob_hash, key):
+            return True
+        if record is not None:
+            if not record_matches(record, key):
+                return False
+        elif length is None:
+            # not a blob the cluster knows about, BlobFile accepts any file
+            return True
+        elif length == key[0]:
+            unrecorded.append((blob_hash, key[0], key[2], key[1]))
+        else:
+            return False
+        self.verification_cache.add(blob_hash, key)
+        return True
+
     @defer.inlineCallbacks
-    def verify_stream_ready_to_forward(self, sd_hash):
-        blob_exists = yield self.blob_exists(sd_hash)
-        if not blob_exists:
-            defer.returnValue(False)
+    def get_stream_state(self, sd_hash):
+        """
+        Return (blob hashes in the stream, {blob_hash: (length, host, in cluster, verified)})
+        for the sd blob and the blobs in the stream. length is None if the blob
+        is unknown. verified is checked against the record made when the blob
+        was received, blobs without one are checked on disk and recorded.
+        """
+        blob_hashes = yield self.db.get_blobs_for_stream(sd_hash)
+        blob_hashes = list(blob_hashes)
+        blob_states = yield self.db.get_blob_states([sd_hash] + blob_hashes)
+        states = {}
+        unrecorded = []
+        for blob_hash, (blob_info, in_cluster, record) in blob_states.iteritems():
+            length, timestamp, host = blob_info if blob_info is not None else (None, 0, '')
+            verified = False
+            if not in_cluster:
+                verified = self._is_verified(blob_hash, length, record, unrecorded)
+            states[blob_hash] = (length, host, in_cluster, verified)
+        if unrecorded:
+            yield self.db.set_verified_blobs(unrecorded)
+        defer.returnValue((blob_hashes, states))
 
-        blob_forwarded = yield self.blob_has_been_forwarded_to_host(sd_hash)
-        if blob_forwarded:
-            defer.returnValue(False)
-        sd_blob = yield self.get_blob(sd_hash)
-        if not sd_blob.verified:
+    @defer.inlineCallbacks
+    def verify_stream_ready_to_forward(self, sd_hash):
+        if not is_valid_blobhash(sd_hash):
+            raise InvalidBlobHashError(sd_hash)
+        blob_hashes, states = yield self.get_stream_state(sd_hash)
+        sd_length, sd_host, sd_forwarded, sd_verified = states[sd_hash]
+        if sd_length is None or sd_forwarded or not sd_verified:
             defer.returnValue(False)
-        blobs = yield self.get_blobs_for_stream(sd_hash)
-        for b in blobs:
-            if not b.verified:
+        for blob_hash in blob_hashes:
+            length, host, forwarded, verified = states[blob_hash]
+            if not verified:
                 defer.returnValue(False)
         defer.returnValue(True)
 
+    @defer.inlineCallbacks
+    def get_stream_blob_count(self, sd_hash):
+        count = yield self.db.get_stream_blob_count(sd_hash)
+        defer.returnValue(count)
+
     @defer.inlineCallbacks
     def get_host_count(self, host):
         count = yield self.db.get_host_count(host)
@@ -0,0 +1,59 @@
+import os
+from collections import OrderedDict
+
+
+def stat_key(path):
+    """
+    Return (size, inode, mtime) of the file at path, or None if it does not exist.
+    A verification made for one key does not hold for a file with another.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_ino, st.st_mtime
+
+
+def record_matches(record, key):
+    # record is the (length, mtime, inode) stored when the blob was verified,
+    # records made before inodes were stored have inode None
+    length, mtime, inode = record
+    size, st_ino, st_mtime = key
+    return length == size and mtime == st_mtime and inode in (None, st_ino)
+
+
+class VerificationCache(object):
+    """
+    Bounded LRU of blobs known to be verified, keyed by the blob hash and the
+    (size, inode, mtime) of its file. The records in redis are shared by the
+    server and the workers, this saves long running processes from decoding
+    them again.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_verified(self, blob_hash, key):
+        cached_key = self._entries.pop(blob_hash, None)
+        if cached_key is None:
+            return False
+        if cached_key != key:
+            return False
+        # move it to the most recently used end
+        self._entries[blob_hash] = cached_key
+        return True
+
+    def add(self, blob_hash, key):
+        if self.max_size <= 0:
+            return
+        self._entries.pop(blob_hash, None)
+        self._entries[blob_hash] = key
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, blob_hash):
+        self._entries.pop(blob_hash, None)
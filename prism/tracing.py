@@ -0,0 +1,96 @@
+import os
+import copy
+import json
+import time
+import random
+import logging
+from logging.handlers import RotatingFileHandler
+
+from prism.config import get_settings
+
+settings = get_settings()
+# share of the client connections whose requests are traced, 0 turns tracing off
+TRACE_SAMPLE_RATE = settings['trace sample rate']
+# seconds a traced request has to take to be written to the trace log
+TRACE_SLOW_REQUEST = settings['trace slow request']
+TRACE_LOG_PATH = os.path.expanduser(settings['trace log'])
+
+trace_log = logging.getLogger('prism.trace')
+
+
+def init_trace_log(path=TRACE_LOG_PATH):
+    # the traces go to their own file instead of the server log
+    if not trace_log.handlers:
+        handler = RotatingFileHandler(path, maxBytes=2 ** 26, backupCount=2)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        trace_log.addHandler(handler)
+        trace_log.setLevel(logging.INFO)
+        trace_log.propagate = False
+
+
+def sample_connection(rate=TRACE_SAMPLE_RATE):
+    return rate > 0 and random.random() < rate
+
+
+def counting_storage(blob_storage, call_counter):
+    """
+    Return a shallow copy of blob_storage whose redis helper counts its commands
+    and batches in call_counter, the caches and connections are shared
+    """
+    db = copy.copy(blob_storage.db)
+    db.call_counter = call_counter
+    traced = copy.copy(blob_storage)
+    traced.db = db
+    return traced
+
+
+class ConnectionTracer(object):
+    """
+    Records the phases of the requests on one client connection. Requests are
+    handled one at a time, so the redis calls made through the connection's
+    counting storage between start() and finish() belong to the request.
+    """
+
+    def __init__(self, blob_storage, peer, slow_request=TRACE_SLOW_REQUEST):
+        self.calls = [0]
+        self.blob_storage = counting_storage(blob_storage, self.calls)
+        self.peer = peer
+        self.slow_request = slow_request
+        self.request = None
+        self.phases = []
+        self._start = None
+        self._calls_at_start = 0
+
+    def start(self, request):
+        self.request = request
+        self.phases = []
+        self._start = time.time()
+        self._calls_at_start = self.calls[0]
+
+    def mark(self, phase):
+        if self._start is not None:
+            self.phases.append((phase, time.time()))
+
+    def finish(self, **info):
+        # returns the trace, which is logged if the request was slow
+        if self._start is None:
+            return None
+        now = time.time()
+        duration = now - self._start
+        previous = self._start
+        phases = []
+        for phase, at in self.phases:
+            phases.append([phase, round((at - previous) * 1000.0, 3)])
+            previous = at
+        trace = {
+            'request': self.request,
+            'peer': self.peer,
+            'total_ms': round(duration * 1000.0, 3),
+            'phases_ms': phases,
+            'redis_calls': self.calls[0] - self._calls_at_start,
+        }
+        trace.update(info)
+        self._start = None
+        if duration >= self.slow_request:
+            trace_log.info(json.dumps(trace))
+        return trace
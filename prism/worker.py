@@ -1,15 +1,221 @@
 import sys
+import logging
+import argparse
+
 from redis import Redis
-from rq import Connection, Worker
+from rq import Connection, Queue, Worker, get_failed_queue
+from rq.job import JobStatus
+from rq.exceptions import DequeueTimeout
+from rq.registry import StartedJobRegistry, FinishedJobRegistry
+
+# the configured reactor is installed before anything imports the default one
 from prism.config import get_settings
+from prism.reactors import install_reactor
+install_reactor(get_settings()['reactor'])
+
+from twisted.internet import defer, task, threads
+
+from prism.metrics import listen_metrics
+from prism.protocol.pool import ReflectorConnectionPool
+from prism.protocol.task import TCP_CONNECT_TIMEOUT, forward_blob, forward_stream
+from prism.storage.storage import ClusterStorage, get_redis_connection
 
 settings = get_settings()
+log = logging.getLogger(__name__)
+
+# the reactor equivalents of the job functions
+FORWARD_JOBS = {
+    'prism.protocol.task.process_stream': forward_stream,
+    'prism.protocol.task.process_blob': forward_blob,
+}
+
+
+class ReactorWorker(object):
+    """
+    Runs forwarding jobs from the rq queues on one long lived reactor, up to
+    max_in_flight at a time, instead of forking a work horse with its own reactor,
+    redis connection and lbrynet import for every job.
+
+    The jobs keep the rq bookkeeping, they show up in the started, finished and
+    failed registries like jobs run by a forking rq Worker. A job that raises is
+    moved to the failed queue without affecting the other jobs in flight.
+    """
+
+    DEQUEUE_TIMEOUT = 5
+    HEARTBEAT_INTERVAL = 60
+
+    def __init__(self, queue_names, redis_connection, max_in_flight, burst=False, pool=None):
+        self.redis_connection = redis_connection
+        # ReflectorConnectionPool shared by the jobs, or None to connect for each job
+        self.pool = pool
+        self.queues = [Queue(name, connection=redis_connection) for name in queue_names]
+        self.rq_worker = Worker(self.queues, connection=redis_connection)
+        self.failed_queue = get_failed_queue(redis_connection)
+        self.semaphore = defer.DeferredSemaphore(max_in_flight)
+        self.burst = burst
+        self.running = False
+        # job id: deferred
+        self.in_flight = {}
+        # (db_dir, redis_address): (ClusterStorage, redis connection)
+        self._storages = {}
+        self._heartbeat = task.LoopingCall(self._send_heartbeat)
+
+    def _send_heartbeat(self):
+        d = threads.deferToThread(self.rq_worker.heartbeat)
+        d.addErrback(lambda err: log.warning("Failed to send heartbeat: %s", err))
+        return d
+
+    def _get_storage(self, db_dir, redis_address):
+        key = (db_dir, redis_address)
+        if key not in self._storages:
+            self._storages[key] = (ClusterStorage(db_dir, redis_address),
+                                   get_redis_connection(redis_address))
+        return self._storages[key]
+
+    def _dequeue(self):
+        try:
+            return Queue.dequeue_any(self.queues, self.DEQUEUE_TIMEOUT,
+                                     connection=self.redis_connection)
+        except DequeueTimeout:
+            return None
+
+    def _start_job(self, job):
+        started_registry = StartedJobRegistry(job.origin, self.redis_connection)
+        with self.redis_connection.pipeline() as pipeline:
+            job.set_status(JobStatus.STARTED, pipeline=pipeline)
+            started_registry.add(job, job.timeout + 60, pipeline=pipeline)
+            pipeline.execute()
+
+    def _finish_job(self, job, result):
+        started_registry = StartedJobRegistry(job.origin, self.redis_connection)
+        finished_registry = FinishedJobRegistry(job.origin, self.redis_connection)
+        result_ttl = job.get_result_ttl(self.rq_worker.default_result_ttl)
+        with self.redis_connection.pipeline() as pipeline:
+            job.set_status(JobStatus.FINISHED, pipeline=pipeline)
+            job._result = result
+            if result_ttl != 0:
+                job.save(pipeline=pipeline)
+                finished_registry.add(job, result_ttl, pipeline=pipeline)
+            job.cleanup(result_ttl, pipeline=pipeline)
+            started_registry.remove(job, pipeline=pipeline)
+            pipeline.execute()
+
+    def _fail_job(self, job, err):
+        log.error("Job %s failed: %s", job.id, err.getErrorMessage())
+        started_registry = StartedJobRegistry(job.origin, self.redis_connection)
+        with self.redis_connection.pipeline() as pipeline:
+            job.set_status(JobStatus.FAILED, pipeline=pipeline)
+            started_registry.remove(job, pipeline=pipeline)
+            pipeline.execute()
+        self.failed_queue.quarantine(job, exc_info=err.getTraceback())
+
+    def _forward(self, job):
+        forward = FORWARD_JOBS.get(job.func_name)
+        if forward is None:
+            raise Exception("%s can not be run by a reactor worker" % job.func_name)
+        hash_to_process, db_dir, client_factory_class, redis_address = job.args[:4]
+        host_infos = job.args[4] if len(job.args) > 4 else None
+        blob_storage, redis_connection = self._get_storage(db_dir, redis_address)
+        return forward(hash_to_process, blob_storage, client_factory_class, redis_connection,
+                       host_infos, job.timeout, self.pool)
+
+    def perform_job(self, job):
+        log.info("Starting job %s (%s in flight)", job.id, len(self.in_flight))
+        d = threads.deferToThread(self._start_job, job)
+        d.addCallback(lambda _: self._forward(job))
+        d.addCallbacks(lambda result: threads.deferToThread(self._finish_job, job, result),
+                       lambda err: threads.deferToThread(self._fail_job, job, err))
+        d.addErrback(lambda err: log.error("Failed to update job %s: %s", job.id, err))
+        return d
+
+    def _job_done(self, result, job_id):
+        del self.in_flight[job_id]
+        self.semaphore.release()
+
+    @defer.inlineCallbacks
+    def work(self):
+        from twisted.internet import reactor
+        self.running = True
+        yield threads.deferToThread(self.rq_worker.register_birth)
+        self._heartbeat.start(self.HEARTBEAT_INTERVAL)
+        if self.pool is not None:
+            self.pool.start()
+        log.info("Reactor worker started, up to %i jobs in flight", self.semaphore.limit)
+        while self.running:
+            yield self.semaphore.acquire()
+            try:
+                dequeued = yield threads.deferToThread(self._dequeue)
+            except Exception as err:
+                log.error("Failed to dequeue a job: %s", err)
+                dequeued = None
+                yield task.deferLater(reactor, self.DEQUEUE_TIMEOUT, lambda: None)
+            if dequeued is None:
+                self.semaphore.release()
+                if self.burst and not self.in_flight:
+                    break
+                continue
+            job, queue = dequeued
+            self.in_flight[job.id] = d = self.perform_job(job)
+            d.addBoth(self._job_done, job.id)
+        yield self.stop()
+
+    @defer.inlineCallbacks
+    def stop(self):
+        # wait for the jobs in flight, they are bounded by their job timeouts
+        self.running = False
+        yield defer.DeferredList(self.in_flight.values())
+        if self.pool is not None:
+            self.pool.stop()
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+            yield threads.deferToThread(self.rq_worker.register_death)
+
+
+def run_reactor_worker(queue_names, redis_connection, max_in_flight, burst=False, host_connections=0,
+                       metrics_port=0):
+    from twisted.internet import reactor
+    if metrics_port:
+        listen_metrics(metrics_port, settings['metrics listen'])
+    pool = None
+    if host_connections > 0:
+        pool = ReflectorConnectionPool(host_connections, settings['host idle timeout'], TCP_CONNECT_TIMEOUT,
+                                       pipelined_blobs=settings['pipelined blobs'])
+    worker = ReactorWorker(queue_names, redis_connection, max_in_flight, burst, pool)
+    # the blocking rq calls and the thread redis client share the threadpool
+    reactor.suggestThreadPoolSize(max(10, max_in_flight))
+    reactor.addSystemEventTrigger('before', 'shutdown', worker.stop)
+
+    def _stop(result):
+        if reactor.running:
+            reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: worker.work().addErrback(log.error).addBoth(_stop))
+    reactor.run()
+
 
 def main():
-    with Connection(Redis(settings['redis server'])):
-        qs = ['default']
-        w = Worker(qs)
-        w.work()
+    parser = argparse.ArgumentParser(description="Forward streams from the prism queue to the cluster")
+    parser.add_argument('--mode', choices=('fork', 'reactor'), default=settings['worker mode'],
+                        help='fork a process per job, or run many jobs on one reactor')
+    parser.add_argument('--max-in-flight', type=int, default=settings['worker max in flight'],
+                        help='jobs run at a time in reactor mode')
+    parser.add_argument('--host-connections', type=int, default=settings['host connections'],
+                        help='connections kept open to each host in reactor mode, 0 to not reuse them')
+    parser.add_argument('--metrics-port', type=int, default=settings['worker metrics port'],
+                        help='serve prometheus metrics on this port in reactor mode, 0 to not serve them')
+    parser.add_argument('--burst', action='store_true', help='exit once the queue is empty')
+    args = parser.parse_args()
+
+    redis_connection = Redis(settings['redis server'])
+    qs = ['default']
+    if args.mode == 'reactor':
+        run_reactor_worker(qs, redis_connection, args.max_in_flight, args.burst, args.host_connections,
+                           args.metrics_port)
+    else:
+        with Connection(redis_connection):
+            w = Worker(qs)
+            w.work(burst=args.burst)
 
 if __name__ == "__main__":
     sys.exit(main())
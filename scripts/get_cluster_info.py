@@ -15,7 +15,7 @@ optional arguments:
 
 """
 
-from prism.storage.storage import ClusterStorage, SD_BLOB_HASHES
+from prism.storage.storage import ClusterStorage, SD_BLOB_HASHES, SUPPRESSED_STREAM_JOBS
 from prism.config import get_settings
 
 from twisted.internet import reactor,defer
@@ -87,7 +87,7 @@ def check_host_info(host):
 @defer.inlineCallbacks
 def check_cluster_info():
     storage = ClusterStorage()
-    sd_blobs = storage.db.db.smembers(SD_BLOB_HASHES)
+    sd_blobs = storage.db.decode_hashes(storage.db.db.smembers(SD_BLOB_HASHES))
     print("Num sd hashes:{}".format(len(sd_blobs)))
 
     for host in settings['hosts']:
@@ -108,6 +108,8 @@ def check_cluster_info():
         blobs = yield storage.db.get_blobs_for_stream(sd_blob)
         num_unforwarded_blobs += len(blobs)
     print("Num blobs in unforwarded streams:{}".format(num_unforwarded_blobs))
+    suppressed = storage.db.db.get(SUPPRESSED_STREAM_JOBS) or 0
+    print("Num duplicate stream jobs suppressed:{}".format(suppressed))
     reactor.stop()
 
 
@@ -0,0 +1,64 @@
+# Move the blob files in the prism blob directory into the subdirectories of
+# the "blob directory levels" setting, or back into the blob directory with
+# --levels 0.
+#
+# Moving blobs out of a flat blob directory is safe while the cluster is up
+# once the servers and workers have been restarted with the new levels and
+# "blob directory fallback" on, they keep finding blob files in the top
+# directory until they are moved. Turn the fallback off and restart them again
+# once it's done. Any other change of levels must be done while the cluster is
+# stopped
+#
+# python migrate_blob_directory.py [--levels 2]
+#
+
+from __future__ import print_function
+
+import os
+import errno
+import argparse
+
+from lbrynet.core.utils import is_valid_blobhash
+
+from prism.config import get_settings
+from prism.storage.storage import blob_subdir, make_dir
+
+settings = get_settings()
+
+
+def migrate(db_dir, levels):
+    moved, checked = 0, 0
+    made = set()
+    for dir_path, dir_names, file_names in os.walk(db_dir):
+        for file_name in file_names:
+            if not is_valid_blobhash(file_name):
+                continue
+            checked += 1
+            blob_dir = os.path.join(db_dir, blob_subdir(file_name, levels))
+            if os.path.normpath(dir_path) == os.path.normpath(blob_dir):
+                continue
+            if blob_dir not in made:
+                make_dir(blob_dir)
+                made.add(blob_dir)
+            try:
+                os.rename(os.path.join(dir_path, file_name), os.path.join(blob_dir, file_name))
+            except OSError as err:
+                # forwarded and removed since the directory was listed
+                if err.errno != errno.ENOENT:
+                    raise
+            moved += 1
+            if moved % 10000 == 0:
+                print("checked {} blobs, moved {}".format(checked, moved))
+    print("checked {} blobs, moved {}".format(checked, moved))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the blob files into the blob directory layout")
+    parser.add_argument('--levels', type=int, default=settings['blob directory levels'],
+                        help='levels of subdirectories, 0 for a flat blob directory')
+    args = parser.parse_args()
+    migrate(os.path.expandvars(settings['blob directory']), args.levels)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Rewrite the json encoded entries in blob_hashes in the packed BLOB_RECORD
+# format, printing the redis memory used before and after.
+#
+# Safe to run while the cluster is up, the entries are read a page at a time
+# with HSCAN and an entry is only replaced if it hasn't changed since it was read
+#
+# python migrate_blob_records.py [--page-size 1000]
+#
+
+from __future__ import print_function
+
+import argparse
+
+from twisted.internet import reactor, defer
+
+from prism.storage.storage import BLOB_HASHES, ClusterStorage, RedisScript, is_packed_blob
+
+# ARGV is blob hash, value that was read, new value for each entry, returns
+# the number of entries replaced
+REPLACE_UNCHANGED_SCRIPT = RedisScript("""
+local replaced = 0
+for i = 1, #ARGV, 3 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        replaced = replaced + 1
+    end
+end
+return replaced
+""")
+
+
+def used_memory(storage):
+    return storage.db.db.info('memory')['used_memory']
+
+
+@defer.inlineCallbacks
+def migrate(storage, page_size):
+    memory_before = used_memory(storage)
+    cursor, checked, replaced = 0, 0, 0
+    while True:
+        cursor, entries = storage.db.db.hscan(BLOB_HASHES, cursor, count=page_size)
+        args = []
+        for blob_hash, blob_val in entries.items():
+            if is_packed_blob(blob_val):
+                continue
+            length, timestamp, host = storage.db._decode_blob(blob_val)
+            if host:
+                yield storage.db.get_host_id(host)
+            args.extend([blob_hash, blob_val, storage.db._encode_blob(length, timestamp, host)])
+        if args:
+            count = yield storage.db.run_script(REPLACE_UNCHANGED_SCRIPT, [BLOB_HASHES], args)
+            replaced += count
+        checked += len(entries)
+        print("checked {} blobs, replaced {}".format(checked, replaced))
+        if cursor == 0:
+            break
+    memory_after = used_memory(storage)
+    print("used memory {} -> {} bytes".format(memory_before, memory_after))
+    if replaced:
+        print("{} bytes saved per million blobs".format((memory_before - memory_after) * 1000000 / replaced))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the json encoded blob_hashes entries")
+    parser.add_argument('--page-size', type=int, default=1000, help='entries read with each HSCAN')
+    args = parser.parse_args()
+
+    def run():
+        d = migrate(ClusterStorage(), args.page_size)
+        d.addErrback(lambda err: print(err.getTraceback()))
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Convert the blob hashes stored in the redis sets and hashes between the hex
+# and raw storage layouts, printing the redis memory used before and after.
+# Set "storage layout" in .prism.yml to the new layout before starting the
+# cluster again.
+#
+# The cluster must be stopped while this runs, entries written in the old layout
+# during the migration would be left behind
+#
+# python migrate_storage_layout.py --to raw [--page-size 1000]
+#
+
+from __future__ import print_function
+
+import argparse
+
+from prism.config import get_settings
+from prism.protocol.task import parse_host
+from prism.storage.storage import BLOB_HASHES, CLUSTER_BLOBS, HOST_BLOB_COUNTS, HOST_IDS, SD_BLOB_HASHES
+from prism.storage.storage import VERIFIED_BLOBS, get_redis_connection
+
+settings = get_settings()
+
+HEX_LENGTH = 96
+RAW_LENGTH = 48
+# encodings redis uses for small sets
+COMPACT_ENCODINGS = ('intset', 'listpack', 'ziplist')
+
+
+def to_hex(member):
+    return member.encode('hex') if len(member) == RAW_LENGTH else member
+
+
+def converter(layout):
+    # returns (length of the members to convert, conversion)
+    if layout == 'raw':
+        return HEX_LENGTH, lambda member: member.decode('hex')
+    return RAW_LENGTH, lambda member: member.encode('hex')
+
+
+def migrate_set(db, name, layout, page_size):
+    length, convert = converter(layout)
+    cursor, converted = 0, 0
+    while True:
+        cursor, members = db.sscan(name, cursor, count=page_size)
+        members = [member for member in members if len(member) == length]
+        if members:
+            pipe = db.pipeline(transaction=False)
+            pipe.sadd(name, *[convert(member) for member in members])
+            pipe.srem(name, *members)
+            pipe.execute()
+            converted += len(members)
+        if cursor == 0:
+            return converted
+
+
+def migrate_hash(db, name, layout, page_size):
+    length, convert = converter(layout)
+    cursor, converted = 0, 0
+    while True:
+        cursor, entries = db.hscan(name, cursor, count=page_size)
+        entries = dict((field, value) for field, value in entries.items() if len(field) == length)
+        if entries:
+            pipe = db.pipeline(transaction=False)
+            pipe.hmset(name, dict((convert(field), value) for field, value in entries.items()))
+            pipe.hdel(name, *entries.keys())
+            pipe.execute()
+            converted += len(entries)
+        if cursor == 0:
+            return converted
+
+
+def stream_keys(db, page_size):
+    cursor = 0
+    while True:
+        cursor, members = db.sscan(SD_BLOB_HASHES, cursor, count=page_size)
+        for member in members:
+            yield to_hex(member)
+        if cursor == 0:
+            return
+
+
+def host_keys(db):
+    hosts = set(parse_host(host)[0] for host in settings['hosts'])
+    hosts.update(db.hkeys(HOST_IDS))
+    hosts.update(db.hkeys(HOST_BLOB_COUNTS))
+    return sorted(hosts)
+
+
+def migrate(db, layout, page_size):
+    memory_before = db.info('memory')['used_memory']
+    streams, compact, converted = 0, 0, 0
+    for sd_hash in stream_keys(db, page_size):
+        converted += migrate_set(db, sd_hash, layout, page_size)
+        streams += 1
+        if db.object('encoding', sd_hash) in COMPACT_ENCODINGS:
+            compact += 1
+        if streams % 10000 == 0:
+            print("converted {} streams".format(streams))
+    print("converted {} blobs in {} streams, {} sets are compact".format(converted, streams, compact))
+    for host in host_keys(db):
+        print("host {}: converted {} blobs".format(host, migrate_set(db, host, layout, page_size)))
+    for name in (CLUSTER_BLOBS, SD_BLOB_HASHES):
+        print("{}: converted {} blobs".format(name, migrate_set(db, name, layout, page_size)))
+    for name in (BLOB_HASHES, VERIFIED_BLOBS):
+        print("{}: converted {} blobs".format(name, migrate_hash(db, name, layout, page_size)))
+    memory_after = db.info('memory')['used_memory']
+    print("used memory {} -> {} bytes".format(memory_before, memory_after))
+    print("set \"storage layout\" to \"{}\" before starting the cluster".format(layout))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the stored blob hashes to another storage layout")
+    parser.add_argument('--to', choices=['raw', 'hex'], required=True, help='layout to convert to')
+    parser.add_argument('--page-size', type=int, default=1000, help='entries read with each scan')
+    args = parser.parse_args()
+    migrate(get_redis_connection(settings['redis server']), args.to, args.page_size)
+
+
+if __name__ == '__main__':
+    main()
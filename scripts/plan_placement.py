@@ -0,0 +1,68 @@
+# List the streams that have to move for the cluster to match consistent
+# placement after hosts are added or removed. Only streams the new ring
+# places on a different host than the one they are on are listed, when the
+# streams were placed by the old ring that is about 1/N of them.
+#
+# Streams on removed hosts are found through the host tables, their blobs must
+# be copied back into the prism blob directory to be forwarded again, as with
+# redistribute_blobs.py
+#
+# python plan_placement.py [--add host:port ...] [--remove host ...] [--output moves.json]
+#
+
+import sys
+import json
+import argparse
+from collections import Counter
+
+from prism.config import get_settings
+from prism.placement import HashRing, plan_moves
+from prism.protocol.task import parse_host
+from prism.storage.storage import SD_BLOB_HASHES, RedisHelper
+
+settings = get_settings()
+
+
+def host_key(host):
+    return "%s:%i" % parse_host(host)
+
+
+def find_placements(helper, hosts):
+    # {sd_hash: host} of the streams on hosts
+    placements = {}
+    for host in hosts:
+        address, port = parse_host(host)
+        for member in helper.db.sinter(address, SD_BLOB_HASHES):
+            placements[helper.decode_hash(member)] = host_key(host)
+    return placements
+
+
+def run(args):
+    removed = set(host_key(host) for host in args.remove)
+    current = [host_key(host) for host in settings['hosts']]
+    hosts = [host for host in current if host not in removed]
+    hosts.extend(host_key(host) for host in args.add if host_key(host) not in hosts)
+    weights = dict((host_key(host), weight) for host, weight in settings['host weights'].items())
+    ring = HashRing(hosts, settings['virtual nodes'], weights)
+
+    placements = find_placements(RedisHelper(settings['redis server']), current)
+    moves = plan_moves(placements, ring)
+    out = json.dumps([{'sd_hash': sd_hash, 'from': from_host, 'to': to_host}
+                      for sd_hash, from_host, to_host in moves], indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+    for (from_host, to_host), count in sorted(Counter((m[1], m[2]) for m in moves).items()):
+        sys.stderr.write("{} -> {}: {} streams\n".format(from_host, to_host, count))
+    sys.stderr.write("{} of {} streams move\n".format(len(moves), len(placements)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List the streams to move after a cluster membership change")
+    parser.add_argument('--add', action='append', default=[], help='host joining the cluster')
+    parser.add_argument('--remove', action='append', default=[], help='host leaving the cluster')
+    parser.add_argument('--output', help='write the moves to this json file')
+    run(parser.parse_args())
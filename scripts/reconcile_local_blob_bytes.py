@@ -0,0 +1,59 @@
+# Set the local_blob_bytes counter to the total length of the blobs in
+# blob_hashes that are not on a host, printing the old and new totals.
+#
+# Servers that counted blobs received more than once left the counter too high,
+# and blobs received before the counter was kept were never added to it. Run it
+# once with prism-server and the workers stopped, the entries are read a page at
+# a time with HSCAN and blobs recorded or forwarded during the scan would be
+# counted wrong
+#
+# python reconcile_local_blob_bytes.py [--page-size 1000] [--dry-run]
+#
+
+from __future__ import print_function
+
+import argparse
+
+from twisted.internet import reactor, defer
+
+from prism.storage.storage import BLOB_HASHES, LOCAL_BLOB_BYTES, ClusterStorage
+
+
+@defer.inlineCallbacks
+def reconcile(storage, page_size, dry_run):
+    cursor, checked, local_blobs, local_bytes = 0, 0, 0, 0
+    while True:
+        cursor, entries = storage.db.db.hscan(BLOB_HASHES, cursor, count=page_size)
+        blobs = yield storage.db.decode_blobs(entries.values())
+        for length, timestamp, host in blobs:
+            if not host:
+                local_blobs += 1
+                local_bytes += length
+        checked += len(entries)
+        print("checked {} blobs, {} local with {} bytes".format(checked, local_blobs, local_bytes))
+        if cursor == 0:
+            break
+    counted = storage.db.db.get(LOCAL_BLOB_BYTES)
+    print("{} is {}, local blobs have {} bytes".format(LOCAL_BLOB_BYTES, counted, local_bytes))
+    if not dry_run:
+        storage.db.db.set(LOCAL_BLOB_BYTES, local_bytes)
+        print("set {} to {}".format(LOCAL_BLOB_BYTES, local_bytes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recount the local_blob_bytes counter from blob_hashes")
+    parser.add_argument('--page-size', type=int, default=1000, help='entries read with each HSCAN')
+    parser.add_argument('--dry-run', action='store_true', help='print the totals without setting the counter')
+    args = parser.parse_args()
+
+    def run():
+        d = reconcile(ClusterStorage(), args.page_size, args.dry_run)
+        d.addErrback(lambda err: print(err.getTraceback()))
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -60,16 +60,16 @@ def migrate_entry(blob_hash, from_host):
 
 @defer.inlineCallbacks
 def migrate_sd_hash(sd_hash, from_host):
-    if not os.path.isfile(os.path.join(storage.db_dir,sd_hash)):
+    if not os.path.isfile(storage.get_blob_path(sd_hash)):
         raise Exception("sd hash %s not found"%sd_hash)
 
     yield migrate_entry(sd_hash, from_host)
 
-    blob_hashes = yield storage.db.smembers(sd_hash)
+    blob_hashes = yield storage.db.get_blobs_for_stream(sd_hash)
 
     # copy blobs
     for blob_hash in blob_hashes:
-        if not os.path.isfile(os.path.join(storage.db_dir,sd_hash)):
+        if not os.path.isfile(storage.get_blob_path(blob_hash)):
             raise Exception("blob hash %s not found"%blob_hash)
         yield migrate_entry(blob_hash, from_host)
 
@@ -111,10 +111,8 @@ def do_migration(sd_hashes):
 def find_host_sd_hashes(hosts):
     sd_hashes = []
     for host in hosts:
-        blob_hashes = storage.db.db.smembers(host)
-        for blob_hash in blob_hashes:
-            if storage.db.db.sismember(SD_BLOB_HASHES, blob_hash):
-                sd_hashes.append((host, blob_hash))
+        for member in storage.db.db.sinter(host, SD_BLOB_HASHES):
+            sd_hashes.append((host, storage.db.decode_hash(member)))
     print("{} sd hashes found".format(len(sd_hashes)))
     return sd_hashes
 
@@ -26,7 +26,7 @@ setup(
     author="LBRY Inc.",
     author_email="hello@lbry.io",
     license='MIT',
-    packages=find_packages(base_dir, exclude=['tests']),
+    packages=find_packages(base_dir, exclude=['tests', 'benchmarks']),
     install_requires=requires,
     entry_points={'console_scripts': console_scripts},
 )
@@ -2,11 +2,12 @@ import hashlib
 import os
 import sys
 
-from prism import config
-from prism.protocol.task import process_blob
+from twisted.internet import defer, task
 
-from redis import Redis
-from rq import Queue
+from prism import config
+from prism.protocol.factory import build_prism_blob_client_factory
+from prism.protocol.task import enqueue_blob
+from prism.storage.storage import ClusterStorage
 
 settings = config.get_settings()
 
@@ -14,10 +15,24 @@ BLOB_DIR = os.path.expandvars(settings["blob directory"])
 BLOB_SIZE = 1024 * 1024 * 2
 
 
-def main():
-    redis_conn = Redis()
-    q = Queue(connection=redis_conn)
+@defer.inlineCallbacks
+def send_blobs(reactor, num_blobs):
+    # record random blobs as received by this host and enqueue them to be
+    # forwarded, for a load test of the whole ingest path see benchmarks.ingest
+    storage = ClusterStorage(BLOB_DIR)
+    for i in range(num_blobs):
+        blob_contents = os.urandom(BLOB_SIZE)
+        blob_hash = hashlib.sha384(blob_contents).hexdigest()
+        blob = yield storage.get_blob(blob_hash, BLOB_SIZE)
+        blob_path = blob.file_path
+        with open(blob_path, 'wb') as f:
+            f.write(blob_contents)
+        st = os.stat(blob_path)
+        yield storage.completed(blob_hash, BLOB_SIZE, st.st_mtime, st.st_ino)
+        enqueue_blob(blob_hash, storage.db_dir, build_prism_blob_client_factory, storage._redis_address)
+
 
+def main():
     if not os.path.isdir(BLOB_DIR):
         os.mkdir(BLOB_DIR)
 
@@ -26,18 +41,7 @@ def main():
     except IndexError:
         num_blobs = 1
 
-    blobs = []
-
-    for i in range(num_blobs):
-        blob_contents = os.urandom(BLOB_SIZE)
-        blob_hash = hashlib.sha384(blob_contents).hexdigest()
-        blob_path = os.path.join(BLOB_DIR, blob_hash)
-        with open(blob_path, 'wb') as f:
-            f.write(blob_contents)
-        blobs.append(blob_hash)
-
-    for blob_hash in blobs:
-        q.enqueue(process_blob, blob_hash, 1)
+    task.react(send_blobs, (num_blobs,))
 
 
 if __name__ == "__main__":
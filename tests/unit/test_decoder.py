@@ -0,0 +1,62 @@
+import json
+
+from twisted.trial import unittest
+
+from prism.error import ReflectorRequestDecodeError
+from prism.protocol.decoder import ReflectorMessageDecoder
+
+
+class TestReflectorMessageDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = ReflectorMessageDecoder(200)
+
+    def test_whole_message(self):
+        msg, offset = self.decoder.decode('{"version": 1}')
+        self.assertEqual({'version': 1}, msg)
+        self.assertEqual(14, offset)
+
+    def test_fragmented_message(self):
+        data = json.dumps({'blob_hash': 'a' * 96, 'blob_size': 2097152})
+        for i, c in enumerate(data[:-1]):
+            self.assertEqual((None, 1), self.decoder.decode(c))
+            self.assertEqual(i + 1, self.decoder.buffered)
+        msg, offset = self.decoder.decode(data[-1])
+        self.assertEqual({'blob_hash': 'a' * 96, 'blob_size': 2097152}, msg)
+        self.assertEqual(1, offset)
+        self.assertEqual(0, self.decoder.buffered)
+
+    def test_braces_and_escapes_in_strings(self):
+        data = '{"a": "}{\\"}", "b": {"c": "\\\\"}}'
+        expected = json.loads(data)
+        for split in range(1, len(data)):
+            decoder = ReflectorMessageDecoder()
+            self.assertEqual((None, split), decoder.decode(data[:split]))
+            msg, offset = decoder.decode(data[split:])
+            self.assertEqual(expected, msg)
+            self.assertEqual(len(data) - split, offset)
+
+    def test_trailing_data(self):
+        data = '{"send_blob": true}' + '\x00{}' * 10
+        msg, offset = self.decoder.decode(data)
+        self.assertEqual({'send_blob': True}, msg)
+        self.assertEqual('\x00{}' * 10, data[offset:])
+
+    def test_multiple_messages(self):
+        data = ' {"version": 1}\n{"sd_blob_hash": "aa", "sd_blob_size": 10}'
+        msg, offset = self.decoder.decode(data)
+        self.assertEqual({'version': 1}, msg)
+        msg, offset = self.decoder.decode(data, offset)
+        self.assertEqual({'sd_blob_hash': 'aa', 'sd_blob_size': 10}, msg)
+        self.assertEqual(len(data), offset)
+
+    def test_max_size(self):
+        self.assertEqual((None, 150), self.decoder.decode('{"a": "' + 'a' * 143))
+        self.assertRaises(ReflectorRequestDecodeError, self.decoder.decode, 'a' * 60)
+        # unbounded decoders accept large messages
+        decoder = ReflectorMessageDecoder()
+        msg, _ = decoder.decode(json.dumps({'needed_blobs': ['a' * 96] * 1000}))
+        self.assertEqual(1000, len(msg['needed_blobs']))
+
+    def test_invalid_message(self):
+        self.assertRaises(ReflectorRequestDecodeError, self.decoder.decode, 'version')
+        self.assertRaises(ReflectorRequestDecodeError, ReflectorMessageDecoder().decode, '{"a": }')
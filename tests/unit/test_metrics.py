@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from prism.metrics import Counter, Gauge, Histogram, Registry
+from prism.storage.storage import ClusterStorage
+from prism.tracing import ConnectionTracer
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(Counter('blobs_total', 'Blobs', ('result',)))
+        counter.labels('true').inc()
+        counter.labels('true').inc(2)
+        counter.labels('false').inc()
+        registry.register(Gauge('connections', 'Connections', function=lambda: 7))
+        histogram = registry.register(Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0)))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE blobs_total counter', lines)
+        self.assertIn('blobs_total{result="true"} 3.0', lines)
+        self.assertIn('blobs_total{result="false"} 1.0', lines)
+        self.assertIn('connections 7.0', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1.0', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3.0', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4.0', lines)
+        self.assertIn('latency_seconds_sum 6.05', lines)
+        self.assertIn('latency_seconds_count 4.0', lines)
+
+
+class TestConnectionTracer(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = ClusterStorage(self.db_dir, 'fake')
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def test_trace_counts_redis_calls(self):
+        tracer = ConnectionTracer(self.storage, '127.0.0.1', slow_request=0)
+        blob_hash = 'ab' * 48
+        tracer.start('blob')
+        yield tracer.blob_storage.blob_has_been_forwarded_to_host(blob_hash)
+        tracer.mark('blob decision')
+        yield tracer.blob_storage.blob_exists(blob_hash)
+        trace = tracer.finish()
+        self.assertEqual('blob', trace['request'])
+        self.assertEqual(2, trace['redis_calls'])
+        self.assertEqual(['blob decision'], [phase for phase, ms in trace['phases_ms']])
+        # calls through the untraced storage aren't counted
+        tracer.start('blob')
+        yield self.storage.blob_exists(blob_hash)
+        self.assertEqual(0, tracer.finish()['redis_calls'])
+        self.assertIsNone(tracer.finish())
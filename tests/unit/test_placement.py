@@ -0,0 +1,40 @@
+import hashlib
+
+from twisted.trial import unittest
+
+from prism.placement import HashRing, plan_moves
+
+HOSTS = ['host%i:5566' % i for i in range(4)]
+SD_HASHES = [hashlib.sha384(str(i)).hexdigest() for i in range(2000)]
+
+
+class TestHashRing(unittest.TestCase):
+    def test_placement_is_stable(self):
+        ring = HashRing(HOSTS)
+        placements = dict((sd_hash, ring.host_for(sd_hash)) for sd_hash in SD_HASHES)
+        self.assertEqual(set(HOSTS), set(placements.values()))
+        # host order doesn't matter
+        reordered = HashRing(list(reversed(HOSTS)))
+        self.assertEqual([], plan_moves(placements, reordered))
+
+    def test_adding_a_host_moves_its_share(self):
+        ring = HashRing(HOSTS)
+        placements = dict((sd_hash, ring.host_for(sd_hash)) for sd_hash in SD_HASHES)
+        moves = plan_moves(placements, HashRing(HOSTS + ['host4:5566']))
+        # about 1/5 of the streams move, all of them to the new host
+        self.assertTrue(0.1 < float(len(moves)) / len(SD_HASHES) < 0.3)
+        self.assertEqual(set(['host4:5566']), set(to_host for _, _, to_host in moves))
+
+    def test_removing_a_host_only_moves_its_streams(self):
+        ring = HashRing(HOSTS)
+        placements = dict((sd_hash, ring.host_for(sd_hash)) for sd_hash in SD_HASHES)
+        moves = plan_moves(placements, HashRing(HOSTS[1:]))
+        self.assertEqual(sum(1 for host in placements.values() if host == HOSTS[0]), len(moves))
+        self.assertEqual(set([HOSTS[0]]), set(from_host for _, from_host, _ in moves))
+
+    def test_weights_and_full_hosts(self):
+        ring = HashRing(HOSTS[:2], weights={HOSTS[0]: 3})
+        counts = [ring.host_for(sd_hash) for sd_hash in SD_HASHES].count(HOSTS[0])
+        self.assertTrue(0.65 < float(counts) / len(SD_HASHES) < 0.85)
+        self.assertEqual(HOSTS[1], ring.host_for(SD_HASHES[0], full_hosts=[HOSTS[0]]))
+        self.assertIsNone(ring.host_for(SD_HASHES[0], full_hosts=HOSTS[:2]))
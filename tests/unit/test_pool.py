@@ -0,0 +1,142 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import ClientFactory, Protocol, ServerFactory
+
+from prism.protocol.pool import ReflectorConnectionPool
+
+
+class HandshakeServerProtocol(Protocol):
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.lost_d = defer.Deferred()
+
+    def dataReceived(self, data):
+        msg = json.loads(data)
+        if 'version' in msg:
+            self.transport.write(json.dumps({'version': msg['version']}))
+        elif self.factory.drop_requests:
+            # as if the host closed the connection while it was idle
+            self.factory.drop_requests -= 1
+            self.transport.loseConnection()
+        else:
+            self.transport.write(json.dumps({'answer': msg['request']}))
+
+    def connectionLost(self, reason=None):
+        self.lost_d.callback(None)
+
+
+class RequestClient(Protocol):
+    # sends one request on a pooled connection and releases it once answered
+    def connectionMade(self):
+        self.transport.write(json.dumps({'request': self.factory.request}))
+
+    def dataReceived(self, data):
+        self.factory.answers.append(json.loads(data)['answer'])
+        self.pooled_connection.release()
+
+    def connectionLost(self, reason):
+        self.factory.lost.append(reason)
+
+
+class RequestClientFactory(ClientFactory):
+    protocol = RequestClient
+
+    def __init__(self, request):
+        self.request = request
+        self.answers = []
+        self.lost = []
+
+
+class TestReflectorConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server_factory = ServerFactory()
+        self.server_factory.protocol = HandshakeServerProtocol
+        self.server_factory.connections = []
+        self.server_factory.drop_requests = 0
+        self.port = reactor.listenTCP(0, self.server_factory, interface='127.0.0.1')
+        self.port_num = self.port.getHost().port
+        self.clock = task.Clock()
+        self.pool = ReflectorConnectionPool(2, 10, clock=self.clock)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.pool.stop()
+        for connection in self.server_factory.connections:
+            connection.transport.loseConnection()
+        yield defer.DeferredList([c.lost_d for c in self.server_factory.connections])
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        connection = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.pool._release(connection)
+        self.assertEqual(1, self.pool.idle_connections('127.0.0.1', self.port_num))
+        reused = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.assertIs(connection, reused)
+        self.assertEqual(1, len(self.server_factory.connections))
+        self.assertEqual(1, self.pool.open_connections('127.0.0.1', self.port_num))
+
+    @defer.inlineCallbacks
+    def test_max_per_host(self):
+        first = yield self.pool.acquire('127.0.0.1', self.port_num)
+        second = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.assertIsNot(first, second)
+        waiting = self.pool.acquire('127.0.0.1', self.port_num)
+        self.assertFalse(waiting.called)
+        self.pool._release(second)
+        third = yield waiting
+        self.assertIs(second, third)
+        self.assertEqual(2, len(self.server_factory.connections))
+
+    @defer.inlineCallbacks
+    def test_idle_eviction(self):
+        self.pool.start()
+        connection = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.pool._release(connection)
+        self.clock.advance(5)
+        self.assertEqual(1, self.pool.idle_connections('127.0.0.1', self.port_num))
+        self.clock.advance(5)
+        self.assertEqual(0, self.pool.idle_connections('127.0.0.1', self.port_num))
+        yield self.server_factory.connections[0].lost_d
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(0, self.pool.open_connections('127.0.0.1', self.port_num))
+
+        # a connection closed by the host is not handed out
+        connection = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.pool._release(connection)
+        self.server_factory.connections[1].transport.loseConnection()
+        yield self.server_factory.connections[1].lost_d
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(0, self.pool.idle_connections('127.0.0.1', self.port_num))
+
+    @defer.inlineCallbacks
+    def test_peer_closed(self):
+        # a close the reactor hasn't handled yet is seen before the connection is reused
+        connection = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.pool._release(connection)
+        self.server_factory.connections[0].transport.loseConnection()
+        yield self.server_factory.connections[0].lost_d
+        self.assertFalse(connection.is_healthy())
+        other = yield self.pool.acquire('127.0.0.1', self.port_num)
+        self.assertIsNot(connection, other)
+
+    @defer.inlineCallbacks
+    def test_retry_on_closed_reuse(self):
+        first = RequestClientFactory(1)
+        self.pool.connect('127.0.0.1', self.port_num, first)
+        while not first.answers:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        # the host closes the reused connection without answering, the request
+        # is sent again on a new connection
+        self.server_factory.drop_requests = 1
+        second = RequestClientFactory(2)
+        connector = self.pool.connect('127.0.0.1', self.port_num, second)
+        while not second.answers and not second.lost:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual([2], second.answers)
+        self.assertEqual(2, len(self.server_factory.connections))
+        self.assertEqual(self.server_factory.connections[1].transport.getPeer().port,
+                         connector.connection.transport.getHost().port)
+        self.assertEqual(1, self.pool.open_connections('127.0.0.1', self.port_num))
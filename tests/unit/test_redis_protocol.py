@@ -0,0 +1,117 @@
+from redis.exceptions import ConnectionError, NoScriptError, ResponseError
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from prism.storage.redis_protocol import RedisConnectionPool, RedisProtocol, ReplyParser, encode_command
+
+
+class FakePool(object):
+    def __init__(self):
+        self.connections = []
+
+    def connection_ready(self, connection):
+        self.connections.append(connection)
+
+    def connection_lost(self, connection):
+        self.connections.remove(connection)
+
+
+class FakeFactory(object):
+    def __init__(self):
+        self.pool = FakePool()
+
+
+class TestRedisProtocol(unittest.TestCase):
+    def setUp(self):
+        self.factory = FakeFactory()
+        self.protocol = RedisProtocol()
+        self.protocol.factory = self.factory
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_encode_command(self):
+        self.assertEqual('*4\r\n$4\r\nHSET\r\n$1\r\nh\r\n$1\r\nk\r\n$2\r\n10\r\n',
+                         encode_command(('HSET', 'h', 'k', 10)))
+
+    def test_parse_reply(self):
+        parser = ReplyParser()
+        self.assertEqual(['OK', 3, None, 'abc', ['a', 1], []],
+                         parser.feed('+OK\r\n:3\r\n$-1\r\n$3\r\nabc\r\n*2\r\n$1\r\na\r\n:1\r\n*0\r\n'))
+        self.assertEqual([], parser.feed('$3\r\nab'))
+        self.assertEqual(['abc'], parser.feed('c\r\n'))
+        self.assertEqual([], parser.feed('*2\r\n$1\r\na\r\n'))
+        self.assertEqual([['a', 'b']], parser.feed('$1\r\nb\r\n'))
+
+    def test_parse_split_reply(self):
+        # nested arrays and a large bulk string split over many reads are
+        # parsed as they arrive and the bulk string is joined once
+        parser = ReplyParser()
+        bulk = 'x' * 100000
+        data = '*2\r\n$1\r\n0\r\n*2\r\n$%i\r\n%s\r\n:7\r\n' % (len(bulk), bulk)
+        replies = []
+        for i in range(0, len(data), 100):
+            replies.extend(parser.feed(data[i:i + 100]))
+            if i + 100 < len(data):
+                self.assertEqual([], replies)
+        self.assertEqual([['0', [bulk, 7]]], replies)
+        self.assertEqual([], parser._arrays)
+
+    def test_pipelined_replies(self):
+        self.assertEqual([self.protocol], self.factory.pool.connections)
+        d = self.protocol.execute_commands([
+            ('sismember', ('s', 'a')),
+            ('smembers', ('s',)),
+            ('hget', ('h', 'k')),
+            ('delete', ('s',)),
+        ])
+        self.assertEqual(
+            encode_command(('SISMEMBER', 's', 'a')) + encode_command(('SMEMBERS', 's')) +
+            encode_command(('HGET', 'h', 'k')) + encode_command(('DEL', 's')),
+            self.transport.value())
+        # replies may be split at any byte
+        for c in ':1\r\n*2\r\n$1\r\na\r\n$1\r\nb\r\n$-1\r\n:1\r\n':
+            self.protocol.dataReceived(c)
+        self.assertEqual([True, set(['a', 'b']), None, 1], self.successResultOf(d))
+        self.assertEqual(0, self.protocol.pending)
+
+    def test_error_reply(self):
+        d1 = self.protocol.execute_commands([('evalsha', ('abc', 0))])
+        d2 = self.protocol.execute_commands([('hget', ('h', 'k')), ('sadd', ('h', 'k'))])
+        d3 = self.protocol.execute_commands([('hget', ('h', 'k'))])
+        self.protocol.dataReceived('-NOSCRIPT No matching script\r\n')
+        self.protocol.dataReceived('-WRONGTYPE Operation against a key\r\n:1\r\n$1\r\nv\r\n')
+        self.failureResultOf(d1, NoScriptError)
+        self.failureResultOf(d2, ResponseError)
+        self.assertEqual(['v'], self.successResultOf(d3))
+
+    def test_connection_lost(self):
+        d = self.protocol.execute_commands([('hget', ('h', 'k'))])
+        self.protocol.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.failureResultOf(d, ConnectionError)
+        self.assertEqual([], self.factory.pool.connections)
+
+
+class TestRedisConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = RedisConnectionPool('localhost', connect_timeout=10, _reactor=self.clock)
+
+    def test_connect_timeout(self):
+        d = self.pool.execute_commands([('hget', ('h', 'k'))])
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, ConnectionError)
+        self.assertEqual(0, len(self.pool._waiting))
+
+    def test_connection_made_in_time(self):
+        d = self.pool.execute_commands([('hget', ('h', 'k'))])
+        protocol = RedisProtocol()
+        protocol.factory = FakeFactory()
+        protocol.factory.pool = self.pool
+        protocol.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual([], self.clock.getDelayedCalls())
+        protocol.dataReceived('$1\r\nv\r\n')
+        self.assertEqual(['v'], self.successResultOf(d))
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, protocol
+from twisted.test import proto_helpers
+
+from prism.protocol import sender
+from prism.protocol.sender import BlobSender
+
+
+class Consumer(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+
+class CollectingProtocol(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.received = []
+
+    def dataReceived(self, data):
+        self.factory.received.append(data)
+        if sum(len(d) for d in self.factory.received) >= self.factory.expected:
+            self.factory.received_d.callback(''.join(self.factory.received))
+
+    def connectionLost(self, reason=None):
+        self.factory.lost_d.callback(None)
+
+
+class TestBlobSender(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(sender.CHUNK_SIZE * 3 + 100)
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        self.blob_file = open(self.path, 'rb')
+
+    def tearDown(self):
+        self.blob_file.close()
+        os.remove(self.path)
+
+    @defer.inlineCallbacks
+    def test_buffered(self):
+        transport = proto_helpers.StringTransport()
+        blob_sender = BlobSender()
+        yield blob_sender.beginFileTransfer(self.blob_file, Consumer(transport))
+        self.assertFalse(blob_sender.used_sendfile)
+        self.assertEqual(self.data, transport.value())
+        self.assertIsNone(transport.producer)
+
+    @defer.inlineCallbacks
+    def test_sendfile(self):
+        if sender.sendfile is None:
+            raise unittest.SkipTest("sendfile isn't available")
+        server_factory = protocol.ServerFactory()
+        server_factory.protocol = CollectingProtocol
+        server_factory.expected = len(self.data)
+        server_factory.received_d = defer.Deferred()
+        server_factory.lost_d = defer.Deferred()
+        port = reactor.listenTCP(0, server_factory, interface='127.0.0.1')
+        client = yield protocol.ClientCreator(reactor, protocol.Protocol).connectTCP(
+            '127.0.0.1', port.getHost().port)
+        try:
+            blob_sender = BlobSender()
+            yield blob_sender.beginFileTransfer(self.blob_file, Consumer(client.transport))
+            self.assertTrue(blob_sender.used_sendfile)
+            received = yield server_factory.received_d
+            self.assertEqual(self.data, received)
+        finally:
+            client.transport.loseConnection()
+            yield server_factory.lost_d
+            yield port.stopListening()
@@ -0,0 +1,336 @@
+import json
+import socket
+import shutil
+import hashlib
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, reactor, task
+from twisted.internet.protocol import ClientCreator, Protocol
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from prism import server as prism_server
+from prism.protocol import server as server_protocol
+from prism.protocol.budget import InFlightBudget
+from prism.protocol.decoder import ReflectorMessageDecoder
+from prism.protocol.factory import PrismServerFactory
+from prism.server import CHILD_STATS_FD, MAX_RESTART_DELAY, RESTART_DELAY, PrismServer, PrismServerSupervisor
+from prism.server import ServerProcessProtocol, listening_socket, publish_stats
+from prism.storage.storage import STATS_SNAPSHOT, ClusterStorage
+
+
+class TestReflectorServerProtocol(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = ClusterStorage(self.db_dir, 'fake')
+        self.protocol = PrismServerFactory(self.storage).buildProtocol(('127.0.0.1', 0))
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.protocol.setTimeout(None)
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def get_responses(self, count):
+        for _ in range(100):
+            decoder = ReflectorMessageDecoder()
+            data = self.transport.value()
+            responses = []
+            offset = 0
+            while offset < len(data):
+                msg, offset = decoder.decode(data, offset)
+                if msg is None:
+                    break
+                responses.append(msg)
+            if len(responses) >= count:
+                defer.returnValue(responses)
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        self.fail("expected %i responses, got %s" % (count, data))
+
+    @defer.inlineCallbacks
+    def test_pipelined_blobs(self):
+        blobs = ['a' * 100, 'b' * 200, 'c' * 300]
+        blob_hashes = [hashlib.sha384(blob).hexdigest() for blob in blobs]
+        yield self.storage.completed(blob_hashes[1], len(blobs[1]))
+
+        self.protocol.dataReceived(json.dumps({'version': 1, 'pipelined_blobs': 64}))
+        responses = yield self.get_responses(1)
+        self.assertEqual({'version': 1, 'pipelined_blobs': 32}, responses[0])
+
+        # the server already has the second blob, so only the first and third are sent
+        offers = ''.join(json.dumps({'blob_hash': blob_hash, 'blob_size': len(blob),
+                                     'offers_following': 2 - i})
+                         for i, (blob_hash, blob) in enumerate(zip(blob_hashes, blobs)))
+        self.protocol.dataReceived(offers)
+        responses = yield self.get_responses(4)
+        self.assertEqual([{'send_blob': True}, {'send_blob': False}, {'send_blob': True}], responses[1:])
+
+        # the blobs and the next offer arrive in one chunk
+        next_blob = 'd' * 50
+        next_hash = hashlib.sha384(next_blob).hexdigest()
+        self.protocol.dataReceived(blobs[0] + blobs[2] + json.dumps(
+            {'blob_hash': next_hash, 'blob_size': len(next_blob), 'offers_following': 0}) + next_blob)
+        responses = yield self.get_responses(8)
+        self.assertEqual([{'received_blob': True}, {'received_blob': True}, {'send_blob': True},
+                          {'received_blob': True}], responses[4:])
+        for blob_hash in blob_hashes + [next_hash]:
+            out = yield self.storage.blob_exists(blob_hash)
+            self.assertTrue(out)
+
+    @defer.inlineCallbacks
+    def test_too_many_pipelined_offers(self):
+        self.protocol.dataReceived(json.dumps({'version': 1, 'pipelined_blobs': 2}))
+        yield self.get_responses(1)
+        self.protocol.dataReceived(json.dumps({'blob_hash': hashlib.sha384('a').hexdigest(),
+                                               'blob_size': 1, 'offers_following': 2}))
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertTrue(self.transport.disconnecting)
+
+    @defer.inlineCallbacks
+    def test_oversized_offers(self):
+        budget = self.protocol.factory.in_flight = InFlightBudget(1000)
+        self.protocol.dataReceived(json.dumps({'version': 1}))
+        yield self.get_responses(1)
+        self.protocol.dataReceived(json.dumps({'blob_hash': hashlib.sha384('a').hexdigest(), 'blob_size': 2 ** 30}))
+        responses = yield self.get_responses(2)
+        self.assertEqual({'send_blob': False}, responses[1])
+        self.assertEqual(0, budget.reserved)
+        self.protocol.dataReceived(json.dumps({'sd_blob_hash': hashlib.sha384('b').hexdigest(),
+                                               'sd_blob_size': 2 ** 30}))
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(0, budget.reserved)
+        self.flushLoggedErrors()
+
+    @defer.inlineCallbacks
+    def test_oversized_pipelined_offers(self):
+        budget = self.protocol.factory.in_flight = InFlightBudget(1000)
+        self.protocol.dataReceived(json.dumps({'version': 1, 'pipelined_blobs': 8}))
+        yield self.get_responses(1)
+        # offers over the maximum blob size are declined, and the group may
+        # only reserve up to the in flight limit
+        sizes = [2 ** 30, 600, 2 ** 30, 600, 300]
+        self.protocol.dataReceived(''.join(
+            json.dumps({'blob_hash': hashlib.sha384(str(i)).hexdigest(), 'blob_size': size,
+                        'offers_following': len(sizes) - 1 - i}) for i, size in enumerate(sizes)))
+        responses = yield self.get_responses(6)
+        self.assertEqual([{'send_blob': False}, {'send_blob': True}, {'send_blob': False},
+                          {'send_blob': False}, {'send_blob': True}], responses[1:])
+        self.assertEqual(900, budget.reserved)
+        self.assertEqual(900, self.protocol.reserved_bytes)
+
+    @defer.inlineCallbacks
+    def test_handshake_without_pipelining(self):
+        self.protocol.dataReceived(json.dumps({'version': 1}))
+        responses = yield self.get_responses(1)
+        self.assertEqual({'version': 1}, responses[0])
+
+    @defer.inlineCallbacks
+    def test_closed_without_stream(self):
+        # a connection that sent no stream has nothing to enqueue
+        self.protocol.dataReceived(json.dumps({'version': 1}))
+        yield self.get_responses(1)
+        self.patch(server_protocol, 'enqueue_stream', lambda *args, **kwargs: self.fail("enqueued"))
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual([], self.flushLoggedErrors())
+
+    @defer.inlineCallbacks
+    def test_flow_control(self):
+        self.patch(server_protocol, 'CONNECTION_BUFFER_BYTES', 50)
+        budget = self.protocol.factory.in_flight = InFlightBudget(1000)
+        held = yield budget.reserve(1000)
+        self.protocol.dataReceived(json.dumps({'version': 1}))
+        yield self.get_responses(1)
+
+        # the offer waits for room in the budget, and the connection isn't read
+        blob = 'flow control' * 10
+        blob_hash = hashlib.sha384(blob).hexdigest()
+        self.protocol.dataReceived(json.dumps({'blob_hash': blob_hash, 'blob_size': len(blob)}))
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(set(['budget']), self.protocol.paused_for)
+        self.assertEqual('paused', self.transport.producerState)
+        # data that arrives meanwhile is buffered, past the limit it pauses the connection too
+        self.protocol.dataReceived(blob[:60])
+        self.protocol.dataReceived(blob[60:])
+        self.assertEqual(set(['budget', 'buffer']), self.protocol.paused_for)
+
+        budget.release(held)
+        responses = yield self.get_responses(3)
+        self.assertEqual([{'send_blob': True}, {'received_blob': True}], responses[1:])
+        self.assertEqual(set(), self.protocol.paused_for)
+        self.assertEqual('producing', self.transport.producerState)
+        self.assertEqual(0, budget.reserved)
+        self.assertEqual(0, self.protocol.reserved_bytes)
+
+
+class TestInFlightBudget(unittest.TestCase):
+    def test_reservations_wait_in_order(self):
+        budget = InFlightBudget(100)
+        first = budget.reserve(60)
+        second = budget.reserve(60)
+        third = budget.reserve(10)
+        self.assertTrue(first.called)
+        self.assertFalse(second.called)
+        # later reservations don't jump the line even if they'd fit
+        self.assertFalse(third.called)
+        budget.release(60)
+        self.assertTrue(second.called)
+        self.assertTrue(third.called)
+        self.assertEqual(70, budget.reserved)
+
+    def test_force_and_cancel(self):
+        budget = InFlightBudget(100)
+        budget.reserve(100)
+        self.assertTrue(budget.reserve(50, force=True).called)
+        self.assertEqual(150, budget.reserved)
+        waiting = budget.reserve(10)
+        waiting.addErrback(lambda err: err.trap(defer.CancelledError))
+        waiting.cancel()
+        budget.release(150)
+        self.assertEqual(0, budget.reserved)
+
+    def test_larger_than_limit(self):
+        # let in once nothing else is reserved
+        budget = InFlightBudget(100)
+        budget.reserve(10)
+        large = budget.reserve(500)
+        self.assertFalse(large.called)
+        budget.release(10)
+        self.assertTrue(large.called)
+
+
+class TestPublishStats(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = ClusterStorage(self.db_dir, 'fake')
+        self.storage.db.db.flushdb()
+
+    def tearDown(self):
+        self.storage.db.db.flushdb()
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def test_snapshot(self):
+        blob_hashes = [hashlib.sha384(str(i)).hexdigest() for i in range(3)]
+        for i, blob_hash in enumerate(blob_hashes):
+            yield self.storage.completed(blob_hash, 100 * (i + 1))
+        yield self.storage.add_blobs_to_host(blob_hashes[:1], 'somehost')
+        yield self.storage.delete(blob_hashes[1])
+
+        snapshot = yield publish_stats(self.storage, 2, 40)
+        self.assertEqual(json.loads(self.storage.db.db.get(STATS_SNAPSHOT)), snapshot)
+        self.assertEqual(2, snapshot['blobs'])
+        self.assertEqual(1, snapshot['local_blobs'])
+        self.assertEqual(300, snapshot['local_bytes'])
+        self.assertEqual({'somehost': 1}, snapshot['hosts'])
+        self.assertEqual(2, snapshot['connections'])
+        self.assertEqual(40, snapshot['open_files'])
+
+
+class HandshakeClient(Protocol):
+    def connectionMade(self):
+        self.response_d = defer.Deferred()
+        self.transport.write(json.dumps({'version': 1}))
+
+    def dataReceived(self, data):
+        self.response_d.callback(json.loads(data))
+
+
+class TestServerProcesses(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = ClusterStorage(self.db_dir, 'fake')
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def test_shared_listening_socket(self):
+        sock = listening_socket(0, '127.0.0.1')
+        server = PrismServer(cluster_storage=self.storage, listen_fd=sock.fileno())
+        server.startService()
+        try:
+            client = yield ClientCreator(reactor, HandshakeClient).connectTCP('127.0.0.1', sock.getsockname()[1])
+            response = yield client.response_d
+            self.assertEqual({'version': 1}, response)
+            client.transport.abortConnection()
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        finally:
+            yield server.stopService()
+            sock.close()
+
+    def test_connection_reports(self):
+        process = ServerProcessProtocol(None, 0)
+        process.childDataReceived(CHILD_STATS_FD, '3 20\n1')
+        self.assertEqual((3, 20), (process.connections, process.open_files))
+        process.childDataReceived(CHILD_STATS_FD, '2 30\n')
+        self.assertEqual((12, 30), (process.connections, process.open_files))
+        # the other pipes are not counts
+        process.childDataReceived(1, '7 7\n')
+        self.assertEqual((12, 30), (process.connections, process.open_files))
+
+    def test_supervisor_counts(self):
+        # the published counts are those of the server processes, the open files
+        # include the supervisor's own
+        clock, supervisor, spawned = self._supervisor()
+        self.patch(prism_server, 'open_files', lambda: 5)
+        supervisor.running[0].childDataReceived(CHILD_STATS_FD, '3 20\n')
+        supervisor.running[1].childDataReceived(CHILD_STATS_FD, '4 30\n')
+        self.assertEqual(7, supervisor.connections())
+        self.assertEqual(55, supervisor.open_files())
+
+    def _supervisor(self):
+        # a supervisor whose processes are stand-ins recording the signals sent to them
+        clock = task.Clock()
+        supervisor = PrismServerSupervisor(2, cluster_storage=self.storage, clock=clock)
+        supervisor._socket = socket.socket()
+        self.addCleanup(supervisor._socket.close)
+        spawned = []
+
+        def spawnProcess(process, executable, args, env, childFDs):
+            process.transport = proto_helpers.StringTransport()
+            process.transport.signalProcess = process.transport.write
+            spawned.append(process.index)
+        self.patch(prism_server.reactor, 'spawnProcess', spawnProcess)
+        for index in range(supervisor.processes):
+            supervisor.spawn(index)
+        return clock, supervisor, spawned
+
+    def _exit(self, supervisor, index):
+        supervisor.running[index].processEnded(failure.Failure(error.ProcessTerminated(1)))
+
+    def test_restart_backoff(self):
+        clock, supervisor, spawned = self._supervisor()
+        self._exit(supervisor, 0)
+        self.assertEqual([RESTART_DELAY], [call.getTime() for call in clock.getDelayedCalls()])
+        clock.advance(RESTART_DELAY)
+        self.assertEqual([0, 1, 0], spawned)
+        # a process that keeps exiting waits twice as long each time, up to the cap
+        delays = []
+        for _ in range(8):
+            self._exit(supervisor, 0)
+            delay = supervisor.restarts[0].getTime() - clock.seconds()
+            delays.append(delay)
+            clock.advance(delay)
+        self.assertEqual([2, 4, 8, 16, 32, 60, 60, 60], delays)
+        self.assertEqual(MAX_RESTART_DELAY, delays[-1])
+        # one that ran for a while starts over
+        clock.advance(MAX_RESTART_DELAY)
+        self._exit(supervisor, 0)
+        self.assertEqual(RESTART_DELAY, supervisor.restarts[0].getTime() - clock.seconds())
+
+    def test_stop_does_not_restart(self):
+        clock, supervisor, spawned = self._supervisor()
+        self._exit(supervisor, 1)
+        stopped_d = supervisor.stopService()
+        self.assertEqual([], clock.getDelayedCalls())
+        self.assertEqual('TERM', supervisor.running[0].transport.value())
+        self.assertNoResult(stopped_d)
+        self._exit(supervisor, 0)
+        self.successResultOf(stopped_d)
+        self.assertEqual([], clock.getDelayedCalls())
+        clock.advance(MAX_RESTART_DELAY)
+        self.assertEqual([0, 1], spawned)
+        self.assertEqual({}, supervisor.running)
@@ -1,3 +1,4 @@
+import os
 import shutil
 import tempfile
 from os import path
@@ -6,15 +7,18 @@ import time
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from prism.storage.storage import ClusterStorage, CLUSTER_BLOBS
+from prism.storage.storage import ClusterStorage, CLUSTER_BLOBS, BLOB_HASHES, BLOB_RECORD, RedisHelper
 from lbrynet.blob.blob_file import BlobFile
 
 class TestClusterStorage(unittest.TestCase):
     def setUp(self):
         self.db_dir = tempfile.mkdtemp()
         self.cs = ClusterStorage(self.db_dir, 'fake')
+        # every fakeredis connection shares one database
+        self.cs.db.db.flushdb()
 
     def tearDown(self):
+        self.cs.db.db.flushdb()
         shutil.rmtree(self.db_dir)
 
     @defer.inlineCallbacks
@@ -102,5 +106,250 @@ class TestClusterStorage(unittest.TestCase):
         self.assertEqual(None, out.length)
         self.assertFalse(out._verified)
 
+    @defer.inlineCallbacks
+    def test_blob_record_formats(self):
+        blob_hashes = [str(i) * 96 for i in range(3)]
+        # entries written before the packed format
+        self.cs.db.db.hset(BLOB_HASHES, blob_hashes[0], '[10, 1.5, "oldhost"]')
+        self.cs.db.db.hset(BLOB_HASHES, blob_hashes[1], '20')
+        out = yield self.cs.db.get_blob(blob_hashes[0])
+        self.assertEqual((10, 1.5, 'oldhost'), out)
+        out = yield self.cs.db.get_blob(blob_hashes[1])
+        self.assertEqual((20, 0, ''), out)
+
+        yield self.cs.db.set_blob(blob_hashes[2], 30, 2.5, 'newhost')
+        self.assertEqual(BLOB_RECORD.size, len(self.cs.db.db.hget(BLOB_HASHES, blob_hashes[2])))
+        # another process learns the host from the host table
+        other = RedisHelper('fake')
+        out = yield other.get_blob(blob_hashes[2])
+        self.assertEqual((30, 2.5, 'newhost'), out)
+        host_id = yield other.get_host_id('newhost')
+        out = yield self.cs.db.get_host_id('newhost')
+        self.assertEqual(host_id, out)
+
+    @defer.inlineCallbacks
+    def test_raw_layout(self):
+        self.cs.db = RedisHelper('fake', layout='raw')
+        sd_hash = 'ab' * 48
+        blob_hashes = ['%02x' % i * 48 for i in range(3)]
+        yield self.cs.db.add_sd_blob(sd_hash, blob_hashes)
+        for blob_hash in [sd_hash] + blob_hashes:
+            yield self.cs.db.set_blob(blob_hash, 10, 1.5)
+        yield self.cs.add_blobs_to_host(blob_hashes[:1], 'somehost')
+
+        # members are stored as digests, the stream set is still keyed by the hex hash
+        self.assertEqual(set(b.decode('hex') for b in blob_hashes), self.cs.db.db.smembers(sd_hash))
+        self.assertTrue(self.cs.db.db.sismember('somehost', blob_hashes[0].decode('hex')))
+        self.assertFalse(self.cs.db.db.hexists(BLOB_HASHES, sd_hash))
+
+        out = yield self.cs.db.get_blobs_for_stream(sd_hash)
+        self.assertEqual(set(blob_hashes), out)
+        num_blobs, missing = yield self.cs.db.find_missing_blobs(sd_hash=sd_hash, check_local=False)
+        self.assertEqual(3, num_blobs)
+        self.assertEqual(set(blob_hashes[1:]), set(missing))
+        out = yield self.cs.db.get_blob(blob_hashes[0])
+        self.assertEqual((10, 1.5, 'somehost'), out)
+        out = yield self.cs.db.scan_sd_blobs()
+        self.assertIn(sd_hash, out[1])
+        out = yield self.cs.db.get_unforwarded_streams([sd_hash])
+        self.assertEqual([(sd_hash, 3)], out)
+
+    @defer.inlineCallbacks
+    def test_blob_directory_levels(self):
+        blob_hash = 'ab' * 48
+        cs = ClusterStorage(self.db_dir, 'fake', dir_levels=2)
+        self.assertEqual(path.join(self.db_dir, 'ab', 'ab', blob_hash), cs.get_blob_path(blob_hash))
+        self.assertFalse(path.isdir(path.join(self.db_dir, 'ab', 'ab')))
+        blob = yield cs.get_blob(blob_hash, 10)
+        self.assertEqual(path.join(self.db_dir, 'ab', 'ab', blob_hash), blob.file_path)
+        self.assertTrue(path.isdir(path.join(self.db_dir, 'ab', 'ab')))
+        # a blob left by the flat layout is only looked for with the fallback
+        other_hash = 'cd' * 48
+        open(path.join(self.db_dir, other_hash), 'wb').close()
+        self.assertEqual(path.join(self.db_dir, 'cd', 'cd'), cs.get_blob_dir(other_hash))
+        cs = ClusterStorage(self.db_dir, 'fake', dir_levels=2, dir_fallback=True)
+        self.assertEqual(self.db_dir, cs.get_blob_dir(other_hash))
+        os.makedirs(path.join(self.db_dir, 'cd', 'cd'))
+        os.rename(path.join(self.db_dir, other_hash), path.join(self.db_dir, 'cd', 'cd', other_hash))
+        self.assertEqual(path.join(self.db_dir, 'cd', 'cd'), cs.get_blob_dir(other_hash))
+
+    def test_unknown_layout(self):
+        self.assertRaises(ValueError, RedisHelper, 'fake', layout='base64')
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        batch = self.cs.db.batch()
+        batch.sadd('somehost', 'a', 'b')
+        batch.sismember('somehost', 'a')
+        batch.scard('somehost')
+        batch.hget('missing', 'a')
+        batch.hmget('missing', ['a', 'b'])
+        self.assertEqual(('missing', 'a', 'b'), batch.commands[-1][1])
+        self.assertEqual(5, len(batch))
+        out = yield batch.execute()
+        self.assertEqual([2, True, 2, None, [None, None]], out)
+        self.assertEqual(0, len(batch))
+        out = yield batch.execute()
+        self.assertEqual([], out)
+
+    @defer.inlineCallbacks
+    def test_add_blobs_to_host(self):
+        blob_hashes = [
+            '6ac46ae5445eb2d26ff41739440ac92d240fdade9a34d38f87f5b47154f6edc95f637a1a2cdb3ae60aa2c2ef91533d38',
+            '1ac46ae5445eb2d26ff41739440ac92d240fdade9a34d38f87f5b47154f6edc95f637a1a2cdb3ae60aa2c2ef91533d11',
+        ]
+        for blob_hash in blob_hashes:
+            yield self.cs.completed(blob_hash, 10)
+        yield self.cs.add_blobs_to_host(blob_hashes, 'somehost')
+        for blob_hash in blob_hashes:
+            out = yield self.cs.get_blob_host(blob_hash)
+            self.assertEqual('somehost', out)
+            out = yield self.cs.blob_has_been_forwarded_to_host(blob_hash)
+            self.assertTrue(out)
+        out = yield self.cs.get_host_count('somehost')
+        self.assertEqual(2, out)
+
+    @defer.inlineCallbacks
+    def test_host_counts(self):
+        # a host that had blobs before its count was kept
+        batch = self.cs.db.batch()
+        batch.sadd('counthost', 'a', 'b', 'c')
+        yield batch.execute()
+        out = yield self.cs.get_host_count('counthost')
+        self.assertEqual(3, out)
+
+        blob_hashes = [
+            '2ac46ae5445eb2d26ff41739440ac92d240fdade9a34d38f87f5b47154f6edc95f637a1a2cdb3ae60aa2c2ef91533d38',
+            '3ac46ae5445eb2d26ff41739440ac92d240fdade9a34d38f87f5b47154f6edc95f637a1a2cdb3ae60aa2c2ef91533d11',
+        ]
+        for blob_hash in blob_hashes:
+            yield self.cs.completed(blob_hash, 10)
+        yield self.cs.add_blobs_to_host(blob_hashes, 'counthost')
+        # blobs already on the host are not counted twice
+        yield self.cs.add_blobs_to_host(blob_hashes[:1], 'counthost')
+        out = yield self.cs.get_host_count('counthost')
+        self.assertEqual(5, out)
+
+        yield self.cs.db.reset_blob_host(blob_hashes[0], 10, 0, 'counthost')
+        yield self.cs.db.delete_blob_from_host(blob_hashes[1], 'counthost')
+        yield self.cs.db.delete_blob_from_host(blob_hashes[1], 'counthost')
+        out = yield self.cs.get_host_count('counthost')
+        self.assertEqual(3, out)
+
+    @defer.inlineCallbacks
+    def test_get_needed_blobs_for_stream(self):
+        sd_hash = 'c81b73e05e9b2e782a3d6b1cd2b6f3ba7b37da9359641e25b5d5a39fec4f6989d25c815e671be0c1deff62b25f50b5f5'
+        in_cluster, local, missing = [
+            '6ac46ae5445eb2d26ff41739440ac92d240fdade9a34d38f87f5b47154f6edc95f637a1a2cdb3ae60aa2c2ef91533d38',
+            '1ac46ae5445eb2d26ff41739440ac92d240fdade9a34d38f87f5b47154f6edc95f637a1a2cdb3ae60aa2c2ef91533d11',
+            '0aceb607d62e5c75468ded32343a2812d69e0f4545c9fd471f2e1f96f0b6769fda58584a88e9c96778372916b9062b0f',
+        ]
+        # unknown stream
+        out = yield self.cs.get_needed_blobs_for_stream(sd_hash)
+        self.assertEqual(None, out)
+
+        yield self.cs.db.add_sd_blob(sd_hash, [in_cluster, local, missing])
+        yield self.cs.completed(in_cluster, 10)
+        yield self.cs.add_blob_to_host(in_cluster, 'somehost')
+        yield self.cs.completed(local, 10)
+        out = yield self.cs.get_needed_blobs_for_stream(sd_hash)
+        self.assertEqual([missing], out)
+
+        out = yield self.cs.db.find_missing_blobs(blob_hashes=[in_cluster, local, missing],
+                                                  check_local=False)
+        self.assertEqual((3, [local, missing]), out)
+
+    @defer.inlineCallbacks
+    def test_verify_stream_ready_to_forward(self):
+        sd_hash = 'c81b73e05e9b2e782a3d6b1cd2b6f3ba7b37da9359641e25b5d5a39fec4f6989d25c815e671be0c1deff62b25f50b5f5'
+        blob_hash = '0aceb607d62e5c75468ded32343a2812d69e0f4545c9fd471f2e1f96f0b6769fda58584a88e9c96778372916b9062b0f'
+        yield self.cs.db.add_sd_blob(sd_hash, [blob_hash])
+        yield self._write_completed_blob(sd_hash)
+        out = yield self.cs.verify_stream_ready_to_forward(sd_hash)
+        self.assertFalse(out)
+
+        # the verification records are trusted as long as the files match them
+        yield self._write_completed_blob(blob_hash)
+        out = yield self.cs.verify_stream_ready_to_forward(sd_hash)
+        self.assertTrue(out)
+        out = yield self.cs.get_stream_blob_count(sd_hash)
+        self.assertEqual(1, out)
+
+        # blobs on a host are no longer stored locally
+        yield self.cs.add_blob_to_host(blob_hash, 'somehost')
+        blob_hashes, states = yield self.cs.get_stream_state(sd_hash)
+        self.assertEqual([blob_hash], blob_hashes)
+        self.assertEqual((10, 'somehost', True, False), states[blob_hash])
+        out = yield self.cs.verify_stream_ready_to_forward(sd_hash)
+        self.assertFalse(out)
+
+    @defer.inlineCallbacks
+    def test_verification_cache(self):
+        sd_hash = 'c81b73e05e9b2e782a3d6b1cd2b6f3ba7b37da9359641e25b5d5a39fec4f6989d25c815e671be0c1deff62b25f50b5f5'
+        blob_hash = '0aceb607d62e5c75468ded32343a2812d69e0f4545c9fd471f2e1f96f0b6769fda58584a88e9c96778372916b9062b0f'
+        yield self.cs.db.add_sd_blob(sd_hash, [blob_hash])
+        yield self._write_completed_blob(sd_hash)
+        yield self._write_completed_blob(blob_hash)
+        self.assertEqual(2, len(self.cs.verification_cache))
+
+        # a fresh process has no cached entries and uses the records in redis
+        cs = ClusterStorage(self.db_dir, 'fake')
+        cs.db = self.cs.db
+        out = yield cs.verify_stream_ready_to_forward(sd_hash)
+        self.assertTrue(out)
+        self.assertEqual(2, len(cs.verification_cache))
+
+        # a file that no longer matches its record is not verified
+        with open(path.join(self.db_dir, blob_hash), 'wb') as f:
+            f.write('b' * 11)
+        out = yield cs.verify_stream_ready_to_forward(sd_hash)
+        self.assertFalse(out)
+
+        # blobs received before verifications were recorded are checked and recorded
+        yield self.cs.db.hdel('verified_blobs', sd_hash)
+        cs = ClusterStorage(self.db_dir, 'fake')
+        cs.db = self.cs.db
+        blob_hashes, states = yield cs.get_stream_state(sd_hash)
+        self.assertTrue(states[sd_hash][3])
+        out = yield self.cs.db.hexists('verified_blobs', sd_hash)
+        self.assertTrue(out)
+
+        yield self.cs.delete(sd_hash)
+        self.assertEqual(1, len(self.cs.verification_cache))
+
+    @defer.inlineCallbacks
+    def test_completed_without_stat(self):
+        # callers that don't pass the mtime and inode get the blob file's
+        blob_hash = 'e' * 96
+        blob_path = path.join(self.db_dir, blob_hash)
+        with open(blob_path, 'wb') as f:
+            f.write('e' * 10)
+        yield self.cs.completed(blob_hash, 10)
+        st = os.stat(blob_path)
+        record = yield self.cs.db.hget('verified_blobs', blob_hash)
+        self.assertEqual((10, st.st_mtime, st.st_ino), self.cs.db._decode_verified(record))
+        yield self.cs.delete(blob_hash)
+
+    @defer.inlineCallbacks
+    def test_local_blob_bytes(self):
+        # a blob received again isn't counted twice, and a forwarded blob is no
+        # longer counted
+        blob_hashes = ['1' * 96, '2' * 96]
+        for blob_hash in blob_hashes + blob_hashes[:1]:
+            yield self.cs.completed(blob_hash, 10)
+        self.assertEqual('20', self.cs.db.db.get('local_blob_bytes'))
+        yield self.cs.add_blob_to_host(blob_hashes[0], 'somehost')
+        self.assertEqual('10', self.cs.db.db.get('local_blob_bytes'))
+        yield self.cs.delete_blob_from_host(blob_hashes[0])
+        self.assertEqual('20', self.cs.db.db.get('local_blob_bytes'))
+
+    @defer.inlineCallbacks
+    def _write_completed_blob(self, blob_hash, blob_length=10):
+        blob_path = path.join(self.db_dir, blob_hash)
+        with open(blob_path, 'wb') as f:
+            f.write('a' * blob_length)
+        st = os.stat(blob_path)
+        yield self.cs.completed(blob_hash, blob_length, st.st_mtime, st.st_ino)
+
 if __name__=='__main__':
     unittest.main()
@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+
+from rq import Queue
+from rq.job import Job, JobStatus
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from prism.protocol.factory import build_prism_stream_client_factory
+from prism.protocol.task import acquire_stream_locks, enqueue_stream, enqueue_streams, release_stream_locks
+from prism.protocol.task import stream_job_id
+from prism import server as prism_server
+from prism.server import enqueue_on_start
+from prism.storage.storage import CLUSTER_BLOBS, SUPPRESSED_STREAM_JOBS, ClusterStorage, get_redis_connection
+
+SD_HASH = 'c81b73e05e9b2e782a3d6b1cd2b6f3ba7b37da9359641e25b5d5a39fec4f6989d25c815e671be0c1deff62b25f50b5f5'
+
+
+class TestEnqueueStream(unittest.TestCase):
+    def setUp(self):
+        self.redis = get_redis_connection('fake')
+        self.redis.flushdb()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def enqueue(self):
+        return enqueue_stream(SD_HASH, 2, '/tmp', build_prism_stream_client_factory, 'fake')
+
+    def test_duplicate_jobs_are_suppressed(self):
+        self.assertTrue(self.enqueue())
+        self.assertFalse(self.enqueue())
+        self.assertEqual([stream_job_id(SD_HASH)], Queue(connection=self.redis).job_ids)
+        self.assertEqual(1, int(self.redis.get(SUPPRESSED_STREAM_JOBS)))
+
+        # once the job has run the stream can be enqueued again
+        self.redis.hset(Job.key_for(stream_job_id(SD_HASH)), 'status', JobStatus.FINISHED)
+        self.assertTrue(self.enqueue())
+
+    def test_locked_stream_is_not_enqueued(self):
+        token, = acquire_stream_locks(self.redis, [SD_HASH])
+        self.assertEqual([None], acquire_stream_locks(self.redis, [SD_HASH]))
+        self.assertFalse(self.enqueue())
+        # a token that doesn't hold the lock doesn't release it
+        release_stream_locks(self.redis, [(SD_HASH, 'other')])
+        self.assertFalse(self.enqueue())
+        release_stream_locks(self.redis, [(SD_HASH, token)])
+        self.assertTrue(self.enqueue())
+        self.assertEqual(2, int(self.redis.get(SUPPRESSED_STREAM_JOBS)))
+
+    def test_enqueue_streams(self):
+        other_hash = 'a' * 96
+        self.assertTrue(self.enqueue())
+        out = enqueue_streams([(SD_HASH, 2), (other_hash, 5)], '/tmp', build_prism_stream_client_factory, 'fake')
+        self.assertEqual([False, True], out)
+        self.assertEqual([stream_job_id(SD_HASH), stream_job_id(other_hash)], Queue(connection=self.redis).job_ids)
+        self.assertEqual(180, Job.fetch(stream_job_id(other_hash), self.redis).timeout)
+
+
+class TestEnqueueOnStart(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = ClusterStorage(self.db_dir, 'fake')
+        self.redis = get_redis_connection('fake')
+        self.redis.flushdb()
+
+    def tearDown(self):
+        self.redis.flushdb()
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def test_only_unforwarded_streams_are_enqueued(self):
+        sd_hashes = [str(i) * 96 for i in range(3)]
+        for i, sd_hash in enumerate(sd_hashes):
+            yield self.storage.db.add_sd_blob(sd_hash, ['%i-%i' % (i, j) for j in range(i + 1)])
+        self.redis.sadd(CLUSTER_BLOBS, sd_hashes[0])
+        yield enqueue_on_start(self.storage, rate=1000)
+        job_ids = Queue(connection=self.redis).job_ids
+        self.assertEqual(sorted(stream_job_id(sd_hash) for sd_hash in sd_hashes[1:]), sorted(job_ids))
+        # the job timeouts come from the stream sizes
+        self.assertEqual(120, Job.fetch(stream_job_id(sd_hashes[2]), self.redis).timeout)
+
+    @defer.inlineCallbacks
+    def test_rate(self):
+        # the streams are enqueued at the rate from the first one, a tenth of a second's worth at a time
+        for i in range(5):
+            yield self.storage.db.add_sd_blob(str(i) * 96, ['%i-0' % i])
+        clock = task.Clock()
+        batches = []
+
+        def deferToThread(func, streams, *args):
+            batches.append((clock.seconds(), len(streams)))
+            return defer.succeed([True] * len(streams))
+        self.patch(prism_server.threads, 'deferToThread', deferToThread)
+        d = enqueue_on_start(self.storage, rate=20, clock=clock)
+        clock.pump([0.05] * 10)
+        yield d
+        self.assertEqual([(0, 2), (0.1, 2), (0.2, 1)], [(round(t, 2), n) for t, n in batches])